@@ -1,2 +1,2 @@
 from bytecode_tracer import BytecodeTracer, rewrite_function,\
-    has_been_rewritten, rewrite_lnotab
+    has_been_rewritten, rewrite_lnotab, rewrite_cache
@@ -117,20 +117,43 @@ def flatlist_to_dict(alist):
     return dict(zip(alist[::2], alist[1::2]))
 
 class Bytecode(object):
-    def __init__(self, name, arg1=None, arg2=None):
+    """A single instruction of a code object.
+
+    `handler` is a function that reports events caused by execution of the
+    instruction (see StandardBytecodeTracer.trace) or None if there are no
+    events to report. Instances are shared between frames, so they shouldn't
+    be modified.
+    """
+    def __init__(self, name, arg1=None, arg2=None, handler=None):
         self.name = name
         self.arg1 = arg1
         self.arg2 = arg2
+        self.handler = handler
+
+def bytecode_table(code):
+    """Return a list that maps offsets of instructions in the code to their
+    Bytecode objects. Offsets of instruction arguments map to None.
 
-def current_bytecode(frame):
-    code = frame.f_code.co_code[frame.f_lasti:]
-    op = ord(code[0])
-    name = opcode.opname[op]
-    arg1, arg2 = None, None
-    if op >= opcode.HAVE_ARGUMENT:
-        arg1 = ord(code[1])
-        arg2 = ord(code[2])
-    return Bytecode(name=name, arg1=arg1, arg2=arg2)
+    >>> def fun(x):
+    ...     return x
+    >>> [b and b.name for b in bytecode_table(fun.func_code)]
+    ['LOAD_FAST', None, None, 'RETURN_VALUE']
+    """
+    co_code = code.co_code
+    table = [None] * len(co_code)
+    offset = 0
+    while offset < len(co_code):
+        op = ord(co_code[offset])
+        name = opcode.opname[op]
+        handler = bytecode_handlers.get(name)
+        if op >= opcode.HAVE_ARGUMENT:
+            table[offset] = Bytecode(name, ord(co_code[offset+1]),
+                                     ord(co_code[offset+2]), handler)
+            offset += 3
+        else:
+            table[offset] = Bytecode(name, handler=handler)
+            offset += 1
+    return table
 
 def is_c_func(func):
     """Return True if given function object was implemented in C,
@@ -151,11 +174,128 @@ def name_from_arg(frame, bcode):
     return frame.f_code.co_names[bcode.arg1]
 
 def frame_module(frame):
+    """Return the module which globals the frame uses or None if there is no
+    such module.
+
+    Module named by the '__name__' global is checked first, so the whole
+    sys.modules has to be scanned only for code executed in custom globals.
+    """
     g = frame.f_globals
+    name = g.get('__name__')
+    if isinstance(name, str):
+        module = sys.modules.get(name)
+        if getattr(module, '__dict__', None) is g:
+            return module
     for module in sys.modules.itervalues():
         if hasattr(module, '__dict__') and module.__dict__ is g:
             return module
 
+# Handlers of bytecodes that cause StandardBytecodeTracer events. Each one
+# is a generator taking the tracer, the frame and the Bytecode object.
+
+def handle_call_function(tracer, frame, bcode):
+    value_stack = ValueStack(frame, bcode)
+    function = value_stack.bottom()
+    # Python functions are handled by the standard trace mechanism, but
+    # we have to make sure any C calls the function makes can be traced
+    # by us later, so we rewrite its bytecode.
+    if not is_c_func(function):
+        rewrite_function(function, tracer.selective)
+        return
+    tracer.call_stack.append(True)
+    pargs = value_stack.positional_args()
+    kargs = value_stack.keyword_args()
+    # Rewrite all callables that may have been passed to the C function.
+    rewrite_all(pargs + kargs.values(), tracer.selective)
+    yield 'c_call', (function, pargs, kargs)
+
+def handle_print_newline(tracer, frame, bcode):
+    yield 'print', os.linesep
+
+def handle_print_newline_to(tracer, frame, bcode):
+    stack = get_value_stack_top(frame)
+    yield 'print_to', (os.linesep, stack[-1])
+
+def handle_print_item(tracer, frame, bcode):
+    stack = get_value_stack_top(frame)
+    yield 'print', stack[-1]
+
+def handle_print_item_to(tracer, frame, bcode):
+    stack = get_value_stack_top(frame)
+    yield 'print_to', (stack[-2], stack[-1])
+
+def handle_store_attr(tracer, frame, bcode):
+    stack = get_value_stack_top(frame)
+    yield 'store_attr', (stack[-1], name_from_arg(frame, bcode), stack[-2])
+
+def handle_delete_attr(tracer, frame, bcode):
+    stack = get_value_stack_top(frame)
+    yield 'delete_attr', (stack[-1], name_from_arg(frame, bcode))
+
+def handle_load_global(tracer, frame, bcode):
+    module = tracer.frame_module(frame)
+    if module:
+        try:
+            name = name_from_arg(frame, bcode)
+            value = frame.f_globals[name]
+            yield 'load_global', (module.__name__, name, value)
+        except KeyError:
+            pass
+
+def handle_store_global(tracer, frame, bcode):
+    module = tracer.frame_module(frame)
+    if module:
+        stack = get_value_stack_top(frame)
+        yield 'store_global', (module.__name__,
+                               name_from_arg(frame, bcode),
+                               stack[-1])
+
+def handle_delete_global(tracer, frame, bcode):
+    module = tracer.frame_module(frame)
+    if module:
+        yield 'delete_global', (module.__name__,
+                                name_from_arg(frame, bcode))
+
+bytecode_handlers = {
+    'PRINT_NEWLINE': handle_print_newline,
+    'PRINT_NEWLINE_TO': handle_print_newline_to,
+    'PRINT_ITEM': handle_print_item,
+    'PRINT_ITEM_TO': handle_print_item_to,
+    'STORE_ATTR': handle_store_attr,
+    'DELETE_ATTR': handle_delete_attr,
+    'LOAD_GLOBAL': handle_load_global,
+    'STORE_GLOBAL': handle_store_global,
+    'DELETE_GLOBAL': handle_delete_global,
+}
+for name in opcode.opname:
+    if name.startswith("CALL_FUNCTION"):
+        bytecode_handlers[name] = handle_call_function
+
+def interesting_offsets(code):
+    """Return a list of offsets of instructions StandardBytecodeTracer has to
+    stop at: the first one, the ones that have handlers and the ones right
+    after function calls (needed for detection of 'c_return' events).
+
+    >>> def fun(x):
+    ...     return len(x)
+    >>> interesting_offsets(fun.func_code)
+    [0, 6, 9]
+    """
+    co_code = code.co_code
+    offsets = [0]
+    offset = 0
+    while offset < len(co_code):
+        name = opcode.opname[ord(co_code[offset])]
+        if name in bytecode_handlers and offset != offsets[-1]:
+            offsets.append(offset)
+        if ord(co_code[offset]) >= opcode.HAVE_ARGUMENT:
+            offset += 3
+        else:
+            offset += 1
+        if name.startswith("CALL_FUNCTION") and offset < len(co_code):
+            offsets.append(offset)
+    return offsets
+
 class StandardBytecodeTracer(object):
     """A tracer that goes over each bytecode and reports events that couldn't
     be traced by other means.
@@ -175,16 +315,57 @@ class StandardBytecodeTracer(object):
         finally:
             sys.settrace(None)
     """
-    def __init__(self):
+    def __init__(self, selective=True):
+        # Passed to rewrite_lnotab for all code this tracer rewrites.
+        self.selective = selective
         # Will contain False for calls to Python functions and True for calls to
         # C functions.
         self.call_stack = []
+        # Maps ids of globals dictionaries to (globals, module) pairs. Globals
+        # are kept, so their ids can't be reused while they're in the index.
+        self.modules_by_globals = {}
+        # Maps ids of code objects to (code, bytecode table) pairs, for the
+        # same reason.
+        self.bytecode_tables = {}
 
     def setup(self):
-        code_rewriting_importer.install(rewrite_lnotab)
+        self.modules_by_globals = {}
+        self.bytecode_tables = {}
+        code_rewriting_importer.install(self.rewrite_code)
 
     def teardown(self):
         code_rewriting_importer.uninstall()
+        # Let the modules imported during tracing go.
+        self.modules_by_globals = {}
+        self.bytecode_tables = {}
+        rewrite_cache.clear()
+
+    def rewrite_code(self, code):
+        return rewrite_lnotab(code, self.selective)
+
+    def current_bytecode(self, frame):
+        """Return the Bytecode object of the instruction about to be executed
+        in the frame.
+        """
+        code = frame.f_code
+        try:
+            table = self.bytecode_tables[id(code)][1]
+        except KeyError:
+            table = bytecode_table(code)
+            self.bytecode_tables[id(code)] = (code, table)
+        return table[frame.f_lasti]
+
+    def frame_module(self, frame):
+        """Return the result of frame_module(frame), remembering it for
+        other frames using the same globals.
+        """
+        g = frame.f_globals
+        try:
+            return self.modules_by_globals[id(g)][1]
+        except KeyError:
+            module = frame_module(frame)
+            self.modules_by_globals[id(g)] = (g, module)
+            return module
 
     def trace(self, frame, event):
         """Tries to recognize the current event in terms of calls to and returns
@@ -221,58 +402,12 @@ class StandardBytecodeTracer(object):
                 # C function. Most commonly that will be the 'compile' function.
                 # TODO: Make sure the old code is garbage collected.
                 if type(stack[-1]) is CodeType:
-                    stack[-1] = rewrite_lnotab(stack[-1])
+                    stack[-1] = self.rewrite_code(stack[-1])
                 yield 'c_return', stack[-1]
-            bcode = current_bytecode(frame)
-            if bcode.name.startswith("CALL_FUNCTION"):
-                value_stack = ValueStack(frame, bcode)
-                function = value_stack.bottom()
-                # Python functions are handled by the standard trace mechanism, but
-                # we have to make sure any C calls the function makes can be traced
-                # by us later, so we rewrite its bytecode.
-                if not is_c_func(function):
-                    rewrite_function(function)
-                    return
-                self.call_stack.append(True)
-                pargs = value_stack.positional_args()
-                kargs = value_stack.keyword_args()
-                # Rewrite all callables that may have been passed to the C function.
-                rewrite_all(pargs + kargs.values())
-                yield 'c_call', (function, pargs, kargs)
-            elif bcode.name == "PRINT_NEWLINE":
-                yield 'print', os.linesep
-            else:
-                stack = get_value_stack_top(frame)
-                if bcode.name == "PRINT_NEWLINE_TO":
-                    yield 'print_to', (os.linesep, stack[-1])
-                elif bcode.name == "PRINT_ITEM":
-                    yield 'print', stack[-1]
-                elif bcode.name == "PRINT_ITEM_TO":
-                    yield 'print_to', (stack[-2], stack[-1])
-                elif bcode.name == "STORE_ATTR":
-                    yield 'store_attr', (stack[-1], name_from_arg(frame, bcode), stack[-2])
-                elif bcode.name == "DELETE_ATTR":
-                    yield 'delete_attr', (stack[-1], name_from_arg(frame, bcode))
-                elif bcode.name == "LOAD_GLOBAL":
-                    module = frame_module(frame)
-                    if module:
-                        try:
-                            name = name_from_arg(frame, bcode)
-                            value = frame.f_globals[name]
-                            yield 'load_global', (module.__name__, name, value)
-                        except KeyError:
-                            pass
-                elif bcode.name == "STORE_GLOBAL":
-                    module = frame_module(frame)
-                    if module:
-                        yield 'store_global', (module.__name__,
-                                               name_from_arg(frame, bcode),
-                                               stack[-1])
-                elif bcode.name == "DELETE_GLOBAL":
-                    module = frame_module(frame)
-                    if module:
-                        yield 'delete_global', (module.__name__,
-                                                name_from_arg(frame, bcode))
+            bcode = self.current_bytecode(frame)
+            if bcode.handler is not None:
+                for bytecode_event in bcode.handler(self, frame, bcode):
+                    yield bytecode_event
         elif event == 'call':
             self.call_stack.append(False)
         # When an exception happens in Python >= 2.4 code, 'exception' and
@@ -320,38 +455,110 @@ if sys.version_info < (2, 4):
 else:
     BytecodeTracer = StandardBytecodeTracer
 
-def rewrite_lnotab(code):
+class RewriteCache(object):
+    """Registry of code objects rewritten by rewrite_lnotab, which makes
+    both rewriting and has_been_rewritten checks simple lookups.
+
+    Code objects can't be weakly referenced, so the registry keeps them,
+    making sure their ids aren't reused until it's cleared. Tracers clear
+    it on teardown.
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        # Maps (id of an original code, selective) pairs to (original code,
+        # rewritten code) pairs.
+        self.rewrites = {}
+        # Maps ids of rewritten code objects to the objects themselves.
+        self.rewritten = {}
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, code, selective, rewritten):
+        self.rewrites[(id(code), selective)] = (code, rewritten)
+        self.rewritten[id(rewritten)] = rewritten
+
+rewrite_cache = RewriteCache()
+
+def rewrite_lnotab(code, selective=True):
     """Replace a code object's line number information to claim that every
-    byte of the bytecode is a new line. Returns a new code object.
+    instruction StandardBytecodeTracer is interested in starts a new line
+    (see interesting_offsets). Returns a new code object.
     Also recurses to hack the line numbers in nested code objects.
 
+    When selective is False, every byte of the bytecode is claimed to be
+    a new line instead. Tracer reports the same events for code rewritten
+    either way, but selective rewriting makes the interpreter call the trace
+    function a lot less often.
+
     Based on Ned Batchelder's hackpyc.py:
       http://nedbatchelder.com/blog/200804/wicked_hack_python_bytecode_tracing.html
     """
     if has_been_rewritten(code):
+        rewrite_cache.hits += 1
         return code
-    n_bytes = len(code.co_code)
-    new_lnotab = "\x01\x01" * (n_bytes-1)
+    try:
+        rewritten = rewrite_cache.rewrites[(id(code), selective)][1]
+        rewrite_cache.hits += 1
+        return rewritten
+    except KeyError:
+        rewrite_cache.misses += 1
+    if selective:
+        new_lnotab = selective_lnotab(interesting_offsets(code))
+    else:
+        new_lnotab = "\x01\x01" * (len(code.co_code)-1)
     new_consts = []
     for const in code.co_consts:
         if type(const) is CodeType:
-            new_consts.append(rewrite_lnotab(const))
+            new_consts.append(rewrite_lnotab(const, selective))
         else:
             new_consts.append(const)
-    return CodeType(code.co_argcount, code.co_nlocals, code.co_stacksize,
+    rewritten = CodeType(code.co_argcount, code.co_nlocals, code.co_stacksize,
         code.co_flags, code.co_code, tuple(new_consts), code.co_names,
         code.co_varnames, code.co_filename, code.co_name, 0, new_lnotab,
         code.co_freevars, code.co_cellvars)
+    rewrite_cache.add(code, selective, rewritten)
+    return rewritten
 
-def rewrite_function(function):
+def selective_lnotab(offsets):
+    """Return a line number table that starts a new line at each of the given
+    offsets. Instruction at offset 0 always starts a line.
+
+    Address increments bigger than 255 are split into (255, 0) entries.
+
+    >>> selective_lnotab([0, 6, 9])
+    '\\x06\\x01\\x03\\x01'
+    >>> selective_lnotab([300])
+    '\\xff\\x00-\\x01'
+    """
+    lnotab = []
+    previous = 0
+    for offset in offsets:
+        if offset == previous:
+            continue
+        increment = offset - previous
+        while increment > 255:
+            lnotab.append("\xff\x00")
+            increment -= 255
+        lnotab.append(chr(increment) + "\x01")
+        previous = offset
+    return "".join(lnotab)
+
+def rewrite_function(function, selective=True):
     if isinstance(function, MethodType):
         function = function.im_func
-    function.func_code = rewrite_lnotab(function.func_code)
+    function.func_code = rewrite_lnotab(function.func_code, selective)
 
-def rewrite_all(objects):
+def rewrite_all(objects, selective=True):
     for obj in objects:
         if hasattr(obj, 'func_code'):
-            rewrite_function(obj)
+            rewrite_function(obj, selective)
+
+# Tables written by rewrite_lnotab in both modes, which only ever increase
+# line numbers by one. Rewritten code also begins at line 0, which
+# the compiler never does.
+rewritten_lnotab_re = re.compile(r"\A((\xff\x00)*[\x01-\xff]\x01)*\Z")
 
 def has_been_rewritten(code):
     """Return True if the code has been rewritten by rewrite_lnotab already.
@@ -364,4 +571,11 @@ def has_been_rewritten(code):
     >>> has_been_rewritten(fun.func_code)
     True
     """
-    return re.match(r"\A(\x01\x01)+\Z", code.co_lnotab) is not None
+    if id(code) in rewrite_cache.rewritten:
+        return True
+    if code.co_firstlineno != 0 or \
+            rewritten_lnotab_re.match(code.co_lnotab) is None:
+        return False
+    # Code has been rewritten before the cache was cleared.
+    rewrite_cache.rewritten[id(code)] = code
+    return True
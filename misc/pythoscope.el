@@ -35,6 +35,10 @@
       (format "one %s" word)
       (format "%d %ss" count word)))
 
+(defvar pythoscope-command "pythoscope"
+  "Command used to generate tests. Set it to \"pythoscope-client\" to use
+a running pythoscope-daemon instead of starting pythoscope every time.")
+
 (defvar *pythoscope-process-output* "")
 
 (defun pythoscope-generated-tests ()
@@ -82,7 +86,7 @@ inspection."
   (setq *pythoscope-process-output* "")
   (let ((process (start-process "pythoscope-process"
                                 (current-buffer)
-                                "pythoscope"
+                                pythoscope-command
                                 filename)))
     (set-process-sentinel process 'pythoscope-process-sentinel)
     (set-process-filter process 'pythoscope-process-filter))
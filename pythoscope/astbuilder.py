@@ -2,6 +2,8 @@
 Module containing functions for parsing and modification of an AST.
 """
 
+import logging
+
 from pythoscope.logger import log
 from pythoscope.util import quoted_block
 from pythoscope.astvisitor import is_leaf_of_type, is_node_of_type
@@ -18,6 +20,11 @@ __all__ = ["EmptyCode", "Newline", "ParseError", "clone", "create_import",
 EmptyCode = lambda: Node(syms.file_input, [])
 Newline = lambda: Leaf(token.NEWLINE, "\n")
 
+# Driver used by parse(). It creates a new lib2to3 parser for each string
+# it parses and keeps no other state between parses, so a single instance
+# per process can be safely shared between threads.
+_driver = driver.Driver(pygram.python_grammar, pytree.convert)
+
 def clone(tree):
     """Clone the tree, preserving its add_newline attribute.
     """
@@ -77,9 +84,11 @@ def parse(code):
         code += "\n"
         added_newline = True
 
+    # Debug output of the driver logs every single token, so only ask
+    # for it when it is going to be printed.
+    debug = _driver.logger.isEnabledFor(logging.DEBUG)
     try:
-        drv = driver.Driver(pygram.python_grammar, pytree.convert)
-        result = drv.parse_string(code, True)
+        result = _driver.parse_string(code, debug)
     except ParseError:
         log.debug("Had problems parsing:\n%s\n" % quoted_block(code))
         raise
@@ -6,7 +6,7 @@ and extracting information from an AST.
 from lib2to3 import pytree
 from lib2to3.patcomp import compile_pattern
 from lib2to3.pgen2 import token
-from lib2to3.pytree import Node, Leaf
+from lib2to3.pytree import Node, Leaf, WildcardPattern
 
 __all__ = ["ASTError", "ASTVisitor", "descend", "find_last_leaf",
     "get_starting_whitespace", "is_leaf_of_type", "is_node_of_type",
@@ -125,6 +125,52 @@ def derive_import_names(node):
         return [derive_import_name(node)]
 
 
+def pattern_node_types(pattern):
+    """Return a list of node types given compiled pattern can match, or None
+    if it may match a node of any type.
+    """
+    if pattern.type is not None:
+        return [pattern.type]
+    if isinstance(pattern, WildcardPattern) and pattern.min == 1 and \
+            pattern.max == 1 and pattern.content:
+        types = []
+        for alternative in pattern.content:
+            if len(alternative) != 1:
+                return None
+            alternative_types = pattern_node_types(alternative[0])
+            if alternative_types is None:
+                return None
+            types.extend(alternative_types)
+        return types
+    return None
+
+def dispatch_table(patterns):
+    """Take a list of (method, compiled pattern) pairs and return a tuple
+    (patterns_by_type, any_type_patterns).
+
+    patterns_by_type maps node types to lists of pairs which may match
+    a node of that type, while any_type_patterns lists pairs which may
+    match a node of any other type. Order of pairs is preserved.
+    """
+    any_type_patterns = []
+    patterns_by_type = {}
+    for method, pattern in patterns:
+        types = pattern_node_types(pattern)
+        if types is None:
+            any_type_patterns.append((method, pattern))
+            for type_patterns in patterns_by_type.values():
+                type_patterns.append((method, pattern))
+        else:
+            for type in types:
+                if type not in patterns_by_type:
+                    patterns_by_type[type] = list(any_type_patterns)
+                patterns_by_type[type].append((method, pattern))
+    return patterns_by_type, any_type_patterns
+
+# Compiled patterns are shared between visitors. This is a mapping of
+# pattern lists (as tuples) to tuples of (compiled patterns, dispatch table).
+_compiled_patterns = {}
+
 class ASTVisitor(object):
     DEFAULT_PATTERNS = [
         ('_visit_all', "file_input< nodes=any* >"),
@@ -137,14 +183,25 @@ class ASTVisitor(object):
     ]
 
     def __init__(self):
-        self.patterns = []
-        for method, pattern in self.DEFAULT_PATTERNS:
-            self.register_pattern(method, pattern)
+        key = tuple(self.DEFAULT_PATTERNS)
+        try:
+            self.patterns, (self._patterns_by_type, self._any_type_patterns) = \
+                _compiled_patterns[key]
+        except KeyError:
+            self.patterns = [(method, compile_pattern(pattern))
+                             for method, pattern in self.DEFAULT_PATTERNS]
+            self._patterns_by_type, self._any_type_patterns = \
+                dispatch_table(self.patterns)
+            _compiled_patterns[key] = (self.patterns,
+                (self._patterns_by_type, self._any_type_patterns))
 
     def register_pattern(self, method, pattern):
         """Register method to handle given pattern.
         """
-        self.patterns.append((method, compile_pattern(pattern)))
+        # Don't modify the list shared with other visitors.
+        self.patterns = self.patterns + [(method, compile_pattern(pattern))]
+        self._patterns_by_type, self._any_type_patterns = \
+            dispatch_table(self.patterns)
 
     def visit(self, tree):
         """Main entry point of the ASTVisitor class.
@@ -163,7 +220,8 @@ class ASTVisitor(object):
         pass
 
     def visit_node(self, node):
-        for method, pattern in self.patterns:
+        patterns = self._patterns_by_type.get(node.type, self._any_type_patterns)
+        for method, pattern in patterns:
             results = {}
             if pattern.match(node, results):
                 getattr(self, method)(results)
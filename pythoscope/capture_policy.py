@@ -0,0 +1,150 @@
+"""Policies deciding which calls get captured during dynamic inspection.
+
+By default all calls are captured, which for long running points of entry
+means memory usage growing with each call. A policy can bound the number
+of captured calls of each definition:
+
+  first:N   Capture the first N calls.
+  sample:N  Capture a uniform random sample of N calls (reservoir sampling).
+  unique    Capture only calls with distinct inputs.
+
+Policies decide about units of capture, which are single calls for
+functions and whole user objects for methods, as method calls of a single
+object are meaningful only together. Unit's key is its Function or Class.
+"""
+
+import random
+
+from pythoscope.serializer import is_immutable, is_mapping, is_sequence
+from pythoscope.util import class_of
+
+
+class CapturePolicy(object):
+    """Policy capturing everything.
+    """
+    def admit(self, key, args):
+        """Return True if a new unit of given key, first called with given
+        arguments, should be captured.
+
+        It's called before any of the arguments gets serialized.
+        """
+        return True
+
+    def captured(self, key, unit):
+        """Register an admitted unit, after it has been captured.
+
+        Return a unit of the same key captured earlier, which should be
+        dropped now, or None.
+        """
+        return None
+
+class FirstCalls(CapturePolicy):
+    """Policy capturing up to `limit` first units of each key.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.counts = {}
+
+    def admit(self, key, args):
+        count = self.counts.get(key, 0)
+        if count < self.limit:
+            self.counts[key] = count + 1
+            return True
+        return False
+
+class SampledCalls(CapturePolicy):
+    """Policy keeping a uniform random sample of `size` units of each key,
+    using reservoir sampling. Once the sample is full, each admitted unit
+    replaces a random unit captured earlier.
+    """
+    def __init__(self, size, rng=None):
+        if rng is None:
+            rng = random.Random()
+        self.size = size
+        self.rng = rng
+        # Key => number of units seen.
+        self.counts = {}
+        # Key => list of captured units.
+        self.reservoirs = {}
+
+    def admit(self, key, args):
+        count = self.counts.get(key, 0) + 1
+        self.counts[key] = count
+        return count <= self.size or self.rng.randrange(count) < self.size
+
+    def captured(self, key, unit):
+        reservoir = self.reservoirs.setdefault(key, [])
+        if len(reservoir) < self.size:
+            reservoir.append(unit)
+            return None
+        index = self.rng.randrange(self.size)
+        evicted = reservoir[index]
+        reservoir[index] = unit
+        return evicted
+
+class UniqueCalls(CapturePolicy):
+    """Policy capturing only units with distinct input signatures (see
+    input_signature).
+    """
+    def __init__(self):
+        self.signatures = set()
+
+    def admit(self, key, args):
+        try:
+            signature = (key, input_signature(args))
+            if signature in self.signatures:
+                return False
+            self.signatures.add(signature)
+        except TypeError:
+            # Unhashable signature, capture to be on the safe side.
+            pass
+        return True
+
+# :: {str: object, ...} -> tuple
+def input_signature(args):
+    """Cheap approximation of the call arguments, which doesn't require
+    serializing them. Immutable arguments are represented by their classes
+    and values, while other objects only by their classes and, for
+    collections, lengths.
+
+        >>> input_signature({'x': 1, 'y': [1, 2]}) == input_signature({'y': [3, 4], 'x': 1})
+        True
+        >>> input_signature({'x': 1}) == input_signature({'x': 2})
+        False
+        >>> input_signature({'x': 1}) == input_signature({'x': True})
+        False
+        >>> input_signature({'x': []}) == input_signature({'x': [1]})
+        False
+    """
+    signature = []
+    for name, value in sorted(args.items()):
+        if is_immutable(value):
+            signature.append((name, class_of(value), value))
+        elif is_sequence(value) or is_mapping(value):
+            signature.append((name, class_of(value), len(value)))
+        else:
+            signature.append((name, class_of(value)))
+    return tuple(signature)
+
+# :: str | None -> CapturePolicy
+def capture_policy_from_spec(spec):
+    """Create a policy from its textual description (see the module
+    docstring). None stands for the policy capturing everything.
+
+    Raises ValueError for invalid descriptions.
+    """
+    if spec is None or spec == 'all':
+        return CapturePolicy()
+    if spec == 'unique':
+        return UniqueCalls()
+    parts = spec.split(':')
+    if len(parts) == 2 and parts[0] in ['first', 'sample']:
+        try:
+            limit = int(parts[1])
+        except ValueError:
+            limit = 0
+        if limit > 0:
+            if parts[0] == 'first':
+                return FirstCalls(limit)
+            return SampledCalls(limit)
+    raise ValueError("Unknown capture policy %r." % spec)
@@ -1,21 +1,29 @@
 import getopt
 import os
 import sys
+import time
+import traceback
 
 import logger
 
-from inspector import inspect_project, inspect_project_statically
+from capture_policy import capture_policy_from_spec
+from code_trees_manager import DEFAULT_CACHE_ENTRIES, DEFAULT_CACHE_BYTES
+from inspector import inspect_project, inspect_project_incrementally, \
+    inspect_project_statically, ProjectWatcher
 from generator import add_tests_to_project, UnknownTemplate
 from logger import log
 from store import Project, ModuleNotFound, ModuleNeedsAnalysis, \
      ModuleSaveError, get_pythoscope_path, get_points_of_entry_path, \
-     get_code_trees_path
+     get_code_trees_path, get_excludes_path
+from inspector.file_system import write_excludes
 from compat import samefile
 
 
 __version__ = '0.5dev'
 
 BUGTRACKER_URL = "https://bugs.launchpad.net/pythoscope"
+# How often (in seconds) the --watch mode looks for changed files.
+WATCH_INTERVAL = 1.0
 USAGE = """Pythoscope usage:
 
     %s [options] [module names...]
@@ -33,6 +41,15 @@ notation. For example, both of the following are acceptable:
 All test files will be written to a single directory.
 
 Options:
+  --cache-entries=N, --cache-bytes=N
+                 Use together with --init. Keep at most N syntax trees of
+                 modules, occupying about N bytes, in memory at once.
+                 Defaults are 16 trees and 33554432 bytes (32 MB).
+  -c, --content-digests
+                 Use together with --init. Remember digests of the
+                 project files, so that files which only had their
+                 modification time changed (e.g. after a checkout)
+                 don't get inspected again.
   -f, --force    Go ahead and overwrite any existing test files. Default
                  is to skip generation of tests for files that would
                  otherwise get overwriten.
@@ -43,18 +60,56 @@ Options:
                  Initialization creates .pythoscope/ directory in the
                  project directory, which will store all information
                  related to test generation.
+                 Directories and files listed in .pythoscope/excludes
+                 (virtualenvs and packaging by-products by default) will
+                 not be inspected.
+                 Only code of project modules is traced when points
+                 of entry are run. Globs of module names listed in
+                 .pythoscope/tracing can add other modules ("+glob")
+                 or leave project modules out ("-glob").
                  It will also perform a static (thus perfectly safe)
                  inspection of the project source code.
                  You may provide an argument after this option, which
                  should be a path pointing to a directory of a project
                  you want to initialize. If you don't provide one,
                  current directory will be used.
+  -j N, --jobs=N Parse modules during static inspection using N worker
+                 processes. Default is 1, which doesn't start any extra
+                 processes.
+  -l, --lazy-code-trees
+                 Use together with --init. Inspect modules with the
+                 builtin Python parser, which is faster, and build their
+                 full syntax trees only when tests are added to them.
+  -p POLICY, --capture-policy=POLICY
+                 Use together with --init. Bound the number of calls
+                 captured for each function and the number of objects
+                 captured for each class when points of entry are run:
+                   first:N   capture the first N of them,
+                   sample:N  capture a random sample of N of them,
+                   unique    capture only those called with distinct
+                             arguments.
+                 Default is to capture everything.
   -t TEMPLATE_NAME, --template=TEMPLATE_NAME
                  Name of a template to use (see below for a list of
                  available templates). Default is "unittest".
   -q, --quiet    Don't print anything unless it's an error.
+  -s, --sharded-store
+                 Use together with --init. Store project information in
+                 separate files for each module and point of entry, so
+                 that only the needed parts get loaded and only changed
+                 parts get saved. Recommended for large projects.
   -v, --verbose  Be very verbose (basically enable debug output).
   -V, --version  Print Pythoscope version and exit.
+  -w, --watch    Keep watching the project for changes and inspect changed
+                 modules as soon as they are saved, rerunning only those
+                 points of entry that imported them (or changed themselves).
+                 Project information is saved after each change, so
+                 subsequent test generation doesn't have to wait for the
+                 inspection. Stop it with Ctrl-C.
+                 You may provide an argument after this option, which
+                 should be a path pointing to a directory of a project
+                 you want to watch. If you don't provide one, current
+                 directory will be used.
 
 Available templates:
   * unittest     All tests are placed into classes which derive from
@@ -70,6 +125,18 @@ def fail(message):
     log.error(message)
     sys.exit(1)
 
+def positive_integer_option(opt, value):
+    """Return value of the option as a positive integer, failing if it
+    isn't one.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number <= 0:
+        fail("Value of %s should be a positive integer, got %r." % (opt, value))
+    return number
+
 class PythoscopeDirectoryMissing(Exception):
     pass
 
@@ -95,7 +162,10 @@ def find_project_directory(path):
     else:
         return find_project_directory(os.path.join(path, os.path.pardir))
 
-def init_project(path, skip_inspection=False):
+def init_project(path, skip_inspection=False, sharded_store=False,
+                 content_digests=False, jobs=1, lazy_code_trees=False,
+                 capture_policy=None, cache_entries=DEFAULT_CACHE_ENTRIES,
+                 cache_bytes=DEFAULT_CACHE_BYTES):
     pythoscope_path = get_pythoscope_path(path)
 
     try:
@@ -103,21 +173,77 @@ def init_project(path, skip_inspection=False):
         os.makedirs(pythoscope_path)
         os.makedirs(get_points_of_entry_path(path))
         os.makedirs(get_code_trees_path(path))
-    except OSError, err:
+        write_excludes(get_excludes_path(path))
+    except (OSError, IOError), err:
         fail("Couldn't initialize Pythoscope directory: %s." % err.strerror)
 
     project = Project.from_directory(path)
+    if sharded_store:
+        project.use_sharded_store()
+    if content_digests:
+        project.use_content_digests()
+    if lazy_code_trees:
+        project.use_lazy_code_trees()
+    if capture_policy is not None:
+        project.use_capture_policy(capture_policy)
+    if (cache_entries, cache_bytes) != (DEFAULT_CACHE_ENTRIES, DEFAULT_CACHE_BYTES):
+        project.use_code_trees_cache_limits(cache_entries, cache_bytes)
     if not skip_inspection:
         log.debug("Performing initial static inspection of the project source code.")
-        inspect_project_statically(project)
+        inspect_project_statically(project, jobs)
     project.save()
 
-def generate_tests(modules, force, template):
-    try:
+def generate_tests(modules, force, template, jobs=1):
+    def generate():
         project = Project.from_directory(find_project_directory(modules[0]))
-        inspect_project(project)
+        inspect_project(project, jobs)
         add_tests_to_project(project, modules, template, force)
         project.save()
+    report_generation_errors(generate)
+
+def watch_project(path, jobs=1):
+    try:
+        project = Project.from_directory(find_project_directory(path))
+    except PythoscopeDirectoryMissing:
+        fail("Can't find .pythoscope/ directory for this project. "
+             "Initialize the project with the '--init' option first.")
+    if project._store is None:
+        log.info("Project information is kept in a single file, which will "
+                 "be rewritten after each change. Initialize the project with "
+                 "the '--sharded-store' option to save only changed parts.")
+    # Take the first snapshot before inspection, so changes made in the
+    # meantime don't go unnoticed.
+    watcher = ProjectWatcher(project)
+    inspect_project(project, jobs)
+    project.save(keep_code_trees=True)
+    log.info("Watching %s for changes, press Ctrl-C to stop." % project.path)
+    while True:
+        time.sleep(WATCH_INTERVAL)
+        inspect_changes(project, watcher, jobs)
+
+def inspect_changes(project, watcher, jobs=1):
+    """Inspect the project files changed since the watcher's last snapshot
+    and save the project, logging any errors instead of letting them stop
+    the watch. Files may be e.g. deleted in the middle of inspection, in
+    which case the next snapshot will tell about it.
+    """
+    try:
+        changed_paths = watcher.changes()
+        if changed_paths:
+            log.debug("Changed files: %s." % ", ".join(changed_paths))
+            points_of_entry = inspect_project_incrementally(project, changed_paths, jobs)
+            project.save(keep_code_trees=True)
+            log.info("Inspected %d changed files and ran %d points of entry." % \
+                         (len(changed_paths), len(points_of_entry)))
+    except Exception:
+        log.error("Inspecting the changes failed:\n%s" % traceback.format_exc())
+
+def report_generation_errors(generate):
+    """Call the generate function, reporting known problems with the fail
+    function.
+    """
+    try:
+        generate()
     except PythoscopeDirectoryMissing:
         fail("Can't find .pythoscope/ directory for this project. "
              "Initialize the project with the '--init' option first.")
@@ -146,34 +272,68 @@ def main():
     appname = os.path.basename(sys.argv[0])
 
     try:
-        options, args = getopt.getopt(sys.argv[1:], "fhit:qvV",
-                        ["force", "help", "init", "template=", "quiet", "verbose", "version"])
+        options, args = getopt.getopt(sys.argv[1:], "cfhij:lp:t:qsvVw",
+                        ["cache-entries=", "cache-bytes=",
+                         "content-digests", "force", "help", "init", "jobs=",
+                         "lazy-code-trees", "capture-policy=", "template=",
+                         "quiet", "sharded-store", "verbose", "version", "watch"])
     except getopt.GetoptError, err:
         log.error("%s\n" % err)
         print USAGE % appname
         sys.exit(1)
 
+    cache_bytes = DEFAULT_CACHE_BYTES
+    cache_entries = DEFAULT_CACHE_ENTRIES
+    capture_policy = None
+    content_digests = False
     force = False
     init = False
+    jobs = 1
+    lazy_code_trees = False
+    sharded_store = False
     template = "unittest"
+    watch = False
 
     for opt, value in options:
-        if opt in ("-f", "--force"):
+        if opt == "--cache-entries":
+            cache_entries = positive_integer_option(opt, value)
+        elif opt == "--cache-bytes":
+            cache_bytes = positive_integer_option(opt, value)
+        elif opt in ("-c", "--content-digests"):
+            content_digests = True
+        elif opt in ("-f", "--force"):
             force = True
         elif opt in ("-h", "--help"):
             print USAGE % appname
             sys.exit()
         elif opt in ("-i", "--init"):
             init = True
+        elif opt in ("-j", "--jobs"):
+            try:
+                jobs = int(value)
+            except ValueError:
+                fail("Number of jobs should be an integer, got %r." % value)
+        elif opt in ("-l", "--lazy-code-trees"):
+            lazy_code_trees = True
+        elif opt in ("-p", "--capture-policy"):
+            try:
+                capture_policy_from_spec(value)
+            except ValueError, err:
+                fail(str(err))
+            capture_policy = value
         elif opt in ("-t", "--template"):
             template = value
         elif opt in ("-q", "--quiet"):
             log.level = logger.ERROR
+        elif opt in ("-s", "--sharded-store"):
+            sharded_store = True
         elif opt in ("-v", "--verbose"):
             log.level = logger.DEBUG
         elif opt in ("-V", "--version"):
             print "%s %s" % (appname, __version__)
             sys.exit()
+        elif opt in ("-w", "--watch"):
+            watch = True
 
     try:
         if init:
@@ -181,13 +341,22 @@ def main():
                 project_path = args[0]
             else:
                 project_path = "."
-            init_project(project_path)
+            init_project(project_path, sharded_store=sharded_store,
+                         content_digests=content_digests, jobs=jobs,
+                         lazy_code_trees=lazy_code_trees,
+                         capture_policy=capture_policy,
+                         cache_entries=cache_entries, cache_bytes=cache_bytes)
+        elif watch:
+            if args:
+                watch_project(args[0], jobs)
+            else:
+                watch_project(".", jobs)
         else:
             if not args:
                 log.error("You didn't specify any modules for test generation.\n")
                 print USAGE % appname
             else:
-                generate_tests(args, force, template)
+                generate_tests(args, force, template, jobs)
     except KeyboardInterrupt:
         log.info("Interrupted by the user.")
     except Exception: # SystemExit gets through
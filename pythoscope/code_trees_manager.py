@@ -1,92 +1,227 @@
-import os
-
-from pythoscope.logger import log
-from pythoscope.util import string2filename, load_pickle_from
-
-
-class CodeTreeNotFound(Exception):
-    def __init__(self, module_subpath):
-        Exception.__init__(self, "Couldn't find code tree for module %r." % module_subpath)
-        self.module_subpath = module_subpath
-
-class CodeTreesManager(object):
-    def __init__(self, code_trees_path):
-        raise NotImplementedError
-
-    # :: (CodeTree, str) -> None
-    def remember_code_tree(self, code_tree, module_subpath):
-        raise NotImplementedError
-
-    # :: str -> CodeTree
-    def recall_code_tree(self, module_subpath):
-        """Return code tree corresponding to a module located under given subpath.
-
-        May raise CodeTreeNotFound exception.
-        """
-        raise NotImplementedError
-
-    # :: str -> None
-    def forget_code_tree(self, module_subpath):
-        """Get rid of the CodeTree for a module located under given subpath.
-        Do nothing if the module doesn't exist.
-        """
-        raise NotImplementedError
-
-    def clear_cache(self):
-        pass
-
-class FilesystemCodeTreesManager(CodeTreesManager):
-    """Manager of CodeTree instances that keeps at most one CodeTree instance
-    in a memory, storing the rest in files.
-    """
-    def __init__(self, code_trees_path):
-        self.code_trees_path = code_trees_path
-        self._cached_code_tree = None
-
-    def remember_code_tree(self, code_tree, module_subpath):
-        log.debug("Saving code tree for module %r to a file and caching..." % \
-                      module_subpath)
-        code_tree.save(self._code_tree_path(module_subpath))
-        self._cache(code_tree, module_subpath)
-
-    def recall_code_tree(self, module_subpath):
-        if self._is_cached(module_subpath):
-            return self._cached_code_tree[1]
-        try:
-            log.debug("Loading code tree for module %r from a file and caching..." % \
-                          module_subpath)
-            code_tree = load_pickle_from(self._code_tree_path(module_subpath))
-            self._cache(code_tree, module_subpath)
-            return code_tree
-        except IOError:
-            raise CodeTreeNotFound(module_subpath)
-
-    def forget_code_tree(self, module_subpath):
-        try:
-            os.remove(self._code_tree_path(module_subpath))
-        except OSError:
-            pass
-        self._remove_from_cache(module_subpath)
-
-    def clear_cache(self):
-        if self._cached_code_tree:
-            old_module_subpath, old_code_tree = self._cached_code_tree
-            log.debug("Code tree for module %r gets out of cache, "\
-                          "saving to a file..." %  old_module_subpath)
-            old_code_tree.save(self._code_tree_path(old_module_subpath))
-        self._cached_code_tree = None
-
-    def _cache(self, code_tree, module_subpath):
-        self.clear_cache()
-        self._cached_code_tree = (module_subpath, code_tree)
-
-    def _is_cached(self, module_subpath):
-        return self._cached_code_tree and self._cached_code_tree[0] == module_subpath
-
-    def _remove_from_cache(self, module_subpath):
-        if self._is_cached(module_subpath):
-            self._cached_code_tree = None
-
-    def _code_tree_path(self, module_subpath):
-        code_tree_filename = string2filename(module_subpath) + '.pickle'
-        return os.path.join(self.code_trees_path, code_tree_filename)
+import cPickle
+import os
+
+from pythoscope.compat import md5
+from pythoscope.logger import log
+from pythoscope.util import read_file_contents, string2filename,\
+    write_content_to_file
+
+
+# Default limits of the FilesystemCodeTreesManager cache.
+DEFAULT_CACHE_ENTRIES = 16
+DEFAULT_CACHE_BYTES = 32 * 1024 * 1024
+
+class CodeTreeNotFound(Exception):
+    def __init__(self, module_subpath):
+        Exception.__init__(self, "Couldn't find code tree for module %r." % module_subpath)
+        self.module_subpath = module_subpath
+
+class CodeTreesManager(object):
+    def __init__(self, code_trees_path):
+        raise NotImplementedError
+
+    # :: (CodeTree, str) -> None
+    def remember_code_tree(self, code_tree, module_subpath):
+        raise NotImplementedError
+
+    # :: str -> CodeTree
+    def recall_code_tree(self, module_subpath):
+        """Return code tree corresponding to a module located under given subpath.
+
+        May raise CodeTreeNotFound exception.
+        """
+        raise NotImplementedError
+
+    # :: str -> None
+    def forget_code_tree(self, module_subpath):
+        """Get rid of the CodeTree for a module located under given subpath.
+        Do nothing if the module doesn't exist.
+        """
+        raise NotImplementedError
+
+    def clear_cache(self):
+        pass
+
+    def flush(self):
+        """Save all changed code trees, but keep them in memory.
+        """
+        pass
+
+class CachedCodeTree(object):
+    """Entry of the FilesystemCodeTreesManager cache.
+
+    `size` is the length of the CodeTree's pickle, which we use as an
+    approximation of its size in memory. `digest` is a checksum of the
+    pickle last written to (or read from) the file, so we can tell whether
+    the tree changed since.
+    """
+    def __init__(self, code_tree, size, digest):
+        self.code_tree = code_tree
+        self.size = size
+        self.digest = digest
+
+class FilesystemCodeTreesManager(CodeTreesManager):
+    """Manager of CodeTree instances that keeps a limited number of recently
+    used CodeTree instances in a memory, storing the rest in files.
+
+    The cache is bounded both by a number of entries (max_entries) and by
+    an approximate number of bytes (max_bytes) the cached trees occupy. Any
+    of those limits can be turned off by setting it to None. When the cache
+    gets full, the least recently used trees are evicted. Trees are written
+    back to their files only if they are dirty (see CodeTree) and their
+    pickle differs from the one last saved.
+    """
+    def __init__(self, code_trees_path, max_entries=DEFAULT_CACHE_ENTRIES,
+                 max_bytes=DEFAULT_CACHE_BYTES):
+        self.code_trees_path = code_trees_path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        # Module subpath => CachedCodeTree instance.
+        self._cache = {}
+        # Module subpaths, from the least to the most recently used.
+        self._lru = []
+        self._cached_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_not_written = 0
+
+    def __getstate__(self):
+        # Cached code trees are stored in their own files.
+        state = self.__dict__.copy()
+        state['_cache'] = {}
+        state['_lru'] = []
+        state['_cached_bytes'] = 0
+        return state
+
+    def remember_code_tree(self, code_tree, module_subpath):
+        log.debug("Saving code tree for module %r to a file and caching..." % \
+                      module_subpath)
+        self._remove_from_cache(module_subpath)
+        size, digest = self._save(code_tree, module_subpath)
+        self._cache_tree(CachedCodeTree(code_tree, size, digest), module_subpath)
+
+    def recall_code_tree(self, module_subpath):
+        if self._is_cached(module_subpath):
+            self.hits += 1
+            self._touch(module_subpath)
+            return self._cache[module_subpath].code_tree
+        self.misses += 1
+        try:
+            log.debug("Loading code tree for module %r from a file and caching..." % \
+                          module_subpath)
+            pickled_code_tree = read_file_contents(self._code_tree_path(module_subpath), binary=True)
+        except IOError:
+            raise CodeTreeNotFound(module_subpath)
+        code_tree = cPickle.loads(pickled_code_tree)
+        self._cache_tree(CachedCodeTree(code_tree, len(pickled_code_tree),
+                                        md5(pickled_code_tree).digest()),
+                         module_subpath)
+        return code_tree
+
+    def forget_code_tree(self, module_subpath):
+        try:
+            os.remove(self._code_tree_path(module_subpath))
+        except OSError:
+            pass
+        self._remove_from_cache(module_subpath)
+
+    def set_cache_limits(self, max_entries, max_bytes):
+        """Change limits of the cache, evicting trees that don't fit in it
+        anymore.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._evict_overflow()
+
+    def clear_cache(self):
+        if self._cache:
+            log.debug("Code trees cache: %d hits, %d misses, %d evictions, "\
+                          "%d bytes of clean code trees not written." % \
+                          (self.hits, self.misses, self.evictions,
+                           self.bytes_not_written))
+        while self._lru:
+            self._evict(self._lru[0])
+
+    def flush(self):
+        for module_subpath in self._lru:
+            self._write_back(self._cache[module_subpath], module_subpath)
+
+    def _cache_tree(self, entry, module_subpath):
+        self._cache[module_subpath] = entry
+        self._lru.append(module_subpath)
+        self._cached_bytes += entry.size
+        self._evict_overflow()
+
+    def _evict_overflow(self):
+        # The most recently used tree always stays in the cache, even if
+        # by itself it exceeds the bytes limit.
+        while len(self._lru) > 1 and self._is_overflown():
+            self.evictions += 1
+            self._evict(self._lru[0])
+
+    def _is_overflown(self):
+        if self.max_entries is not None and len(self._lru) > self.max_entries:
+            return True
+        if self.max_bytes is not None and self._cached_bytes > self.max_bytes:
+            return True
+        return False
+
+    def _evict(self, module_subpath):
+        entry = self._cache[module_subpath]
+        log.debug("Code tree for module %r gets out of cache." % module_subpath)
+        self._write_back(entry, module_subpath)
+        self._remove_from_cache(module_subpath)
+
+    def _write_back(self, entry, module_subpath):
+        if not entry.code_tree.dirty:
+            self.bytes_not_written += entry.size
+            return
+        pickled_code_tree = pickle_code_tree(entry.code_tree)
+        digest = md5(pickled_code_tree).digest()
+        if digest != entry.digest:
+            log.debug("Code tree for module %r changed, saving to a file..." % \
+                          module_subpath)
+            write_content_to_file(pickled_code_tree,
+                                  self._code_tree_path(module_subpath),
+                                  binary=True)
+            # Entry may stay in the cache (see flush).
+            self._cached_bytes += len(pickled_code_tree) - entry.size
+            entry.size = len(pickled_code_tree)
+            entry.digest = digest
+        else:
+            self.bytes_not_written += entry.size
+        entry.code_tree.mark_clean()
+
+    def _save(self, code_tree, module_subpath):
+        """Save the code tree to a file and return the size and checksum of
+        its pickle.
+        """
+        pickled_code_tree = pickle_code_tree(code_tree)
+        write_content_to_file(pickled_code_tree,
+                              self._code_tree_path(module_subpath),
+                              binary=True)
+        code_tree.mark_clean()
+        return len(pickled_code_tree), md5(pickled_code_tree).digest()
+
+    def _touch(self, module_subpath):
+        self._lru.remove(module_subpath)
+        self._lru.append(module_subpath)
+
+    def _is_cached(self, module_subpath):
+        return module_subpath in self._cache
+
+    def _remove_from_cache(self, module_subpath):
+        if self._is_cached(module_subpath):
+            entry = self._cache.pop(module_subpath)
+            self._lru.remove(module_subpath)
+            self._cached_bytes -= entry.size
+
+    def _code_tree_path(self, module_subpath):
+        code_tree_filename = string2filename(module_subpath) + '.pickle'
+        return os.path.join(self.code_trees_path, code_tree_filename)
+
+def pickle_code_tree(code_tree):
+    return cPickle.dumps(code_tree, cPickle.HIGHEST_PROTOCOL)
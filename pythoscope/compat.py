@@ -68,6 +68,24 @@ except ImportError:
                 self.currvalue = self.it.next() # Exit on StopIteration
                 self.currkey = self.keyfunc(self.currvalue)
 
+try:
+    from multiprocessing import Pool
+except ImportError:
+    # Parallel inspection is not available on Python 2.5 and lower.
+    Pool = None
+
+try:
+    import ast
+except ImportError:
+    # Inspection with the builtin parser is not available on Python 2.5
+    # and lower.
+    ast = None
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
 try:
     from os.path import samefile
 except ImportError:
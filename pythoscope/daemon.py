@@ -0,0 +1,294 @@
+"""Daemon which keeps a Project in memory and serves requests of the
+pythoscope-client command over a UNIX socket located in the project's
+.pythoscope/ directory.
+
+Protocol is simple enough for the client not to depend on Pythoscope. The
+client sends a request, which is a list of fields separated with NUL
+characters, and shuts down its side of the connection. The first field is
+a command name, the second one is a logging level name (DEBUG, INFO or
+ERROR). Other fields are command-specific:
+
+  generate FORCE TEMPLATE MODULE...
+    Generate tests for given modules, like "pythoscope MODULE..." does.
+    FORCE is either 0 or 1.
+
+  inspect
+    Inspect changed modules and rerun points of entry if needed.
+
+  stop
+    Save the project and stop the daemon.
+
+In response the daemon sends an exit status in the first line, followed by
+the log output of the request.
+"""
+
+import getopt
+import os
+import select
+import signal
+import socket
+import sys
+import traceback
+
+from cStringIO import StringIO
+
+import logger
+
+from cmdline import fail, find_project_directory, report_generation_errors, \
+    PythoscopeDirectoryMissing
+from generator import add_tests_to_project
+from inspector import inspect_project_dynamically, update_project_statically
+from logger import log
+from store import Project, get_daemon_socket_path, get_pickle_path, \
+    get_shards_index_path
+
+
+# How often (in seconds) the daemon looks for changed files when idle.
+DEFAULT_POLL_INTERVAL = 2.0
+
+LOG_LEVELS = {'DEBUG': logger.DEBUG, 'INFO': logger.INFO, 'ERROR': logger.ERROR}
+
+USAGE = """Pythoscope daemon usage:
+
+    %s [options] [project directory]
+
+Keeps information about the project in memory, so that tests can be
+generated quickly with the pythoscope-client command. Accepts the same
+arguments as pythoscope (try "pythoscope-client --help"). The daemon
+runs in the foreground until it is interrupted or stopped with
+"pythoscope-client --stop".
+
+If you don't provide the project directory, the project the current
+directory belongs to will be used.
+
+Options:
+  -h, --help     Show this help message and exit.
+  -j N, --jobs=N Parse modules during static inspection using N worker
+                 processes. Default is 1.
+  -p SECONDS, --poll-interval=SECONDS
+                 How often to look for changed files when idle. Default
+                 is %s seconds.
+  -q, --quiet    Don't print anything unless it's an error.
+  -v, --verbose  Be very verbose (i.e. print a lot of debug output).
+"""
+
+def read_request(connection):
+    chunks = []
+    while True:
+        chunk = connection.recv(4096)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return "".join(chunks).split("\0")
+
+def stat_of(path):
+    """Return a (modification time, size) pair for given file or None if it
+    doesn't exist.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+class Daemon(object):
+    """Keeps a warm Project and serves requests for it.
+
+    While idle, the daemon polls the project directory and inspects new and
+    changed modules statically, so requests don't have to wait for it.
+    Points of entry are run only when a request arrives, as they may have
+    side effects.
+
+    The project is saved only after a request has been handled. If someone
+    else saves the project in the meantime (e.g. by running pythoscope
+    directly), the daemon reloads it.
+    """
+    def __init__(self, project_path, jobs=1, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.project_path = os.path.realpath(project_path)
+        self.socket_path = get_daemon_socket_path(self.project_path)
+        self.jobs = jobs
+        self.poll_interval = poll_interval
+        self.stopped = False
+        self.load_project()
+
+    def load_project(self):
+        log.debug("Loading project information for %s." % self.project_path)
+        self.project = Project.from_directory(self.project_path)
+        self.project_stat = self._get_project_stat()
+        # Number of static updates since the last dynamic inspection.
+        self.pending_updates = 0
+
+    def _get_project_stat(self):
+        return (stat_of(get_pickle_path(self.project_path)),
+                stat_of(get_shards_index_path(self.project_path)))
+
+    def refresh(self):
+        """Reload the project if it has been saved by someone else and
+        inspect new and changed modules.
+        """
+        if self._get_project_stat() != self.project_stat:
+            log.info("Project information changed on disk, reloading.")
+            self.load_project()
+        self.pending_updates += update_project_statically(self.project, self.jobs)
+
+    def inspect(self):
+        self.refresh()
+        if self.pending_updates:
+            inspect_project_dynamically(self.project)
+            self.pending_updates = 0
+        else:
+            log.info("No changes discovered in the source code, skipping dynamic inspection.")
+
+    def save(self):
+        self.project.save(keep_code_trees=True)
+        self.project_stat = self._get_project_stat()
+
+    def generate(self, force, template, modules):
+        def generate():
+            self.inspect()
+            add_tests_to_project(self.project, modules, template, force)
+            self.save()
+        report_generation_errors(generate)
+
+    def handle_request(self, request):
+        command, arguments = request[0], request[1:]
+        if command == 'generate':
+            self.generate(arguments[0] == '1', arguments[1], arguments[2:])
+        elif command == 'inspect':
+            self.inspect()
+            self.save()
+        elif command == 'stop':
+            log.info("Stopping the daemon.")
+            self.stopped = True
+        else:
+            fail("Unknown daemon command %r." % command)
+
+    def handle_connection(self, connection):
+        request = read_request(connection)
+        output = StringIO()
+        old_output, old_level = logger.get_output(), log.level
+        logger.set_output(output)
+        status = 0
+        try:
+            try:
+                log.level = LOG_LEVELS.get(request[1], logger.INFO)
+                self.handle_request([request[0]] + request[2:])
+            except SystemExit, err:
+                status = err.code or 0
+            except Exception:
+                log.error("Oops, it seems that an internal Pythoscope error "
+                          "occurred:\n%s" % traceback.format_exc())
+                status = 1
+        finally:
+            logger.set_output(old_output)
+            log.level = old_level
+        try:
+            connection.sendall("%d\n%s" % (status, output.getvalue()))
+        except socket.error, err:
+            # The client went away before getting the reply.
+            log.warning("Couldn't send the reply to the client: %s." % err)
+
+    def refresh_while_idle(self):
+        """Refresh the project, logging any errors instead of letting them
+        stop the daemon. The project may be e.g. in the middle of being
+        saved by someone else, in which case the next refresh will succeed.
+        """
+        try:
+            self.refresh()
+        except Exception:
+            log.error("Refreshing the project failed:\n%s" % traceback.format_exc())
+
+    def _bind(self):
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.path.exists(self.socket_path):
+            try:
+                server.connect(self.socket_path)
+            except socket.error:
+                # Left by a daemon that didn't exit cleanly.
+                os.remove(self.socket_path)
+            else:
+                server.close()
+                fail("Another daemon is already running for project %s." % \
+                         self.project_path)
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        server.listen(5)
+        return server
+
+    def serve(self):
+        server = self._bind()
+        log.info("Serving project %s on %s." % (self.project_path, self.socket_path))
+        try:
+            self.refresh_while_idle()
+            while not self.stopped:
+                readable, _, _ = select.select([server], [], [], self.poll_interval)
+                if not readable:
+                    self.refresh_while_idle()
+                    continue
+                connection, _ = server.accept()
+                try:
+                    self.handle_connection(connection)
+                finally:
+                    connection.close()
+        finally:
+            server.close()
+            os.remove(self.socket_path)
+            # Without a dynamic inspection the project information would be
+            # incomplete, so the next run should repeat the static one.
+            if not self.pending_updates:
+                self.save()
+
+def main():
+    appname = os.path.basename(sys.argv[0])
+
+    try:
+        options, args = getopt.getopt(sys.argv[1:], "hj:p:qv",
+                        ["help", "jobs=", "poll-interval=", "quiet", "verbose"])
+    except getopt.GetoptError, err:
+        log.error("%s\n" % err)
+        print USAGE % (appname, DEFAULT_POLL_INTERVAL)
+        sys.exit(1)
+
+    jobs = 1
+    poll_interval = DEFAULT_POLL_INTERVAL
+
+    for opt, value in options:
+        if opt in ("-h", "--help"):
+            print USAGE % (appname, DEFAULT_POLL_INTERVAL)
+            sys.exit()
+        elif opt in ("-j", "--jobs"):
+            try:
+                jobs = int(value)
+            except ValueError:
+                fail("Number of jobs should be an integer, got %r." % value)
+        elif opt in ("-p", "--poll-interval"):
+            try:
+                poll_interval = float(value)
+            except ValueError:
+                fail("Poll interval should be a number, got %r." % value)
+        elif opt in ("-q", "--quiet"):
+            log.level = logger.ERROR
+        elif opt in ("-v", "--verbose"):
+            log.level = logger.DEBUG
+
+    if not hasattr(socket, 'AF_UNIX'):
+        fail("Daemon mode requires UNIX sockets, which are not available "
+             "on this platform.")
+
+    if args:
+        project_path = args[0]
+    else:
+        project_path = "."
+
+    # Make "kill" stop the daemon cleanly.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        try:
+            Daemon(find_project_directory(project_path), jobs, poll_interval).serve()
+        except PythoscopeDirectoryMissing:
+            fail("Can't find .pythoscope/ directory for this project. "
+                 "Initialize the project with the '--init' option first.")
+        except socket.error, err:
+            fail("Couldn't start the daemon: %s." % err)
+    except KeyboardInterrupt:
+        log.info("Interrupted by the user.")
@@ -1,14 +1,18 @@
 import itertools
+import os
 import time
 import types
+import weakref
 
+from pythoscope.capture_policy import capture_policy_from_spec
 from pythoscope.serializer import BuiltinException, ImmutableObject, MapObject,\
     UnknownObject, SequenceObject, LibraryObject, is_immutable, is_sequence,\
     is_mapping, is_builtin_exception, is_library_object
 from pythoscope.store import Call, Class, Function, FunctionCall,\
-    GeneratorObject, GeneratorObjectInvocation, MethodCall, Project, UserObject
+    GeneratorObject, GeneratorObjectInvocation, MethodCall, Project,\
+    UnknownCall, UserObject
 from pythoscope.util import all_of_type, assert_argument_type, class_name,\
-    generator_has_ended, get_generator_from_frame, is_generator_code,\
+    class_of, generator_has_ended, get_generator_from_frame, is_generator_code,\
     map_values, module_name
 
 
@@ -34,10 +38,34 @@ class Execution(object):
     In create_method_call/create_function_call if we can't find a class or
     function in Project, we don't care about it. This way we don't record any
     information about thid-party and dynamically created code.
+
+    Calls that are captured are decided by a capture policy, by default
+    the one set for the project (see pythoscope.capture_policy). Calls not
+    admitted by the policy aren't serialized at all and are marked as
+    dropped. Same goes for captured calls later evicted by the policy.
     """
-    def __init__(self, project):
+    # Executions saved before imported modules were recorded don't have
+    # this attribute set.
+    imported_modules = None
+    # Value of project's modules_generation the definition lookup tables
+    # were filled for.
+    _lookups_generation = None
+
+    def __init__(self, project, capture_policy=None):
         self.project = project
 
+        if capture_policy is None:
+            capture_policy = capture_policy_from_spec(project.capture_policy)
+        self.capture_policy = capture_policy
+        # Ids of captured UserObjects => whether the policy admitted them.
+        self._user_object_verdicts = {}
+        # Ids of objects not admitted by the policy, which haven't been
+        # captured (those are not preserved, hence the weak references).
+        self._dropped_objects = weakref.WeakValueDictionary()
+        # Same for objects which can't be weakly referenced. These are kept
+        # alive until the end of the run, so their ids can't get reused.
+        self._dropped_unreferenceable_objects = {}
+
         self.started = time.time()
         self.ended = None
 
@@ -53,10 +81,24 @@ class Execution(object):
         # References to objects we don't want to be garbage collected just yet.
         self._preserved_objects = []
 
+        # Subpaths of project modules imported during the run.
+        self.imported_modules = []
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Code objects can't be pickled and lookups are cheap to repeat.
+        # State of the capture policy is needed only during the run.
+        for name in ['_lookups_generation', '_functions_by_code', '_classes_by_class',
+                     'capture_policy', '_user_object_verdicts', '_dropped_objects',
+                     '_dropped_unreferenceable_objects']:
+            state.pop(name, None)
+        return state
+
     def finalize(self):
         """Mark execution as finished.
         """
         self._preserved_objects = []
+        self._dropped_unreferenceable_objects = {}
         self.ended = time.time()
         self._fix_generator_objects()
 
@@ -68,12 +110,24 @@ class Execution(object):
         self.captured_calls = []
         self.call_graph = None
 
+    def record_imported_files(self, paths):
+        """Remember which project modules were imported during the run, given
+        paths of the imported files.
+        """
+        self.imported_modules = []
+        for path in paths:
+            root, ext = os.path.splitext(path)
+            if ext in ['.py', '.pyc', '.pyo'] and self.project.contains_path(root + '.py'):
+                self.imported_modules.append(self.project._extract_subpath(root + '.py'))
+
     def destroy_references(self):
         for obj in itertools.chain(self.captured_calls, self.captured_objects.values()):
             # Method calls will also be erased, implicitly during removal of
             # their UserObjects.
             if isinstance(obj, UserObject):
-                obj.klass.user_objects.remove(obj)
+                # Objects evicted by the capture policy have already been
+                # removed.
+                remove_identical(obj.klass.user_objects, obj)
             # FunctionCalls have to be removed from their definition classes.
             elif isinstance(obj, FunctionCall):
                 obj.definition.calls.remove(obj)
@@ -110,7 +164,7 @@ class Execution(object):
 
     # :: object -> UserObject | None
     def create_serialized_user_object(self, obj):
-        klass = self.project.find_object(Class, class_name(obj), module_name(obj))
+        klass = self.find_class_of(obj)
         if klass:
             serialized = UserObject(obj, klass)
             klass.add_user_object(serialized)
@@ -141,6 +195,15 @@ class Execution(object):
 
     # :: (type, Definition, Callable, args, code, frame) -> Call
     def create_call(self, call_type, definition, callable, args, code, frame):
+        """Capture a call. Function calls are passed through the capture
+        policy first (method calls are decided for the whole object in
+        create_method_call), so the returned call may be a dropped one.
+        """
+        # Generator invocations have to be recorded in their generator
+        # objects, so they're not sampled.
+        sample = isinstance(callable, Function) and not is_generator_code(code)
+        if sample and not self.capture_policy.admit(definition, args):
+            return dropped_call(call_type(definition, {}))
         sargs = self.serialize_call_arguments(args)
         if is_generator_code(code):
             generator = get_generator_from_frame(frame)
@@ -165,14 +228,48 @@ class Execution(object):
         call = call_type(definition, sargs)
         self.captured_calls.append(call)
         callable.add_call(call)
+        if sample:
+            evicted = self.capture_policy.captured(definition, call)
+            if evicted is not None:
+                self.drop_call(evicted)
         return call
 
     # :: (str, object, dict, code, frame) -> MethodCall | None
     def create_method_call(self, name, obj, args, code, frame):
-        user_object = self.try_serializing_as_user_object(obj)
+        user_object = self.captured_objects.get(object_id(obj))
+        if user_object is None:
+            if object_id(obj) in self._dropped_objects or \
+                    object_id(obj) in self._dropped_unreferenceable_objects:
+                return self._dropped_method_call(obj, name)
+            # Decide about an object we see for the first time before
+            # serializing it.
+            klass = self.find_class_of(obj)
+            if klass is None:
+                return None
+            if not self.capture_policy.admit(klass, args):
+                try:
+                    self._dropped_objects[object_id(obj)] = obj
+                except TypeError:
+                    # Not every object can be weakly referenced.
+                    self._dropped_unreferenceable_objects[object_id(obj)] = obj
+                return self._dropped_method_call(obj, name)
+            user_object = self.try_serializing_as_user_object(obj)
+            self._user_object_admitted(user_object)
+        elif isinstance(user_object, UserObject):
+            verdict = self._user_object_verdicts.get(id(user_object))
+            if verdict is None:
+                # Object was captured earlier as a value, this is its first
+                # call.
+                verdict = self.capture_policy.admit(user_object.klass, args)
+                if verdict:
+                    self._user_object_admitted(user_object)
+                else:
+                    self._user_object_verdicts[id(user_object)] = False
+            if not verdict:
+                return self._dropped_method_call(obj, name)
 
         # We ignore the call if we can't find the class of this object.
-        if user_object:
+        if isinstance(user_object, UserObject):
             method = user_object.klass.find_method_by_name(name)
             if method:
                 return self.create_call(MethodCall, method, user_object, args, code, frame)
@@ -181,14 +278,102 @@ class Execution(object):
                 # so at least issue a warning.
                 pass
 
+    def _user_object_admitted(self, user_object):
+        self._user_object_verdicts[id(user_object)] = True
+        evicted = self.capture_policy.captured(user_object.klass, user_object)
+        if evicted is not None:
+            self.drop_user_object(evicted)
+
+    # :: (object, str) -> Call
+    def _dropped_method_call(self, obj, name):
+        method = self.find_class_of(obj).find_method_by_name(name)
+        if method:
+            return dropped_call(MethodCall(method, {}))
+        return dropped_call(UnknownCall())
+
+    # :: Call -> None
+    def drop_call(self, call):
+        """Forget a captured call. Its subcalls are moved to its caller, to
+        keep the call graph connected.
+        """
+        if isinstance(call.definition, Function):
+            remove_identical(call.definition.calls, call)
+        remove_identical(self.captured_calls, call)
+        if call.caller is not None:
+            siblings = call.caller.subcalls
+        else:
+            siblings = self.call_graph or []
+        index = find_identical(siblings, call)
+        if index is not None:
+            for subcall in call.subcalls:
+                subcall.caller = call.caller
+            siblings[index:index+1] = call.subcalls
+        call.caller = None
+        call.subcalls = []
+        # If the call hasn't returned yet, let the call stack know it
+        # shouldn't record anything more inside of it.
+        dropped_call(call)
+
+    # :: UserObject -> None
+    def drop_user_object(self, user_object):
+        """Forget all calls of a captured user object. The object itself
+        stays captured, as it may have been passed to other calls.
+        """
+        remove_identical(user_object.klass.user_objects, user_object)
+        for call in user_object.calls:
+            if isinstance(call, Call):
+                self.drop_call(call)
+        user_object.calls = []
+        self._user_object_verdicts[id(user_object)] = False
+
     # :: (str, dict, code, frame) -> FunctionCall | None
     def create_function_call(self, name, args, code, frame):
+        function = self.find_function(name, code)
+        if function:
+            return self.create_call(FunctionCall, function, function,
+                                    args, code, frame)
+
+    # :: (str, code) -> Function | None
+    def find_function(self, name, code):
+        """Return a Function with given name defined by given code object or
+        None if it's not a part of the project.
+
+        Results are memoized by code object (pinned in the table, so its id
+        isn't reused) until modules of the project change.
+        """
+        self._check_lookups_generation()
+        entry = self._functions_by_code.get(id(code))
+        if entry is not None and entry[1] == name:
+            return entry[2]
+        function = None
         if self.project.contains_path(code.co_filename):
             modulename = self.project._extract_subpath(code.co_filename)
             function = self.project.find_object(Function, name, modulename)
-            if function:
-                return self.create_call(FunctionCall, function, function,
-                                        args, code, frame)
+        self._functions_by_code[id(code)] = (code, name, function)
+        return function
+
+    # :: object -> Class | None
+    def find_class_of(self, obj):
+        """Return a Class of given object or None if the class is not a part
+        of the project. Results are memoized by Python class.
+        """
+        self._check_lookups_generation()
+        cls = class_of(obj)
+        entry = self._classes_by_class.get(id(cls))
+        if entry is not None:
+            return entry[1]
+        klass = self.project.find_object(Class, class_name(obj), module_name(obj))
+        self._classes_by_class[id(cls)] = (cls, klass)
+        return klass
+
+    def _check_lookups_generation(self):
+        """Empty definition lookup tables if modules of the project have been
+        added, replaced or removed since they were filled.
+        """
+        if self._lookups_generation != self.project.modules_generation:
+            self._functions_by_code = {}
+            self._classes_by_class = {}
+            self._lookups_generation = self.project.modules_generation
 
     # :: (str, *object) -> SideEffect
     def create_side_effect(self, klass, *args):
@@ -257,6 +442,33 @@ class Execution(object):
 def object_id(obj):
     return id(obj)
 
+# :: Call -> Call
+def dropped_call(call):
+    """Mark a call as dropped by the capture policy. Dropped calls are only
+    placeholders on the call stack, not a part of the call graph.
+    """
+    call.dropped = True
+    return call
+
+def find_identical(objects, obj):
+    """Return index of the given object in the list, looking for the very
+    same object (not just an equal one), starting from the end.
+
+        >>> find_identical([[], [], []], [])
+        >>> l = []
+        >>> find_identical([l, [], []], l)
+        0
+    """
+    for index in range(len(objects)-1, -1, -1):
+        if objects[index] is obj:
+            return index
+    return None
+
+def remove_identical(objects, obj):
+    index = find_identical(objects, obj)
+    if index is not None:
+        del objects[index]
+
 def save_generator_inside(gobject, generator):
     # Generator objects return None to the tracer when stopped. That
     # extra None we have to filter out manually (see
@@ -7,7 +7,8 @@ import os.path
 
 from pythoscope.logger import log
 from pythoscope.util import max_by_not_zero, module_path_to_name
-from pythoscope.store import Module, TestClass, code_of
+from pythoscope.store import CodeTree, Module, ModuleNotFound, TestClass,\
+    code_of
 from pythoscope.code_trees_manager import CodeTreeNotFound
 from pythoscope.astvisitor import find_last_leaf, get_starting_whitespace, \
     is_node_of_type, remove_trailing_whitespace
@@ -65,6 +66,13 @@ def add_test_case(test_suite, test_case):
     else:
         raise TypeError("Tried to add a test case to %r." % test_suite)
     add_test_case_without_append(test_suite, test_case)
+    mark_as_changed(test_suite)
+
+def mark_as_changed(test_suite):
+    """Mark the test suite as changed after its AST has been modified, so
+    that both the test file and the code tree get saved.
+    """
+    CodeTree.of(test_suite).mark_dirty()
     test_suite.mark_as_changed()
 
 def ensure_main_snippet(module, main_snippet, force=False):
@@ -78,11 +86,11 @@ def ensure_main_snippet(module, main_snippet, force=False):
     if not current_main_snippet:
         code_of(module).append_child(main_snippet)
         module.store_reference('main_snippet', main_snippet)
-        module.mark_as_changed()
+        mark_as_changed(module)
     elif force:
         current_main_snippet.replace(main_snippet)
         module.store_reference('main_snippet', main_snippet)
-        module.mark_as_changed()
+        mark_as_changed(module)
 
 def ensure_imports(test_suite, imports):
     if isinstance(test_suite, TestClass):
@@ -94,7 +102,7 @@ def ensure_imports(test_suite, imports):
     for imp in imports:
         if not module.contains_import(imp):
             insert_after_other_imports(module, create_import(imp))
-            module.mark_as_changed()
+            mark_as_changed(module)
     test_suite.ensure_imports(imports)
 
 def insert_after_other_imports(module, code):
@@ -110,9 +118,7 @@ def insert_after_other_imports(module, code):
     module.store_reference('last_import', code)
 
 def find_test_class_by_name(project, name):
-    for tcase in project.iter_test_cases():
-        if tcase.name == name:
-            return tcase
+    return project.find_test_class_by_name(name)
 
 def merge_test_classes(test_class, other_test_class, force):
     """Merge other_test_case into test_case.
@@ -147,7 +153,7 @@ def replace_test_case(test_suite, old_test_case, new_test_case):
 
     test_suite.remove_test_case(old_test_case)
     add_test_case_without_append(test_suite, new_test_case)
-    test_suite.mark_as_changed()
+    mark_as_changed(test_suite)
 
 def find_module_for_test_class(project, test_class):
     """Find the best place for the new test case to be added. If there is
@@ -169,10 +175,11 @@ def find_associate_test_module_by_name(project, module):
     """Try to find a test module with name corresponding to the name of
     the application module.
     """
-    possible_paths = possible_test_module_paths(module, project.new_tests_directory)
-    for module in project.get_modules():
-        if module.subpath in possible_paths:
-            return module
+    for path in possible_test_module_paths(module, project.new_tests_directory):
+        try:
+            return project[path]
+        except ModuleNotFound:
+            pass
 
 def find_associate_test_module_by_test_class(project, module):
     """Try to find a test module with most test cases for the given
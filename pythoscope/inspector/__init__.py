@@ -1,17 +1,17 @@
+import os
+
 from pythoscope.inspector import static, dynamic
-from pythoscope.inspector.file_system import python_modules_below
+from pythoscope.inspector.file_system import changed_files, \
+    is_excluded_path, is_python_module, python_modules_below, read_excludes, \
+    snapshot_files, WalkStatistics
 from pythoscope.logger import log
-from pythoscope.store import ModuleNotFound
 from pythoscope.point_of_entry import PointOfEntry
 from pythoscope.util import generator_has_ended, last_traceback, \
     last_exception_as_string
 
 
-def inspect_project(project):
-    remove_deleted_modules(project)
-    remove_deleted_points_of_entry(project)
-
-    updates = inspect_project_statically(project)
+def inspect_project(project, jobs=1):
+    updates = update_project_statically(project, jobs)
 
     # If nothing new was discovered statically and there are no new points of
     # entry, don't run dynamic inspection.
@@ -20,25 +20,136 @@ def inspect_project(project):
     else:
         log.info("No changes discovered in the source code, skipping dynamic inspection.")
 
+def update_project_statically(project, jobs=1):
+    """Forget about deleted modules and points of entry and inspect new and
+    changed ones. Returns the number of updates.
+    """
+    remove_deleted_modules(project)
+    remove_deleted_points_of_entry(project)
+    return inspect_project_statically(project, jobs)
+
+def inspect_project_incrementally(project, changed_paths, jobs=1):
+    """Inspect the project after files with given paths have changed.
+
+    Unlike inspect_project, inspects again only modules with given paths
+    and runs only the points of entry that could've been affected by the
+    change. Returns a list of those points of entry.
+
+    A change of the excludes file may add or remove any of the modules, so
+    in that case the whole project gets updated.
+    """
+    if project.get_excludes_path() in changed_paths:
+        update_project_statically(project, jobs)
+    else:
+        update_modules_with_paths(project, changed_paths, jobs)
+        remove_deleted_points_of_entry(project)
+        add_and_update_points_of_entry(project)
+    points_of_entry = affected_points_of_entry(project, changed_paths)
+    inspect_points_of_entry(project, points_of_entry)
+    return points_of_entry
+
+def affected_points_of_entry(project, changed_paths):
+    """Return points of entry that are new or changed and those which imported
+    any of the modules with given paths during their last run.
+    """
+    changed_subpaths = set([project._extract_subpath(path) for path in changed_paths
+                            if project.contains_path(path)])
+    affected = []
+    for poe in project.points_of_entry.values():
+        imported_modules = poe.execution.imported_modules
+        if poe.is_out_of_sync() or imported_modules is None or \
+                changed_subpaths.intersection(imported_modules):
+            affected.append(poe)
+    return affected
+
+class ProjectWatcher(object):
+    """Looks for changes in project modules and points of entry, comparing
+    modification times and sizes of their files with the previous snapshot.
+    """
+    def __init__(self, project):
+        self.project = project
+        self.snapshot = self._take_snapshot()
+
+    def _take_snapshot(self):
+        excludes_path = self.project.get_excludes_path()
+        paths = python_modules_below(self.project.path, read_excludes(excludes_path)) + \
+            python_modules_below(self.project.get_points_of_entry_path()) + \
+            [excludes_path]
+        return snapshot_files(paths)
+
+    def changes(self):
+        """Return a list of paths that changed since the last call (or since
+        the watcher was created).
+        """
+        snapshot = self._take_snapshot()
+        changed = changed_files(self.snapshot, snapshot)
+        self.snapshot = snapshot
+        return changed
+
 def remove_deleted_modules(project):
-    subpaths = [mod.subpath for mod in project.iter_modules() if not mod.exists()]
+    """Forget modules that don't exist anymore or have been excluded from
+    inspection since.
+    """
+    excludes = read_excludes(project.get_excludes_path())
+    def is_gone(subpath):
+        return not os.path.isfile(os.path.join(project.path, subpath)) or \
+            is_excluded_path(subpath, excludes)
+    subpaths = [s for s in project.get_module_subpaths() if is_gone(s)]
     for subpath in subpaths:
         project.remove_module(subpath)
 
-def add_and_update_modules(project):
-    count = 0
-    for modpath in python_modules_below(project.path):
-        try:
-            module = project.find_module_by_full_path(modpath)
-            if module.is_up_to_date():
-                log.debug("%s hasn't changed since last inspection, skipping." % module.subpath)
-                continue
-        except ModuleNotFound:
-            pass
-        log.info("Inspecting module %s." % project._extract_subpath(modpath))
-        static.inspect_module(project, modpath)
-        count += 1
-    return count
+def add_and_update_modules(project, jobs=1):
+    modpaths = []
+    statistics = WalkStatistics()
+    excludes = read_excludes(project.get_excludes_path())
+    modules = python_modules_below(project.path, excludes, statistics)
+    log.debug("Looked for modules below %s: %s." % (project.path, statistics))
+    if statistics.excluded_directories:
+        log.info("Skipped excluded directories: %s." % \
+                     ", ".join(statistics.excluded_directories))
+    for modpath in modules:
+        subpath = project._extract_subpath(modpath)
+        if project.is_module_up_to_date(subpath):
+            log.debug("%s hasn't changed since last inspection, skipping." % subpath)
+            continue
+        modpaths.append(modpath)
+    return inspect_modules(project, modpaths, jobs)
+
+def update_modules_with_paths(project, paths, jobs=1):
+    """Forget deleted modules and inspect new and changed ones, looking only
+    at given paths. Paths outside of the project and excluded from inspection
+    are ignored. Returns the number of inspected modules.
+    """
+    modpaths = []
+    excludes = read_excludes(project.get_excludes_path())
+    known_subpaths = set(project.get_module_subpaths())
+    for path in paths:
+        if not (project.contains_path(path) and is_python_module(path)):
+            continue
+        subpath = project._extract_subpath(path)
+        if is_excluded_path(subpath, excludes):
+            continue
+        if not os.path.isfile(path):
+            if subpath in known_subpaths:
+                project.remove_module(subpath)
+        elif not project.is_module_up_to_date(subpath):
+            modpaths.append(path)
+    return inspect_modules(project, modpaths, jobs)
+
+def inspect_modules(project, modpaths, jobs=1):
+    # Parsing can be done in worker processes, but modules are created
+    # in the order they were found.
+    pool = static.create_pool(min(jobs, len(modpaths)))
+    try:
+        for modpath, code, analysis in static.analyze_modules(modpaths, pool,
+                                                              project.lazy_code_trees):
+            log.info("Inspecting module %s." % project._extract_subpath(modpath))
+            static.create_module_from_analysis(project, modpath, code, analysis)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return len(modpaths)
 
 def remove_deleted_points_of_entry(project):
     names = [poe.name for poe in project.points_of_entry.values() if not poe.exists()]
@@ -60,17 +171,20 @@ def add_and_update_points_of_entry(project):
             count += 1
     return count
 
-def inspect_project_statically(project):
-    return add_and_update_modules(project) + \
+def inspect_project_statically(project, jobs=1):
+    return add_and_update_modules(project, jobs) + \
         add_and_update_points_of_entry(project)
 
 def inspect_project_dynamically(project):
-    if project.points_of_entry and hasattr(generator_has_ended, 'unreliable'):
+    inspect_points_of_entry(project, project.points_of_entry.values())
+
+def inspect_points_of_entry(project, points_of_entry):
+    if points_of_entry and hasattr(generator_has_ended, 'unreliable'):
         log.warning("Pure Python implementation of util.generator_has_ended is "
                     "not reliable on Python 2.4 and lower. Please compile the "
                     "_util module or use Python 2.5 or higher.")
 
-    for poe in project.points_of_entry.values():
+    for poe in points_of_entry:
         try:
             log.info("Inspecting point of entry %s." % poe.name)
             dynamic.inspect_point_of_entry(poe)
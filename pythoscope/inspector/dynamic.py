@@ -1,10 +1,12 @@
 import os
 import sys
 
+from pythoscope.execution import dropped_call
 from pythoscope.side_effect import recognize_side_effect, MissingSideEffectType,\
     GlobalRebind, GlobalRead, AttributeRebind
 from pythoscope.store import CallToC, UnknownCall
-from pythoscope.tracer import ICallback, Tracer
+from pythoscope.inspector.file_system import read_tracing_globs
+from pythoscope.tracer import ICallback, Tracer, TracingScope
 from pythoscope.util import get_names
 
 
@@ -16,12 +18,25 @@ class CallStack(object):
         self.top_level_side_effects = [] # TODO use this list for creating global setup & teardown methods
 
     def called(self, call):
-        if self.stack:
-            self.stack[-1].add_subcall(call)
-        else:
-            self.top_level_calls.append(call)
+        # Dropped calls (see Execution) are only kept on the stack. Calls made
+        # inside of them are recorded as subcalls of the closest caller that
+        # hasn't been dropped.
+        if not call.dropped:
+            caller = self._recording_caller()
+            if caller is not None:
+                caller.add_subcall(call)
+            else:
+                self.top_level_calls.append(call)
         self.stack.append(call)
 
+    def _recording_caller(self):
+        for index in range(len(self.stack)-1, -1, -1):
+            if not self.stack[index].dropped:
+                return self.stack[index]
+
+    def in_dropped_call(self):
+        return self.stack and self.stack[-1].dropped
+
     def returned(self, output):
         if self.stack:
             caller = self.stack.pop()
@@ -60,6 +75,8 @@ class CallStack(object):
             return self.stack[-1]
 
     def side_effect(self, side_effect):
+        if self.in_dropped_call():
+            return
         if self.stack:
             self.stack[-1].add_side_effect(side_effect)
         else:
@@ -77,6 +94,9 @@ class Inspector(ICallback):
     def __init__(self, execution):
         self.execution = execution
         self.call_stack = CallStack()
+        # Capture policy may drop captured calls during the run, so the call
+        # graph has to be available right away.
+        self.execution.call_graph = self.call_stack.top_level_calls
 
     def finalize(self):
         # TODO: There are ways for the application to terminate (easiest
@@ -100,6 +120,9 @@ class Inspector(ICallback):
         return self.called(call)
 
     def c_method_called(self, obj, klass, name, pargs):
+        if self.call_stack.in_dropped_call():
+            self.call_stack.called(dropped_call(CallToC(name)))
+            return
         try:
             se_type = recognize_side_effect(klass, name)
             se = self.execution.create_side_effect(se_type, obj, *pargs)
@@ -109,31 +132,52 @@ class Inspector(ICallback):
         self.call_stack.called(call)
 
     def c_function_called(self, name, pargs):
-        self.call_stack.called(CallToC(name))
+        self.call_stack.called(self._call_in_context(CallToC(name)))
+
+    def unknown_called(self):
+        self.call_stack.called(self._call_in_context(UnknownCall()))
+
+    def unknown_returned(self):
+        self.call_stack.returned(None)
 
     def returned(self, output):
         self.call_stack.assert_last_call_was_python_call()
-        self.call_stack.returned(self.execution.serialize(output))
+        self.call_stack.returned(self._serialize_in_context(output))
 
     def c_returned(self, output):
         self.call_stack.assert_last_call_was_c_call()
-        self.call_stack.returned(self.execution.serialize(output))
+        self.call_stack.returned(self._serialize_in_context(output))
 
     def raised(self, exception, traceback):
-        self.call_stack.raised(self.execution.serialize(exception), traceback)
+        self.call_stack.raised(self._serialize_in_context(exception), traceback)
 
     def called(self, call):
         if call:
             self.call_stack.called(call)
         else:
-            self.call_stack.called(UnknownCall())
+            self.call_stack.called(self._call_in_context(UnknownCall()))
         return True
 
+    def _call_in_context(self, call):
+        # Nothing inside of a dropped call is recorded.
+        if self.call_stack.in_dropped_call():
+            return dropped_call(call)
+        return call
+
+    def _serialize_in_context(self, obj):
+        if self.call_stack.in_dropped_call():
+            return None
+        return self.execution.serialize(obj)
+
     def attribute_rebound(self, obj, name, value):
+        if self.call_stack.in_dropped_call():
+            return
         se = AttributeRebind(self.execution.serialize(obj), name, self.execution.serialize(value))
         self.call_stack.side_effect(se)
 
     def global_read(self, module_name, name, value):
+        if self.call_stack.in_dropped_call():
+            return
         try:
             if has_defined_name(self.execution.project[module_name], name):
                 return
@@ -143,6 +187,8 @@ class Inspector(ICallback):
         self.call_stack.side_effect(se)
 
     def global_rebound(self, module, name, value):
+        if self.call_stack.in_dropped_call():
+            return
         se = GlobalRebind(module, name, self.execution.serialize(value))
         self.call_stack.side_effect(se)
 
@@ -158,21 +204,35 @@ def inspect_point_of_entry(point_of_entry):
     os.chdir(projects_root)
 
     try:
-        inspect_code_in_context(point_of_entry.get_content(),
-                                point_of_entry.execution)
+        code = point_of_entry.get_content()
+        point_of_entry.update_digest(code)
+        inspect_code_in_context(code, point_of_entry.execution,
+                                project_tracing_scope(point_of_entry.project))
     finally:
         sys.path.remove(projects_root)
         os.chdir(old_cwd)
 
-# :: (str, Execution) -> None
-def inspect_code_in_context(code, execution):
+# :: Project -> TracingScope
+def project_tracing_scope(project):
+    """Scope covering project modules, adjusted with globs from
+    the .pythoscope/tracing file.
+    """
+    includes, excludes = read_tracing_globs(project.get_tracing_path())
+    paths = [os.path.join(project.path, subpath)
+             for subpath in project.get_module_subpaths()]
+    return TracingScope(paths, includes, excludes)
+
+# :: (str, Execution, TracingScope | None) -> None
+def inspect_code_in_context(code, execution, scope=None):
     """Inspect given piece of code in the context of given Execution instance.
+    Without a scope all code is traced.
 
     May raise exceptions.
     """
     inspector = Inspector(execution)
-    tracer = Tracer(inspector)
+    tracer = Tracer(inspector, scope)
     try:
         tracer.trace(code)
     finally:
         inspector.finalize()
+        execution.record_imported_files(tracer.imported_files)
@@ -1,26 +1,204 @@
+import fnmatch
 import os
 
-from pythoscope.compat import set
+from pythoscope.util import read_file_contents, write_content_to_file
 
 
-def python_modules_below(path):
-    VCS_PATHS = set([".bzr", "CVS", "_darcs", ".git", ".hg", ".svn"])
-    def is_python_module(path):
-        return path.endswith(".py")
-    def not_vcs_file(path):
-        return not set(path.split(os.path.sep)).intersection(VCS_PATHS)
-    return filter(not_vcs_file, filter(is_python_module, rlistdir(path)))
+# Globs of directories and files that are never inspected, unless the
+# project says otherwise in its .pythoscope/excludes file. Globs without
+# a path separator are matched against entry names, others against paths
+# relative to the directory being walked. Generic names, like "build",
+# are left out, as they may as well be names of real packages.
+DEFAULT_EXCLUDES = [
+    # Version control systems not covered by the dot-prefix rule.
+    "CVS", "_darcs",
+    # Virtual environments and installed packages.
+    "venv", "virtualenv", "site-packages", "node_modules",
+    # Packaging by-products.
+    "*.egg-info", "__pycache__",
+]
 
-def rlistdir(path):
-    """Resursive directory listing. Yield all files below given path,
-    ignoring those which names begin with a dot.
+EXCLUDES_HEADER = """\
+# Globs of directories and files Pythoscope won't inspect, one per line.
+# Globs without a path separator match names of files and directories,
+# others match paths relative to the project directory.
+"""
+
+def read_globs(path):
+    """Read globs from a file, one per line, ignoring empty lines and
+    comments.
+    """
+    globs = []
+    for line in read_file_contents(path).splitlines():
+        line = line.strip()
+        if line and not line.startswith("#"):
+            globs.append(line)
+    return globs
+
+def read_excludes(path):
+    """Read exclusion globs from a file, returning DEFAULT_EXCLUDES if the
+    file doesn't exist.
+    """
+    if not os.path.isfile(path):
+        return DEFAULT_EXCLUDES
+    return read_globs(path)
+
+def read_tracing_globs(path):
+    """Read globs of module names that decide what gets traced during dynamic
+    inspection, returning an (includes, excludes) pair of lists.
+
+    Globs prefixed with "-" exclude project modules from tracing, all others
+    (optionally prefixed with "+") include modules from outside of the
+    project. A missing file means there are no globs.
+    """
+    includes, excludes = [], []
+    if not os.path.isfile(path):
+        return includes, excludes
+    for glob in read_globs(path):
+        if glob.startswith("-"):
+            excludes.append(glob[1:].strip())
+        elif glob.startswith("+"):
+            includes.append(glob[1:].strip())
+        else:
+            includes.append(glob)
+    return includes, excludes
+
+def write_excludes(path, excludes=DEFAULT_EXCLUDES):
+    write_content_to_file(EXCLUDES_HEADER + "".join([e + "\n" for e in excludes]),
+                          path)
+
+class WalkStatistics(object):
+    """Counters of a single directory walk.
+
+    Files that were pruned together with their directory are not counted
+    as skipped, because they were never listed.
+    """
+    def __init__(self):
+        self.scanned_files = 0
+        self.skipped_files = 0
+        self.skipped_directories = 0
+        # Relative paths of directories pruned because of exclusion globs
+        # (hidden directories are not listed).
+        self.excluded_directories = []
+
+    def __str__(self):
+        return "scanned %d files, skipped %d files and %d directories" % \
+            (self.scanned_files, self.skipped_files, self.skipped_directories)
+
+def is_excluded(name, subpath, excludes):
+    """Tell whether given directory entry matches any of the exclusion globs.
+
+    >>> is_excluded("build", "build", ["build"])
+    True
+    >>> is_excluded("build", os.path.join("docs", "build"), ["build"])
+    True
+    >>> is_excluded("module.egg-info", "module.egg-info", ["*.egg-info"])
+    True
+    >>> is_excluded("examples", os.path.join("docs", "examples"), [os.path.join("docs", "examples")])
+    True
+    >>> is_excluded("examples", "examples", [os.path.join("docs", "examples")])
+    False
     """
+    for pattern in excludes:
+        if os.path.sep in pattern or (os.path.altsep and os.path.altsep in pattern):
+            if fnmatch.fnmatch(subpath, os.path.normpath(pattern)):
+                return True
+        elif fnmatch.fnmatch(name, pattern):
+            return True
+    return False
+
+def is_excluded_path(subpath, excludes):
+    """Tell whether a walk of the project directory would skip given path,
+    relative to the project directory, or one of its parent directories.
+
+    >>> is_excluded_path(os.path.join("venv", "lib", "module.py"), ["venv"])
+    True
+    >>> is_excluded_path(os.path.join(".hg", "module.py"), [])
+    True
+    >>> is_excluded_path(os.path.join("lib", "module.py"), ["venv"])
+    False
+    """
+    prefix = ""
+    for name in os.path.normpath(subpath).split(os.path.sep):
+        prefix = os.path.join(prefix, name)
+        if name.startswith('.') or is_excluded(name, prefix, excludes):
+            return True
+    return False
+
+def python_modules_below(path, excludes=DEFAULT_EXCLUDES, statistics=None):
+    """Return paths of all Python modules below given path.
+
+    Files and directories which names begin with a dot or which match one
+    of the exclusion globs are skipped. Excluded directories are pruned
+    before descending into them, so their contents are never listed.
+    Counts of scanned and skipped entries are collected in the statistics
+    object, if one was given.
+    """
+    if statistics is None:
+        statistics = WalkStatistics()
     if os.path.basename(path).startswith('.'):
-        return
-
-    if os.path.isdir(path):
-        for entry in os.listdir(path):
-            for subpath in rlistdir(os.path.join(path, entry)):
-                yield subpath
-    else:
-        yield path
+        return []
+    if not os.path.isdir(path):
+        statistics.scanned_files += 1
+        if is_python_module(path):
+            return [path]
+        return []
+
+    modules = []
+    # Stack of (absolute path, path relative to the walk root) pairs.
+    directories = [(path, "")]
+    while directories:
+        directory, subdirectory = directories.pop()
+        subdirectories = []
+        for entry in os.listdir(directory):
+            entry_path = os.path.join(directory, entry)
+            entry_subpath = os.path.join(subdirectory, entry)
+            is_directory = os.path.isdir(entry_path)
+            if entry.startswith('.') or is_excluded(entry, entry_subpath, excludes):
+                if is_directory:
+                    statistics.skipped_directories += 1
+                    if not entry.startswith('.'):
+                        statistics.excluded_directories.append(entry_subpath)
+                else:
+                    statistics.skipped_files += 1
+            elif is_directory:
+                subdirectories.append((entry_path, entry_subpath))
+            else:
+                statistics.scanned_files += 1
+                if is_python_module(entry):
+                    modules.append(entry_path)
+        # Keep the listing order when popping from the stack.
+        subdirectories.reverse()
+        directories.extend(subdirectories)
+    return modules
+
+def is_python_module(path):
+    return path.endswith(".py")
+
+def snapshot_files(paths):
+    """Return a mapping of given paths to (modification time, size) pairs.
+
+    Files that disappeared in the meantime are left out.
+    """
+    snapshot = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        snapshot[path] = (stat.st_mtime, stat.st_size)
+    return snapshot
+
+def changed_files(old_snapshot, new_snapshot):
+    """Return a sorted list of paths that were added, removed or modified
+    between two snapshots.
+
+    >>> changed_files({'a': (1, 10), 'b': (1, 10), 'c': (1, 10)},
+    ...               {'a': (2, 10), 'c': (1, 10), 'd': (1, 0)})
+    ['a', 'b', 'd']
+    """
+    changed = [path for path, stat in new_snapshot.iteritems()
+               if old_snapshot.get(path) != stat]
+    changed.extend([path for path in old_snapshot if path not in new_snapshot])
+    changed.sort()
+    return changed
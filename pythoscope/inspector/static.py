@@ -1,12 +1,16 @@
+import bisect
+import itertools
 import re
 import types
 
-from pythoscope.astvisitor import descend, ASTVisitor
+from pythoscope.astvisitor import descend, ASTVisitor, is_node_of_type
 from pythoscope.astbuilder import parse, ParseError
+from pythoscope.compat import Pool, ast
 from pythoscope.logger import log
-from pythoscope.store import Class, Function, Method, TestClass,TestMethod
+from pythoscope.store import Class, CodeTree, Function, Method, TestClass, \
+    TestMethod
 from pythoscope.util import all_of_type, is_generator_code, \
-    read_file_contents, compile_without_warnings
+    read_file_contents, compile_without_warnings, get_content_digest
 
 
 def is_test_class(name, bases):
@@ -76,15 +80,70 @@ def is_generator_definition(definition):
         # inside generator.
         return False
 
-def create_definition(name, args, code, definition_type):
-    return definition_type(name, args=args, code=code,
-                           is_generator=is_generator_definition(code))
+def find_generators(module_code):
+    """Compile the whole module and return a mapping of (name, line) of each
+    code block defined in it (functions, methods, but also classes) to
+    a boolean value saying whether it is a generator.
+
+    Returns None if the module doesn't compile.
+
+    >>> generators = find_generators("def f():\\n  return 1\\nclass C:\\n  def g(self):\\n    yield 2\\n")
+    >>> sorted(generators.items())
+    [(('C', 3), False), (('f', 1), False), (('g', 4), True)]
+    >>> find_generators("def f(:\\n") is None
+    True
+    """
+    if not module_code.endswith("\n"):
+        module_code += "\n"
+    try:
+        code = compile_without_warnings(module_code, 'exec')
+    except (SyntaxError, TypeError, ValueError):
+        return None
+    return generators_of_code(code)
+
+def generators_of_code(code):
+    """Return find_generators() mapping for code blocks nested in given
+    code object.
+    """
+    generators = {}
+    def visit(code):
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                generators[(const.co_name, const.co_firstlineno)] = is_generator_code(const)
+                visit(const)
+    visit(code)
+    return generators
+
+def definition_line(definition):
+    """Return the line the code object of given definition starts at.
+    """
+    # Code of decorated functions starts at the first decorator.
+    if definition.parent is not None and is_node_of_type(definition.parent, 'decorated'):
+        return definition.parent.get_lineno()
+    return definition.get_lineno()
+
+def create_definition(name, args, code, definition_type, generators=None):
+    """Create a Function or a Method.
+
+    Generators is a result of find_generators() for the module. If it's
+    missing or doesn't know about the definition, the definition gets
+    compiled separately.
+    """
+    is_generator = None
+    if generators is not None:
+        is_generator = generators.get((name, definition_line(code)))
+    if is_generator is None:
+        is_generator = is_generator_definition(code)
+    return definition_type(name, args=args, code=code, is_generator=is_generator)
 
 class ModuleVisitor(ASTVisitor):
-    def __init__(self):
+    def __init__(self, generators=None):
         ASTVisitor.__init__(self)
+        self.generators = generators
         self.imports = []
         self.objects = []
+        # List of (top-level definition, its first line) pairs.
+        self.definition_lines = []
         self.main_snippet = None
         self.last_import = None
         self.past_imports = False
@@ -95,13 +154,17 @@ class ModuleVisitor(ASTVisitor):
             methods = [TestMethod(n, c) for (n, a, c) in visitor.methods]
             klass = TestClass(name=name, test_cases=methods, code=body)
         else:
-            methods = [create_definition(n, a, c, Method) for (n, a, c) in visitor.methods]
+            methods = [create_definition(n, a, c, Method, self.generators)
+                       for (n, a, c) in visitor.methods]
             klass = Class(name=name, methods=methods, bases=bases)
         self.objects.append(klass)
+        self.definition_lines.append((klass, definition_line(body)))
         self.past_imports = True
 
     def visit_function(self, name, args, body):
-        self.objects.append(create_definition(name, args, body, Function))
+        function = create_definition(name, args, body, Function, self.generators)
+        self.objects.append(function)
+        self.definition_lines.append((function, definition_line(body)))
         self.past_imports = True
 
     def visit_lambda_assign(self, name, args):
@@ -133,17 +196,269 @@ class ClassVisitor(ASTVisitor):
     def visit_function(self, name, args, body):
         self.methods.append((name, args, body))
 
+class UnsupportedConstruct(Exception):
+    """Raised by the fast inspection when it can't derive the same
+    information the ModuleVisitor would.
+    """
+
+def ast_dotted_name(node):
+    if isinstance(node, ast.Name):
+        return node.id
+    elif isinstance(node, ast.Attribute):
+        return "%s.%s" % (ast_dotted_name(node.value), node.attr)
+    raise UnsupportedConstruct("base class expression on line %d" % node.lineno)
+
+def ast_argument(node):
+    if isinstance(node, ast.Name):
+        return node.id
+    return tuple([ast_argument(elt) for elt in node.elts])
+
+def ast_arguments(arguments):
+    names = [ast_argument(arg) for arg in arguments.args]
+    if arguments.vararg:
+        names.append('*' + arguments.vararg)
+    if arguments.kwarg:
+        names.append('**' + arguments.kwarg)
+    return names
+
+def ast_lambda_arguments(arguments):
+    """ModuleVisitor only knows names of lambdas with a single argument
+    without a default value.
+    """
+    names = ast_arguments(arguments)
+    if len(names) == 1 and isinstance(names[0], str) and \
+            not arguments.defaults and not (arguments.vararg or arguments.kwarg):
+        return names
+    elif names:
+        return [None]
+    return []
+
+def ast_first_line(node):
+    """Return the first line of given statement, including its decorators.
+    """
+    lines = [node.lineno]
+    for decorator in getattr(node, 'decorator_list', []):
+        lines.append(decorator.lineno)
+    return min(lines)
+
+def is_ast_main_snippet(node):
+    """Tell whether given statement is an `if __name__ == '__main__'` without
+    elif or else clauses.
+    """
+    test = node.test
+    return isinstance(test, ast.Compare) and \
+        isinstance(test.left, ast.Name) and test.left.id == '__name__' and \
+        len(test.ops) == 1 and isinstance(test.ops[0], ast.Eq) and \
+        isinstance(test.comparators[0], ast.Str) and \
+        test.comparators[0].s == '__main__' and not node.orelse
+
+def ast_nested_statements(node):
+    """Return statements nested in given compound statement, except for
+    bodies of class and function definitions, in the source order.
+    """
+    statements = list(getattr(node, 'body', []))
+    for handler in getattr(node, 'handlers', []):
+        statements.extend(handler.body)
+    for field in ['orelse', 'finalbody']:
+        statements.extend(getattr(node, field, []))
+    return statements
+
+class FastModuleVisitor(object):
+    """Visitor of the builtin AST which finds the same definitions and
+    imports as the ModuleVisitor, but doesn't need a lib2to3 tree.
+
+    References to the lib2to3 tree (including main_snippet and last_import)
+    are not collected. Module created from the result of this visitor
+    builds its CodeTree lazily (see Module#lazy_code_tree).
+
+    Raises UnsupportedConstruct for code which the ModuleVisitor
+    interprets differently than the builtin parser does.
+    """
+    def __init__(self, lines, generators):
+        self.lines = lines
+        self.generators = generators
+        self.imports = []
+        self.objects = []
+        # List of (top-level definition, its first line) pairs.
+        self.definition_lines = []
+
+    def visit(self, statements):
+        for node in statements:
+            if isinstance(node, ast.ClassDef):
+                self.visit_class(node)
+            elif isinstance(node, ast.FunctionDef):
+                function = self.create_definition(node, Function)
+                self.objects.append(function)
+                self.definition_lines.append((function, ast_first_line(node)))
+            elif isinstance(node, ast.Import):
+                self.visit_import(node)
+            elif isinstance(node, ast.ImportFrom):
+                self.visit_import_from(node)
+            elif isinstance(node, ast.Assign) and len(node.targets) == 1 and \
+                    isinstance(node.targets[0], ast.Name) and \
+                    isinstance(node.value, ast.Lambda):
+                self.objects.append(Function(node.targets[0].id,
+                    args=ast_lambda_arguments(node.value.args)))
+            elif isinstance(node, ast.If) and is_ast_main_snippet(node):
+                pass
+            else:
+                self.visit(ast_nested_statements(node))
+
+    def visit_class(self, node):
+        # ModuleVisitor doesn't recognize classes with empty parentheses.
+        header = "\n".join(self.lines[node.lineno-1:node.body[0].lineno])
+        if not node.bases and re.search(r'\bclass\s+%s\s*\(' % node.name, header):
+            raise UnsupportedConstruct("empty bases of class %s" % node.name)
+        bases = [ast_dotted_name(base) for base in node.bases]
+        methods = self.find_methods(node.body)
+        if is_test_class(node.name, bases):
+            klass = TestClass(name=node.name,
+                              test_cases=[TestMethod(m.name) for m in methods])
+        else:
+            klass = Class(name=node.name, bases=bases,
+                          methods=[self.create_definition(m, Method) for m in methods])
+        self.objects.append(klass)
+        self.definition_lines.append((klass, ast_first_line(node)))
+
+    def find_methods(self, statements):
+        methods = []
+        for node in statements:
+            if isinstance(node, ast.FunctionDef):
+                methods.append(node)
+            elif isinstance(node, ast.If) and is_ast_main_snippet(node):
+                pass
+            elif not isinstance(node, ast.ClassDef):
+                methods.extend(self.find_methods(ast_nested_statements(node)))
+        return methods
+
+    def create_definition(self, node, definition_type):
+        is_generator = self.generators.get((node.name, ast_first_line(node)))
+        if is_generator is None:
+            # Compiler drops code objects of dead code, like definitions
+            # under "if 0:".
+            raise UnsupportedConstruct("definition of %s on line %d without "
+                                       "code object" % (node.name, node.lineno))
+        return definition_type(node.name, args=ast_arguments(node.args),
+                               is_generator=is_generator)
+
+    def visit_import(self, node):
+        for alias in node.names:
+            if alias.asname:
+                self.imports.append((alias.name, alias.asname))
+            else:
+                self.imports.append(alias.name)
+
+    def visit_import_from(self, node):
+        if node.level > 0:
+            raise UnsupportedConstruct("relative import on line %d" % node.lineno)
+        # ModuleVisitor ignores imports of names in parentheses.
+        if re.match(r'from\s+[\w.\s]+?\s+import\s*\(',
+                    self.lines[node.lineno-1][node.col_offset:]):
+            return
+        for alias in node.names:
+            # ModuleVisitor doesn't understand names of the form "a as b"
+            # nor the star.
+            if alias.asname or alias.name == '*':
+                self.imports.append((node.module, None))
+            else:
+                self.imports.append((node.module, alias.name))
+
 def inspect_module(project, path):
-    return inspect_code(project, path, read_file_contents(path))
+    return create_module_from_analysis(project, *analyze_module(path))
 
 # :: (Project, string, string) -> Module
 def inspect_code(project, path, code):
+    return create_module_from_analysis(project, path, code,
+                                       analyze_code(code))
+
+# :: string -> (string, string, dict)
+def analyze_module(path):
+    """Read and analyze the module located under given path.
+
+    Doesn't need a Project, so it can be run in a worker process (see
+    analyze_modules).
+    """
+    code = read_file_contents(path)
+    return path, code, analyze_code(code)
+
+# :: string -> (string, string, dict)
+def analyze_module_quickly(path):
+    """Like analyze_module, but uses analyze_code_quickly.
+    """
+    code = read_file_contents(path)
+    return path, code, analyze_code_quickly(code)
+
+# :: int -> Pool | None
+def create_pool(jobs):
+    """Return a pool of given number of worker processes for analyze_modules
+    or None if modules should be analyzed in the current process.
+    """
+    if jobs <= 1:
+        return None
+    if Pool is None:
+        log.warning("Parallel inspection requires the multiprocessing "
+                    "module, inspecting modules one by one.")
+        return None
+    return Pool(jobs)
+
+# :: ([string], Pool | None, bool) -> iterator of (string, string, dict)
+def analyze_modules(paths, pool=None, quickly=False):
+    """Analyze modules located under given paths, using given pool of worker
+    processes if there is one. If quickly is true, modules are analyzed
+    with analyze_code_quickly.
+
+    Results are returned in the same order as paths, no matter how many
+    workers are used.
+    """
+    if quickly:
+        analyze = analyze_module_quickly
+    else:
+        analyze = analyze_module
+    if pool is None:
+        return itertools.imap(analyze, paths)
+    return pool.imap(analyze, paths)
+
+# :: (Project, string, string, dict) -> Module
+def create_module_from_analysis(project, path, code, analysis):
+    if analysis.get('errors'):
+        log.warning("Inspection of module %s failed." % path)
+    module = project.create_module(path, **analysis)
+    module.update_digest(code)
+    return module
+
+# :: (string, [int], [(ObjectInModule, int)]) -> None
+def set_source_digests(code, statement_lines, definition_lines):
+    """Set source_digest of each top-level definition to the digest of the
+    top-level statement it is a part of.
+
+    statement_lines are first lines of top-level statements of the code,
+    in order. Comments and blank lines that follow a statement are counted
+    as its part.
+    """
+    lines = code.splitlines(True)
+    bounds = statement_lines + [len(lines) + 1]
+    digests = []
+    for start, end in zip(bounds, bounds[1:]):
+        digests.append(get_content_digest("".join(lines[start-1:end-1])))
+    for definition, line in definition_lines:
+        index = bisect.bisect_right(statement_lines, line) - 1
+        if index >= 0:
+            definition.source_digest = digests[index]
+
+# :: string -> dict
+def analyze_code(code):
+    """Parse and visit given code, returning keyword arguments for
+    Project#create_module. All of them can be pickled.
+    """
     try:
         tree = parse(code)
     except ParseError, e:
-        log.warning("Inspection of module %s failed." % path)
-        return project.create_module(path, errors=[e])
-    visitor = descend(tree, ModuleVisitor)
+        return dict(errors=[e])
+    visitor = ModuleVisitor(find_generators(code))
+    visitor.visit(tree)
+    # The last child is always the end marker.
+    set_source_digests(code, [child.get_lineno() for child in tree.children[:-1]],
+                       visitor.definition_lines)
 
     # We assume that all test classes in this module has dependencies on
     # all imports the module contains.
@@ -153,6 +468,49 @@ def inspect_code(project, path, code):
         # structure.
         test_class.imports = visitor.imports[:]
 
-    return project.create_module(path, code=tree, objects=visitor.objects,
-        imports=visitor.imports, main_snippet=visitor.main_snippet,
-        last_import=visitor.last_import)
+    return dict(code=tree, objects=visitor.objects, imports=visitor.imports,
+                main_snippet=visitor.main_snippet,
+                last_import=visitor.last_import)
+
+# :: string -> dict
+def analyze_code_quickly(code):
+    """Like analyze_code, but uses the builtin parser instead of lib2to3
+    when possible. Modules created from the result don't have a CodeTree
+    until someone asks for it (see build_code_tree).
+    """
+    if ast is None:
+        return analyze_code(code)
+    try:
+        tree = compile_without_warnings(code + "\n", 'exec', ast.PyCF_ONLY_AST)
+        generators = generators_of_code(compile_without_warnings(tree, 'exec'))
+        visitor = FastModuleVisitor(code.splitlines(), generators)
+        visitor.visit(tree.body)
+        set_source_digests(code, map(ast_first_line, tree.body),
+                           visitor.definition_lines)
+    except (SyntaxError, TypeError, ValueError, UnsupportedConstruct), e:
+        log.debug("Falling back to full inspection: %s." % e)
+        return analyze_code(code)
+
+    for test_class in [o for o in visitor.objects if isinstance(o, TestClass)]:
+        test_class.imports = visitor.imports[:]
+
+    return dict(objects=visitor.objects, imports=visitor.imports,
+                lazy_code_tree=True)
+
+# :: string -> CodeTree
+def build_code_tree(code):
+    """Parse given code and return a CodeTree with references to all
+    objects the ModuleVisitor finds in it.
+    """
+    tree = parse(code)
+    visitor = ModuleVisitor(find_generators(code))
+    visitor.visit(tree)
+    code_tree = CodeTree(tree)
+    for obj in visitor.objects:
+        code_tree.add_object_with_code(obj)
+        if isinstance(obj, (Class, TestClass)):
+            for method in obj.methods:
+                code_tree.add_object_with_code(method)
+    code_tree.add_object('main_snippet', visitor.main_snippet)
+    code_tree.add_object('last_import', visitor.last_import)
+    return code_tree
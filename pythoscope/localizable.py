@@ -1,8 +1,9 @@
 import os
 import time
 
-from pythoscope.util import ensure_directory, get_last_modification_time, \
-    module_path_to_name, write_content_to_file
+from pythoscope.util import ensure_directory, get_content_digest, \
+    get_file_digest, get_last_modification_time, module_path_to_name, \
+    write_content_to_file
 
 
 class Localizable(object):
@@ -11,7 +12,14 @@ class Localizable(object):
     Each Localizable has a 'path' attribute and an information when it was
     created, to be in sync with its file system counterpart. Path is always
     relative to the project this localizable belongs to.
+
+    When the project uses content digests, Localizable also remembers
+    a digest of its file contents. A file modified after the Localizable
+    was created is then considered out of sync only if its contents differ,
+    so checkouts and touches don't trigger a new inspection.
     """
+    # Digest of the file contents, or None if it wasn't recorded.
+    digest = None
     def __init__(self, project, subpath, created=None):
         self.project = project
         self.subpath = subpath
@@ -26,11 +34,26 @@ class Localizable(object):
     def is_out_of_sync(self):
         """Is the object out of sync with its file.
         """
-        return get_last_modification_time(self.get_path()) > self.created
+        modification_time = get_last_modification_time(self.get_path())
+        if modification_time <= self.created:
+            return False
+        if self.digest is not None and self.digest == get_file_digest(self.get_path()):
+            # Contents haven't changed, so there's no need to look at
+            # the digest again until the next modification.
+            self.created = modification_time
+            return False
+        return True
 
     def is_up_to_date(self):
         return not self.is_out_of_sync()
 
+    def update_digest(self, content):
+        """Remember digest of the given file contents, if the project uses
+        content digests.
+        """
+        if self.project.content_digests:
+            self.digest = get_content_digest(content)
+
     def get_path(self):
         """Return the full path to the file.
         """
@@ -44,6 +67,7 @@ class Localizable(object):
         ensure_directory(os.path.dirname(self.get_path()))
         write_content_to_file(new_content, self.get_path())
         self.created = time.time()
+        self.update_digest(new_content)
 
     def exists(self):
         return os.path.isfile(self.get_path())
@@ -2,16 +2,20 @@ import cPickle
 import os
 import re
 
+from cStringIO import StringIO
+
 from pythoscope.astbuilder import regenerate
 from pythoscope.code_trees_manager import FilesystemCodeTreesManager
-from pythoscope.compat import any, set
+from pythoscope.compat import any, md5, set
 from pythoscope.event import Event
 from pythoscope.localizable import Localizable
 from pythoscope.logger import log
 from pythoscope.serializer import SerializedObject
-from pythoscope.util import all_of_type, assert_argument_type, class_name,\
-    directories_under, extract_subpath, findfirst, load_pickle_from,\
-    starts_with_path, write_content_to_file, DirectoryException
+from pythoscope.util import assert_argument_type, class_name,\
+    directories_under, ensure_directory, extract_subpath, findfirst,\
+    get_file_digest, get_last_modification_time, load_pickle_from,\
+    module_path_to_name, read_file_contents, starts_with_path,\
+    string2filename, write_content_to_file, DirectoryException
 
 ########################################################################
 ## Project class and helpers.
@@ -36,6 +40,10 @@ class ModuleSaveError(Exception):
 PYTHOSCOPE_SUBPATH = ".pythoscope"
 PICKLE_SUBPATH = os.path.join(PYTHOSCOPE_SUBPATH, "project.pickle")
 POINTS_OF_ENTRY_SUBPATH = os.path.join(PYTHOSCOPE_SUBPATH, "points-of-entry")
+EXCLUDES_SUBPATH = os.path.join(PYTHOSCOPE_SUBPATH, "excludes")
+TRACING_SUBPATH = os.path.join(PYTHOSCOPE_SUBPATH, "tracing")
+DAEMON_SOCKET_SUBPATH = os.path.join(PYTHOSCOPE_SUBPATH, "daemon.sock")
+SHARDS_SUBPATH = os.path.join(PYTHOSCOPE_SUBPATH, "shards")
 
 def get_pythoscope_path(project_path):
     return os.path.join(project_path, PYTHOSCOPE_SUBPATH)
@@ -43,15 +51,47 @@ def get_pickle_path(project_path):
     return os.path.join(project_path, PICKLE_SUBPATH)
 def get_points_of_entry_path(project_path):
     return os.path.join(project_path, POINTS_OF_ENTRY_SUBPATH)
+def get_excludes_path(project_path):
+    return os.path.join(project_path, EXCLUDES_SUBPATH)
+def get_tracing_path(project_path):
+    return os.path.join(project_path, TRACING_SUBPATH)
+def get_daemon_socket_path(project_path):
+    return os.path.join(project_path, DAEMON_SOCKET_SUBPATH)
 
 def get_code_trees_path(project_path):
     return os.path.join(get_pythoscope_path(project_path), "code-trees")
 
+def get_shards_path(project_path):
+    return os.path.join(project_path, SHARDS_SUBPATH)
+def get_shards_index_path(project_path):
+    return os.path.join(get_shards_path(project_path), "index.pickle")
+
 class Project(object):
     """Object representing the whole project under Pythoscope wings.
 
     No modifications are final until you call save().
+
+    Project information is stored either in a single pickle file or, after
+    a call to use_sharded_store(), in a set of shards managed by
+    a ShardedStore instance.
     """
+    # Sharded store of this project or None if the project is stored in
+    # a single pickle file.
+    _store = None
+    # Whether modules and points of entry should remember digests of their
+    # files' contents (see Localizable).
+    content_digests = False
+    # Whether modules should be inspected with the builtin parser, leaving
+    # creation of their CodeTrees for later (see Module#lazy_code_tree).
+    lazy_code_trees = False
+    # Incremented each time a module is added, replaced or removed, so that
+    # lookups of definitions can be memoized (see Execution).
+    modules_generation = 0
+    # Description of the policy deciding which calls are captured when
+    # points of entry are run or None to capture all of them (see
+    # pythoscope.capture_policy).
+    capture_policy = None
+
     def from_directory(cls, project_path):
         """Read the project information from the .pythoscope/ directory of
         the given project.
@@ -60,6 +100,8 @@ class Project(object):
         first time and that's OK.
         """
         project_path = os.path.realpath(project_path)
+        if os.path.exists(get_shards_index_path(project_path)):
+            return ShardedStore.load_project(project_path)
         try:
             project = load_pickle_from(get_pickle_path(project_path))
             # Update project's path, as the directory could've been moved.
@@ -82,17 +124,42 @@ class Project(object):
         self.new_tests_directory = "tests"
         self.points_of_entry = {}
         self.snippet_executions = []
+        # Modules are indexed both by their subpaths and their locators.
+        # Locator => list of modules with that locator, as modules may share
+        # it (think "pkg.py" and "pkg/__init__.py").
         self._modules = {}
+        self._modules_by_locator = {}
+        # Test class name => list of TestClass instances with that name.
+        self._test_classes_by_name = {}
         self.code_trees_manager = code_trees_manager_class(get_code_trees_path(path))
 
         self._find_new_tests_directory()
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_modules_by_locator']
+        del state['_test_classes_by_name']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._index_modules_by_locator()
+        self._test_classes_by_name = {}
+        for module in self._modules.values():
+            self._index_test_classes_of(module)
+
     def _get_pickle_path(self):
         return get_pickle_path(self.path)
 
     def get_points_of_entry_path(self):
         return get_points_of_entry_path(self.path)
 
+    def get_excludes_path(self):
+        return get_excludes_path(self.path)
+
+    def get_tracing_path(self):
+        return get_tracing_path(self.path)
+
     def path_for_point_of_entry(self, name):
         return os.path.join(self.path, self.subpath_for_point_of_entry(name))
 
@@ -104,15 +171,61 @@ class Project(object):
             if re.search(r'[_-]?tests?([_-]|$)', path):
                 self.new_tests_directory = path
 
-    def save(self):
+    def use_sharded_store(self):
+        """Switch this project to the sharded store. Takes effect on the next
+        call to save().
+        """
+        if self._store is None:
+            self._store = ShardedStore()
+
+    def use_content_digests(self):
+        """Make modules and points of entry inspected from now on remember
+        digests of their contents, so they're not inspected again when only
+        their modification time changes.
+        """
+        self.content_digests = True
+
+    def use_capture_policy(self, spec):
+        """Make points of entry run from now on capture calls according to
+        the given capture policy description.
+        """
+        self.capture_policy = spec
+
+    def use_code_trees_cache_limits(self, max_entries, max_bytes):
+        """Keep in memory at most max_entries CodeTrees, occupying about
+        max_bytes bytes (see FilesystemCodeTreesManager). Limits are saved
+        together with the project.
+        """
+        self.code_trees_manager.set_cache_limits(max_entries, max_bytes)
+
+    def use_lazy_code_trees(self):
+        """Make modules inspected from now on build their CodeTrees only
+        when they're needed, usually when tests are being added to them.
+        """
+        self.lazy_code_trees = True
+
+    def save(self, keep_code_trees=False):
+        """Save the project information and all changed modules.
+
+        Code trees are saved as well and removed from memory, unless
+        keep_code_trees is true.
+        """
         # To avoid inconsistencies try to save all project's modules first. If
         # any of those saves fail, the pickle file won't get updated.
-        for module in self.get_modules():
+        # Modules that haven't been loaded from their shards couldn't have
+        # changed, so there's no need to look at them.
+        for module in self._modules.values():
             log.debug("Calling save() on module %r" % module.subpath)
             module.save()
 
-        # We don't want to have a single AST in a Project instance.
-        self.code_trees_manager.clear_cache()
+        if keep_code_trees:
+            self.code_trees_manager.flush()
+        else:
+            self.code_trees_manager.clear_cache()
+
+        if self._store is not None:
+            self._store.save(self)
+            return
 
         # Pickling the project after saving all of its modules, so any changes
         # made by Module instances during save() will be preserved as well.
@@ -148,12 +261,23 @@ class Project(object):
         """
         module = Module(subpath=self._extract_subpath(path), project=self, **kwds)
 
-        if module.subpath in self._modules.keys():
+        if self._store is not None and module.subpath in self._store.unloaded_modules:
+            # Old version of the module may hold dynamic information about
+            # definitions that haven't changed, so we need it in memory.
+            # Modules from other shards refer to it by subpath, so they will
+            # get the new instance once loaded.
+            self._store.load_module(self, module.subpath)
+
+        if module.subpath in self._modules:
+            kept = module.keep_unchanged_objects_of(self._modules[module.subpath])
+            if kept:
+                log.debug("Kept %d unchanged definitions of module %s." % \
+                              (kept, module.subpath))
             self._replace_references_to_module(module)
             # Don't need to forget the old CallTree, as the creation of
             # the Module instance above overwrites it anyway.
-
-        self._modules[module.subpath] = module
+        else:
+            self._add_module(module)
 
         return module
 
@@ -178,7 +302,7 @@ class Project(object):
                 test_case.associated_modules.remove(module)
             except ValueError:
                 pass
-        del self._modules[subpath]
+        self._remove_module(module)
         self.code_trees_manager.forget_code_tree(module.subpath)
 
     # :: (CodeTree, Module) -> None
@@ -187,6 +311,8 @@ class Project(object):
 
     # :: Module -> CodeTree
     def recall_code_tree(self, module):
+        if module.lazy_code_tree:
+            return module.build_code_tree()
         return self.code_trees_manager.recall_code_tree(module.subpath)
 
     def remember_execution_from_snippet(self, execution):
@@ -195,14 +321,85 @@ class Project(object):
     def _replace_references_to_module(self, module):
         """Remove a module with the same subpath as given module from this
         Project and replace all references to it with the new instance.
+
+        Modules not loaded from the sharded store yet refer to the module by
+        its subpath, so only loaded modules need to be updated.
         """
         old_module = self[module.subpath]
-        for test_case in self.iter_test_cases():
+        for test_case in self._iter_loaded_test_cases():
             try:
                 test_case.associated_modules.remove(old_module)
                 test_case.associated_modules.append(module)
             except ValueError:
                 pass
+        self._remove_module(old_module)
+        self._add_module(module)
+
+    def _add_module(self, module):
+        self.modules_generation += 1
+        self._modules[module.subpath] = module
+        self._modules_by_locator.setdefault(module.locator, []).append(module)
+        self._index_test_classes_of(module)
+
+    def _remove_module(self, module):
+        self.modules_generation += 1
+        del self._modules[module.subpath]
+        modules = self._modules_by_locator.get(module.locator, [])
+        for i, other in enumerate(modules):
+            if other is module:
+                del modules[i]
+                break
+        if not modules:
+            self._modules_by_locator.pop(module.locator, None)
+        for test_class in module.test_cases:
+            self._unindex_test_class(test_class)
+
+    def _index_test_classes_of(self, module):
+        for test_class in module.test_cases:
+            self._index_test_class(test_class)
+
+    def _index_test_class(self, test_class):
+        self._test_classes_by_name.setdefault(test_class.name, []).append(test_class)
+
+    def _unindex_test_class(self, test_class):
+        test_classes = self._test_classes_by_name.get(test_class.name, [])
+        for i, other in enumerate(test_classes):
+            if other is test_class:
+                del test_classes[i]
+                break
+        if not test_classes:
+            self._test_classes_by_name.pop(test_class.name, None)
+
+    def test_class_added(self, module, test_class):
+        """Called by modules whenever a test class is added to them.
+        Modules not registered within this project are ignored.
+        """
+        if self._modules.get(module.subpath) is module:
+            self._index_test_class(test_class)
+
+    def test_class_removed(self, module, test_class):
+        """Called by modules whenever a test class is removed from them.
+        """
+        if self._modules.get(module.subpath) is module:
+            self._unindex_test_class(test_class)
+
+    def find_test_class_by_name(self, name):
+        """Return a test class with given name or None if there isn't one.
+
+        Only modules that may contain the test class get loaded from
+        the sharded store.
+        """
+        if self._store is not None:
+            for subpath in self._store.find_unloaded_modules_with_test_class(name):
+                self._store.load_module(self, subpath)
+        test_classes = self._test_classes_by_name.get(name)
+        if test_classes:
+            return test_classes[0]
+
+    def _index_modules_by_locator(self):
+        self._modules_by_locator = {}
+        for module in self._modules.values():
+            self._modules_by_locator.setdefault(module.locator, []).append(module)
 
     def _extract_point_of_entry_subpath(self, path):
         """Takes the file path and returns subpath relative to the
@@ -231,23 +428,63 @@ class Project(object):
             for test_case in module.test_cases:
                 yield test_case
 
+    def _iter_loaded_test_cases(self):
+        for module in self._modules.values():
+            for test_case in module.test_cases:
+                yield test_case
+
     def _path_for_test(self, test_module_name):
         """Return a full path to test module with given name.
         """
         return os.path.join(self.path, self.new_tests_directory, test_module_name)
 
     def __getitem__(self, module):
-        for mod in self.iter_modules():
-            if module in [mod.subpath, mod.locator]:
-                return mod
+        if module in self._modules:
+            return self._modules[module]
+        if module in self._modules_by_locator:
+            return self._modules_by_locator[module][0]
+        if self._store is not None:
+            subpath = self._store.find_unloaded_module(module)
+            if subpath is not None:
+                return self._store.load_module(self, subpath)
         raise ModuleNotFound(module)
 
     def get_modules(self):
+        self._load_all_modules()
         return self._modules.values()
 
     def iter_modules(self):
+        self._load_all_modules()
         return self._modules.values()
 
+    def get_module_subpaths(self):
+        """Return subpaths of all modules of this project, without loading
+        any of them from the sharded store.
+        """
+        subpaths = self._modules.keys()
+        if self._store is not None:
+            subpaths.extend(self._store.unloaded_modules)
+        return subpaths
+
+    def is_module_up_to_date(self, subpath):
+        """Return True if there is a module under given subpath and it hasn't
+        changed since the last inspection.
+
+        Modules not loaded from the sharded store yet are checked without
+        loading them.
+        """
+        if self._store is not None and subpath in self._store.unloaded_modules:
+            return self._store.is_module_up_to_date(self, subpath)
+        try:
+            return self[subpath].is_up_to_date()
+        except ModuleNotFound:
+            return False
+
+    def _load_all_modules(self):
+        if self._store is not None:
+            for subpath in list(self._store.unloaded_modules):
+                self._store.load_module(self, subpath)
+
     def iter_classes(self):
         for module in self.iter_modules():
             for klass in module.classes:
@@ -285,7 +522,16 @@ class CodeTree(object):
     called on them. They also will *not* be accesible  via `CodeTree.of()`
     interface unless you remember them in a Project instance first (see
     Project#remember_code_tree).
+
+    A CodeTree is dirty when it has changed since it was last saved or
+    loaded. Modifications made through add_object and remove_object mark
+    the tree dirty automatically, while code that modifies the AST directly
+    should call mark_dirty() itself. Clean trees don't have to be saved
+    again. The flag itself is never pickled, so a freshly loaded tree
+    is clean.
     """
+    dirty = False
+
     def of(cls, obj):
         """Return a CodeTree instance that handles code of the given object.
         """
@@ -296,9 +542,22 @@ class CodeTree(object):
     def __init__(self, code):
         self.code = code
         self.code_references = {}
+        self.dirty = True
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('dirty', None)
+        return state
+
+    def mark_dirty(self):
+        self.dirty = True
+
+    def mark_clean(self):
+        self.dirty = False
 
     def add_object(self, obj, code):
         self.code_references[module_level_id(obj)] = code
+        self.mark_dirty()
 
     def add_object_with_code(self, obj):
         """Take an object holding an AST in its `code` attribute and store it
@@ -313,6 +572,7 @@ class CodeTree(object):
 
     def remove_object(self, obj):
         del self.code_references[module_level_id(obj)]
+        self.mark_dirty()
 
     def get_code_of(self, obj):
         if isinstance(obj, Module):
@@ -324,6 +584,7 @@ class CodeTree(object):
         """
         pickled_code_tree = cPickle.dumps(self, cPickle.HIGHEST_PROTOCOL)
         write_content_to_file(pickled_code_tree, path, binary=True)
+        self.mark_clean()
 
 def module_of(obj):
     """Return the Module given object is contained within.
@@ -359,6 +620,16 @@ def module_level_id(obj):
     else:
         raise TypeError("Don't know how to generate a module-level id for %r" % obj)
 
+def forget_code(obj):
+    """Remove the `code` attribute of the given object (and of its methods),
+    just like CodeTree#add_object_with_code does, but without storing it
+    anywhere.
+    """
+    del obj.code
+    if isinstance(obj, (Class, TestClass)):
+        for method in obj.methods:
+            del method.code
+
 def code_of(obj, reference=None):
     """Return an AST for the given object.
 
@@ -381,7 +652,14 @@ class ObjectInModule(object):
 
     Note that the code attribute will be removed from the object once it
     becomes a part of a Module.
+
+    source_digest is a digest of the source of the top-level statement
+    the object has been defined in, set by the static inspector. Objects
+    with unchanged source survive re-inspection of their module (see
+    Module#keep_unchanged_objects_of).
     """
+    source_digest = None
+
     def __init__(self, name, code):
         self.name = name
         self.code = code
@@ -578,6 +856,9 @@ class Call(Event):
     __eq__ and __hash__ definitions provided for Function.get_unique_calls()
     and UserObject.get_external_calls().
     """
+    # Set for calls dropped by a capture policy (see Execution).
+    dropped = False
+
     def __init__(self, definition, args, output=None, exception=None):
         if [value for value in args.values() if not isinstance(value, SerializedObject)]:
             raise ValueError("Values of all arguments should be instances of SerializedObject class.")
@@ -837,14 +1118,34 @@ class TestClass(ObjectInModule, TestSuite):
 ## The Module class.
 ##
 class Module(Localizable, TestSuite):
+    """Module objects are indexed by type and name for quick lookups (see
+    find_object). Index is kept up to date by add_object and remove_object
+    and is rebuilt when someone replaces the `objects` list as a whole.
+    It is never pickled.
+
+    A module with lazy_code_tree set has been created without an AST.
+    Its objects don't have code references until the CodeTree is built
+    from the module's file, which happens on the first call to
+    `CodeTree.of()`.
+    """
     allowed_test_case_classes = [TestClass]
 
+    # The `objects` list the index has been built for.
+    _indexed_objects = None
+    lazy_code_tree = False
+
     def __init__(self, project, subpath, code=None, objects=None, imports=None,
-                 main_snippet=None, last_import=None, errors=None):
+                 main_snippet=None, last_import=None, errors=None,
+                 lazy_code_tree=False):
         Localizable.__init__(self, project, subpath)
         TestSuite.__init__(self, imports=imports)
 
-        if code:
+        if lazy_code_tree:
+            # CodeTree of the previous version of this module is no longer
+            # valid.
+            project.code_trees_manager.forget_code_tree(subpath)
+            self.lazy_code_tree = True
+        elif code:
             # Persistence of CodeTree instances is managed by the Project instance.
             code_tree = CodeTree(code)
             project.remember_code_tree(code_tree, self)
@@ -871,16 +1172,55 @@ class Module(Localizable, TestSuite):
                                     (obj, self.locator, obj.module.locator))
             obj.module = self
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ['_objects_by_type', '_objects_by_name', '_indexed_objects']:
+            state.pop(name, None)
+        return state
+
+    def _ensure_objects_index(self):
+        if self._indexed_objects is not self.objects:
+            # Type => list of objects of that type.
+            self._objects_by_type = {}
+            # Type => name => the first object of that type and name.
+            self._objects_by_name = {}
+            for obj in self.objects:
+                self._index_object(obj)
+            self._indexed_objects = self.objects
+
+    def _index_object(self, obj):
+        # Objects are indexed under all of their base classes, so lookups
+        # work the same way isinstance() does.
+        for klass in type(obj).__mro__:
+            self._objects_by_type.setdefault(klass, []).append(obj)
+            self._objects_by_name.setdefault(klass, {}).setdefault(obj.name, obj)
+
+    def _unindex_object(self, obj):
+        for klass in type(obj).__mro__:
+            objects = self._objects_by_type[klass]
+            objects.remove(obj)
+            names = self._objects_by_name[klass]
+            if names.get(obj.name) is obj:
+                del names[obj.name]
+                for other in objects:
+                    if other.name == obj.name:
+                        names[obj.name] = other
+                        break
+
+    def _objects_of_type(self, type):
+        self._ensure_objects_index()
+        return self._objects_by_type.get(type, [])
+
     def _get_classes(self):
-        return all_of_type(self.objects, Class)
+        return self._objects_of_type(Class)
     classes = property(_get_classes)
 
     def _get_functions(self):
-        return all_of_type(self.objects, Function)
+        return self._objects_of_type(Function)
     functions = property(_get_functions)
 
     def _get_test_classes(self):
-        return all_of_type(self.objects, TestClass)
+        return self._objects_of_type(TestClass)
     test_classes = property(_get_test_classes)
 
     def has_errors(self):
@@ -907,7 +1247,14 @@ class Module(Localizable, TestSuite):
 
     def add_object(self, obj):
         self._set_module_for_object(obj)
+        self._ensure_objects_index()
         self.objects.append(obj)
+        self._index_object(obj)
+
+        if self.lazy_code_tree and obj.code is None:
+            # The reference will be found once the CodeTree gets built.
+            forget_code(obj)
+            return
         CodeTree.of(self).add_object_with_code(obj)
 
         # When attaching a class to a module we not only have to store its own
@@ -917,17 +1264,69 @@ class Module(Localizable, TestSuite):
                 CodeTree.of(self).add_object_with_code(method)
 
     def remove_object(self, obj):
+        self._ensure_objects_index()
         self.objects.remove(obj)
-        CodeTree.of(self).remove_object(obj)
+        self._unindex_object(obj)
+        if not self.lazy_code_tree:
+            CodeTree.of(self).remove_object(obj)
+
+    def keep_unchanged_objects_of(self, old_module):
+        """Replace classes and functions of this module with their
+        counterparts from the old version of this module, if their source
+        hasn't changed. That way calls and user objects collected during
+        dynamic inspection are not lost.
+
+        Code references don't have to be updated, as they're looked up by
+        type and name of the object. Returns the number of kept objects.
+        """
+        old_objects = {}
+        for obj in old_module.objects:
+            if isinstance(obj, (Class, Function)) and obj.source_digest is not None:
+                key = (type(obj), obj.name)
+                if key in old_objects:
+                    # Can't tell which one is which.
+                    old_objects[key] = None
+                else:
+                    old_objects[key] = obj
+        kept = 0
+        for i, obj in enumerate(self.objects):
+            old_obj = old_objects.get((type(obj), obj.name))
+            if old_obj is not None and old_obj.source_digest == obj.source_digest:
+                old_obj.module = self
+                self.objects[i] = old_obj
+                kept += 1
+        # Index is stale now.
+        self._indexed_objects = None
+        return kept
+
+    def build_code_tree(self):
+        """Parse the module's file and remember its CodeTree, so the module
+        is no longer lazy. Return the CodeTree.
+
+        Raises ModuleNeedsAnalysis if the file has changed since the module
+        was inspected, as the references couldn't be trusted.
+        """
+        # The static inspector depends on this module, so it can't be
+        # imported at the top.
+        from pythoscope.inspector.static import build_code_tree
+        if self.is_out_of_sync():
+            raise ModuleNeedsAnalysis(self.subpath, out_of_sync=True)
+        log.debug("Building code tree of module %s." % self.subpath)
+        code_tree = build_code_tree(read_file_contents(self.get_path()))
+        self.project.remember_code_tree(code_tree, self)
+        self.lazy_code_tree = False
+        return code_tree
 
     def add_test_case_without_append(self, test_case):
         TestSuite.add_test_case_without_append(self, test_case)
         self.add_object(test_case)
         self.ensure_imports(test_case.imports)
+        self.project.test_class_added(self, test_case)
 
     def remove_test_case(self, test_case):
         TestSuite.remove_test_case(self, test_case)
         self.remove_object(test_case)
+        self.project.test_class_removed(self, test_case)
 
     def get_content(self):
         return regenerate(code_of(self))
@@ -938,9 +1337,10 @@ class Module(Localizable, TestSuite):
         return [tc for tc in self.test_cases if module in tc.associated_modules]
 
     def find_object(self, type, name):
-        for obj in all_of_type(self.objects, type):
-            if obj.name == name:
-                return obj
+        self._ensure_objects_index()
+        names = self._objects_by_name.get(type)
+        if names is not None:
+            return names.get(name)
 
     def save(self):
         # Don't save the test file unless it has been changed.
@@ -953,3 +1353,405 @@ class Module(Localizable, TestSuite):
                 raise ModuleSaveError(self.subpath, err.args[0])
             self.changed = False
 
+
+########################################################################
+## Sharded project storage.
+##
+# Kinds of persistent ids and parts of them. Those are numbers rather than
+# strings, because pickler memoizes strings by identity and we want the same
+# object graph to always pickle into the same string (see ShardedStore#save).
+PROJECT_REF, MODULE_REF, DEFINITION_REF, CAPTURED_REF = range(4)
+POE_OWNER, SNIPPET_OWNER = range(2)
+CAPTURED_CALL, CAPTURED_OBJECT = range(2)
+
+class CapturedReference(object):
+    """Placeholder for a call or an object captured during an execution,
+    created while a module shard is being loaded. It gets replaced with
+    the real object once all execution owners are loaded.
+    """
+    def __init__(self, owner, key):
+        self.owner = owner
+        self.key = key
+
+class ShardedStore(object):
+    """Storage of project information split into a small index file and
+    separate pickle files ("shards") for each module and each point of entry.
+    Executions of snippets (see pythoscope.snippet) are kept in a shard of
+    their own.
+
+    Objects from one shard refer to objects from other shards using
+    persistent ids:
+      (PROJECT_REF,)                             - the Project itself,
+      (MODULE_REF, subpath)                      - a Module,
+      (DEFINITION_REF, subpath, module_level_id) - a Class, Function or Method,
+      (CAPTURED_REF, owner, key)                 - a call or a serialized
+                                                   object captured during
+                                                   an execution.
+
+    Points of entry and snippet executions (together called "execution
+    owners") are loaded along with the index. Modules are loaded from their
+    shards on demand, although all modules that contain traced calls get
+    loaded together with the executions they were captured in.
+
+    During save() only the loaded shards are pickled and only those with
+    contents different than on disk get written.
+    """
+    def load_project(cls, project_path):
+        store = cls()
+        project = Project.__new__(Project)
+        index = store._load(project, get_shards_index_path(project_path))
+        project.__dict__.update(index['project'])
+        # Update project's path, as the directory could've been moved.
+        project.path = project_path
+        project._modules = {}
+        project._modules_by_locator = {}
+        project._test_classes_by_name = {}
+        project.points_of_entry = {}
+        project.snippet_executions = []
+        project._store = store
+
+        store.module_shards = index['modules']
+        store.unloaded_modules = set(store.module_shards.keys())
+        store.poe_shards = index['points_of_entry']
+        store.snippets_digest = index['snippets']
+        # Indexes saved by older versions don't have names of test classes.
+        store.module_test_classes = index.get('test_classes', {})
+
+        # Modules loaded during loading of execution owners may refer to
+        # executions not loaded yet, so we resolve those references at the end.
+        store._resolving_later = True
+        try:
+            for name in store.poe_shards.keys():
+                log.debug("Loading point of entry %r from its shard..." % name)
+                project.points_of_entry[name] = store._load(project,
+                    store._poe_shard_path(project, name))
+            if store.snippets_digest is not None:
+                project.snippet_executions = store._load(project,
+                    store._snippets_shard_path(project))
+        finally:
+            store._resolving_later = False
+        for module in store._unresolved_modules:
+            store._resolve_captured_references(project, module)
+        store._unresolved_modules = []
+
+        return project
+    load_project = classmethod(load_project)
+
+    def __init__(self):
+        # Mapping of module subpaths to (digest, created, content digest)
+        # tuples, describing module shards on disk.
+        self.module_shards = {}
+        # Mapping of points of entry names to digests of their shards.
+        self.poe_shards = {}
+        self.snippets_digest = None
+        # Subpaths of modules that exist in shards, but haven't been loaded.
+        self.unloaded_modules = set()
+        # Mapping of module subpaths to lists of names of test classes they
+        # contain. Modules missing from it may contain any test classes.
+        self.module_test_classes = {}
+        # Mapping of locators to subpaths of unloaded modules, built on
+        # first use. As modules only get loaded, it never gets out of date
+        # as long as we check the result against unloaded_modules.
+        self._unloaded_by_locator = None
+
+        # Module shells (see load_module) currently being loaded.
+        self._loading_modules = {}
+        self._resolving_later = False
+        self._unresolved_modules = []
+
+    def find_unloaded_module(self, module):
+        """Return subpath of an unloaded module with given subpath or locator,
+        or None if there is no such module.
+        """
+        if module in self.unloaded_modules:
+            return module
+        if self._unloaded_by_locator is None:
+            self._unloaded_by_locator = {}
+            for subpath in self.unloaded_modules:
+                locator = module_path_to_name(subpath, newsep=".")
+                self._unloaded_by_locator.setdefault(locator, subpath)
+        subpath = self._unloaded_by_locator.get(module)
+        if subpath in self.unloaded_modules:
+            return subpath
+
+    def find_unloaded_modules_with_test_class(self, name):
+        """Return subpaths of unloaded modules that may contain a test class
+        with given name.
+        """
+        subpaths = []
+        for subpath in self.unloaded_modules:
+            names = self.module_test_classes.get(subpath)
+            if names is None or name in names:
+                subpaths.append(subpath)
+        return subpaths
+
+    def forget_unloaded_module(self, subpath):
+        self.unloaded_modules.discard(subpath)
+
+    def is_module_up_to_date(self, project, subpath):
+        """Check whether an unloaded module is up to date, the same way
+        Localizable#is_out_of_sync does it.
+        """
+        shard_digest, created, content_digest = self.module_shards[subpath]
+        path = os.path.join(project.path, subpath)
+        modification_time = get_last_modification_time(path)
+        if modification_time <= created:
+            return True
+        if content_digest is not None and content_digest == get_file_digest(path):
+            self.module_shards[subpath] = (shard_digest, modification_time, content_digest)
+            return True
+        return False
+
+    def load_module(self, project, subpath):
+        """Load a module from its shard and register it in the project.
+
+        An empty Module instance (a shell) is registered before the shard is
+        unpickled, so modules referring to each other can be loaded.
+        """
+        try:
+            return self._loading_modules[subpath]
+        except KeyError:
+            pass
+        if subpath in project._modules:
+            return project._modules[subpath]
+
+        log.debug("Loading module %r from its shard..." % subpath)
+        module = Module.__new__(Module)
+        self._loading_modules[subpath] = module
+        try:
+            state = self._load(project, self._module_shard_path(project, subpath))
+        finally:
+            del self._loading_modules[subpath]
+        # Attribute names are interned, just like cPickle does it for
+        # regular instances.
+        for name, value in state.iteritems():
+            module.__dict__[intern(name)] = value
+
+        self.unloaded_modules.discard(subpath)
+        project._add_module(module)
+
+        if self._resolving_later:
+            self._unresolved_modules.append(module)
+        else:
+            self._resolve_captured_references(project, module)
+        return module
+
+    def save(self, project):
+        static_refs, captured_refs = self._collect_references(project)
+        all_refs = static_refs.copy()
+        all_refs.update(captured_refs)
+        def static_persistent_id(obj):
+            return static_refs.get(id(obj))
+        def module_persistent_id_for(subpath):
+            def persistent_id(obj):
+                pid = all_refs.get(id(obj))
+                # Module's own definitions are stored inline in its shard.
+                if pid and pid[0] == DEFINITION_REF and pid[1] == subpath:
+                    return None
+                return pid
+            return persistent_id
+
+        # Pickle everything first, so a pickling error won't leave
+        # the shards in an inconsistent state.
+        writes = []
+        def add_shard(path, obj, persistent_id, old_digest):
+            contents = self._dumps(obj, persistent_id)
+            digest = md5(contents).hexdigest()
+            if digest != old_digest or not os.path.exists(path):
+                writes.append((path, contents))
+            return digest
+
+        module_shards = {}
+        module_test_classes = {}
+        for subpath, module in project._modules.items():
+            old_digest = self.module_shards.get(subpath, (None, None))[0]
+            digest = add_shard(self._module_shard_path(project, subpath),
+                               module.__getstate__(), module_persistent_id_for(subpath),
+                               old_digest)
+            module_shards[subpath] = (digest, module.created, module.digest)
+            module_test_classes[subpath] = [tc.name for tc in module.test_cases]
+        for subpath in self.unloaded_modules:
+            module_shards[subpath] = self.module_shards[subpath]
+            if subpath in self.module_test_classes:
+                module_test_classes[subpath] = self.module_test_classes[subpath]
+
+        poe_shards = {}
+        for name, poe in project.points_of_entry.items():
+            poe_shards[name] = add_shard(self._poe_shard_path(project, name),
+                poe, static_persistent_id, self.poe_shards.get(name))
+
+        snippets_digest = None
+        if project.snippet_executions:
+            snippets_digest = add_shard(self._snippets_shard_path(project),
+                project.snippet_executions, static_persistent_id,
+                self.snippets_digest)
+
+        project_state = project.__dict__.copy()
+        for name in ['_modules', '_modules_by_locator', '_test_classes_by_name',
+                     'points_of_entry', 'snippet_executions', '_store']:
+            project_state.pop(name, None)
+        index = {'project': project_state,
+                 'modules': module_shards,
+                 'points_of_entry': poe_shards,
+                 'snippets': snippets_digest,
+                 'test_classes': module_test_classes}
+        pickled_index = self._dumps(index, static_persistent_id)
+
+        log.debug("Writing %d changed shards to disk..." % len(writes))
+        for path, contents in writes:
+            ensure_directory(os.path.dirname(path))
+            write_content_to_file(contents, path, binary=True)
+
+        obsolete_paths = \
+            [self._module_shard_path(project, s) for s in self.module_shards.keys() if s not in module_shards] + \
+            [self._poe_shard_path(project, n) for n in self.poe_shards.keys() if n not in poe_shards]
+        if self.snippets_digest is not None and snippets_digest is None:
+            obsolete_paths.append(self._snippets_shard_path(project))
+        for path in obsolete_paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+        # Index goes last, so it never points to shards that weren't written.
+        ensure_directory(get_shards_path(project.path))
+        write_content_to_file(pickled_index, get_shards_index_path(project.path), binary=True)
+
+        self.module_shards = module_shards
+        self.module_test_classes = module_test_classes
+        self.poe_shards = poe_shards
+        self.snippets_digest = snippets_digest
+
+    def _collect_references(self, project):
+        """Return two dictionaries mapping ids of objects to their persistent
+        ids: the first one for project, modules and definitions, the second
+        one for objects captured during executions.
+        """
+        # Strings inside persistent ids are interned for the same reason
+        # their kinds are numbers.
+        static_refs = {id(project): (PROJECT_REF,)}
+        for subpath, module in project._modules.items():
+            subpath = intern(subpath)
+            static_refs[id(module)] = (MODULE_REF, subpath)
+            for obj in module.objects:
+                if isinstance(obj, (Class, Function)):
+                    static_refs[id(obj)] = (DEFINITION_REF, subpath, interned_id(obj))
+                if isinstance(obj, Class):
+                    for method in obj.methods:
+                        static_refs[id(method)] = (DEFINITION_REF, subpath, interned_id(method))
+
+        captured_refs = {}
+        for owner, execution in self._iter_executions(project):
+            for i, call in enumerate(execution.captured_calls):
+                captured_refs[id(call)] = (CAPTURED_REF, owner, (CAPTURED_CALL, i))
+            for key, obj in execution.captured_objects.items():
+                captured_refs[id(obj)] = (CAPTURED_REF, owner, (CAPTURED_OBJECT, key))
+
+        return static_refs, captured_refs
+
+    def _iter_executions(self, project):
+        for name, poe in project.points_of_entry.items():
+            yield (POE_OWNER, intern(name)), poe.execution
+        for i, execution in enumerate(project.snippet_executions):
+            yield (SNIPPET_OWNER, i), execution
+
+    def _get_execution(self, project, owner):
+        kind, name = owner
+        try:
+            if kind == POE_OWNER:
+                return project.points_of_entry[name].execution
+            elif kind == SNIPPET_OWNER:
+                return project.snippet_executions[name]
+        except (KeyError, IndexError):
+            pass
+
+    def _resolve_captured_references(self, project, module):
+        """Replace CapturedReference placeholders inside given module with
+        real calls and objects. References to executions that are gone are
+        simply dropped.
+        """
+        def resolve(objects):
+            resolved = []
+            for obj in objects:
+                if isinstance(obj, CapturedReference):
+                    obj = self._resolve_captured(project, obj)
+                    if obj is None:
+                        continue
+                resolved.append(obj)
+            objects[:] = resolved
+        for obj in module.objects:
+            if isinstance(obj, Function):
+                resolve(obj.calls)
+            elif isinstance(obj, Class):
+                resolve(obj.user_objects)
+
+    def _resolve_captured(self, project, reference):
+        execution = self._get_execution(project, reference.owner)
+        if execution is None:
+            return None
+        kind, key = reference.key
+        try:
+            if kind == CAPTURED_CALL:
+                return execution.captured_calls[key]
+            elif kind == CAPTURED_OBJECT:
+                return execution.captured_objects[key]
+        except (KeyError, IndexError):
+            pass
+
+    def _persistent_load(self, project, pid):
+        kind = pid[0]
+        if kind == PROJECT_REF:
+            return project
+        elif kind == MODULE_REF:
+            return self.load_module(project, pid[1])
+        elif kind == DEFINITION_REF:
+            return find_definition(self.load_module(project, pid[1]), pid[2])
+        elif kind == CAPTURED_REF:
+            return CapturedReference(pid[1], pid[2])
+        raise cPickle.UnpicklingError("Unknown persistent id %r." % (pid,))
+
+    def _dumps(self, obj, persistent_id):
+        output = StringIO()
+        pickler = cPickle.Pickler(output, cPickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = persistent_id
+        pickler.dump(obj)
+        return output.getvalue()
+
+    def _load(self, project, path):
+        unpickler = cPickle.Unpickler(StringIO(read_file_contents(path, binary=True)))
+        unpickler.persistent_load = lambda pid: self._persistent_load(project, pid)
+        return unpickler.load()
+
+    def _module_shard_path(self, project, subpath):
+        return os.path.join(get_shards_path(project.path), "modules",
+                            string2filename(subpath) + '.pickle')
+
+    def _poe_shard_path(self, project, name):
+        return os.path.join(get_shards_path(project.path), "points-of-entry",
+                            string2filename(name) + '.pickle')
+
+    def _snippets_shard_path(self, project):
+        return os.path.join(get_shards_path(project.path), "snippets.pickle")
+
+def interned_id(definition):
+    """Return module-level id of a definition with all strings interned.
+    """
+    kind, name = module_level_id(definition)
+    if isinstance(name, tuple):
+        return (kind, tuple(map(intern, name)))
+    return (kind, intern(name))
+
+def find_definition(module, definition_id):
+    """Find a definition inside given module by its module-level id (see
+    module_level_id()).
+    """
+    kind, name = definition_id
+    if kind == 'Class':
+        return module.find_object(Class, name)
+    elif kind == 'Function':
+        return module.find_object(Function, name)
+    elif kind == 'Method':
+        klass_name, method_name = name
+        klass = module.find_object(Class, klass_name)
+        if klass is not None:
+            return klass.find_method_by_name(method_name)
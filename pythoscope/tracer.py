@@ -1,13 +1,15 @@
+import fnmatch
 import inspect
+import os
 import re
 import sys
 import types
 
-from pythoscope.compat import any
+from pythoscope.logger import log
 from pythoscope.util import compact, get_self_from_method
 
 from bytecode_tracer import BytecodeTracer, rewrite_function,\
-    has_been_rewritten, rewrite_lnotab, code_rewriting_importer
+    has_been_rewritten, rewrite_lnotab, rewrite_cache, code_rewriting_importer
 
 
 # Pythons <= 2.4 surround `exec`uted code with a block named "?",
@@ -45,66 +47,76 @@ def is_class_definition(frame):
 class NotMethodFrame(Exception):
     pass
 
-def get_method_information(frame):
-    """Analyze the frame and return relevant information about the method
-    call it presumably represents.
-
-    Returns a tuple: (self_object, input_dictionary).
-
-    If the frame doesn't represent a method call, raises NotMethodFrame
-    exception.
+class ArgumentsLayout(object):
+    """Names of arguments of a code object and places of their values in
+    the frame locals, worked out once for all calls of the code.
+
+    Each argument is described by a (local name, names) pair. Names are None
+    for regular arguments and a list of names for nested arguments lists,
+    which are kept in the locals as tuples under hidden names.
+        >>> def fun(a, (b, c), *args, **kwds): pass
+        >>> layout = ArgumentsLayout(fun.func_code)
+        >>> layout.arguments
+        [('a', None), ('.1', ['b', 'c']), ('args', None), ('kwds', None)]
+        >>> locals = {'a': 1, '.1': (2, 3), 'args': (4,), 'kwds': {}}
+        >>> sorted(layout.input(locals).items())
+        [('a', 1), ('args', (4,)), ('b', 2), ('c', 3), ('kwds', {})]
     """
-    try:
-        args, varargs, varkw, locals = inspect.getargvalues(frame)
-        if args:
-            # Will raise TypeError if args[0] is a list.
-            self = locals[args[0]]
-        else:
-            # Will raise an IndexError if no arguments were passed.
-            self = locals[varargs][0]
-
-        methodname = frame.f_code.co_name
-        # Will raise AttributeError when the self is None or doesn't
-        # have method with given name.
-        method = getattr(self, methodname)
-
-        # This isn't a call on the first argument's method.
-        if not method.im_func.func_code == frame.f_code:
-            raise NotMethodFrame
-
-        # Remove the "self" argument.
-        if args:
-            args.pop(0)
-        elif varargs and locals[varargs]:
-            # No pop(), because locals[varargs] is a tuple.
-            locals[varargs] = locals[varargs][1:]
-        else:
-            raise NotMethodFrame
+    def __init__(self, code):
+        args, varargs, varkw = inspect.getargs(code)
+        self.arguments = []
+        for i, name in enumerate(args):
+            if isinstance(name, list):
+                self.arguments.append(('.%d' % i, name))
+            else:
+                self.arguments.append((name, None))
+        self.args_count = len(args)
+        self.varargs = varargs
+        for name in compact([varargs, varkw]):
+            self.arguments.append((name, None))
+        # First argument is a candidate for the "self" of a method call,
+        # unless it's a nested arguments list.
+        self.self_name = None
+        if args and not isinstance(args[0], list):
+            self.self_name = args[0]
+
+    def input(self, locals, arguments=None):
+        if arguments is None:
+            arguments = self.arguments
+        input = {}
+        for local_name, names in arguments:
+            if names is None:
+                input[local_name] = locals[local_name]
+            else:
+                input.update(zip(names, locals[local_name]))
+        return input
 
-        return (self, input_from_argvalues(args, varargs, varkw, locals))
-    except (AttributeError, KeyError, TypeError, IndexError):
+    def first_argument(self, locals):
+        """Return the first value passed to the call or raise NotMethodFrame
+        if it can't be a method call.
+        """
+        if self.self_name is not None:
+            return locals[self.self_name]
+        if not self.args_count and self.varargs and locals[self.varargs]:
+            return locals[self.varargs][0]
         raise NotMethodFrame
 
-def resolve_args(names, locals):
-    """Returns a list of tuples representing argument names and values.
-
-    Handles nested arguments lists well.
-        >>> resolve_args([['a', 'b'], 'c'], {'.0': (1, 2), 'c': 3})
-        [('a', 1), ('b', 2), ('c', 3)]
+    def input_without_first_argument(self, locals):
+        if self.args_count:
+            return self.input(locals, self.arguments[1:])
+        input = self.input(locals)
+        input[self.varargs] = input[self.varargs][1:]
+        return input
 
-        >>> resolve_args(['a', ['b', 'c']], {'.1': (8, 7), 'a': 9})
-        [('a', 9), ('b', 8), ('c', 7)]
+def method_lookup_class(obj):
+    """Return the class methods of obj are looked up in, which unlike
+    util.class_of ignores __class__ and is the class itself for classes.
     """
-    result = []
-    for i, name in enumerate(names):
-        if isinstance(name, list):
-            result.extend(zip(name, locals['.%d' % i]))
-        else:
-            result.append((name, locals[name]))
-    return result
-
-def input_from_argvalues(args, varargs, varkw, locals):
-    return dict(resolve_args(args + compact([varargs, varkw]), locals))
+    if isinstance(obj, (type, types.ClassType)):
+        return obj
+    if type(obj) is types.InstanceType:
+        return obj.__class__
+    return type(obj)
 
 def make_callable(code):
     if isinstance(code, str):
@@ -126,29 +138,108 @@ builtins_names = dir(__builtin__)
 
 def without_extension(path):
     return re.sub(r'.py[co]?$', '', path)
-def whole_stack(frame):
-    if frame is None:
-        return []
-    return [frame] + whole_stack(frame.f_back)
-def is_frame_from_code_rewriting_importer(frame):
-    code = frame.f_code
-    return without_extension(code_rewriting_importer.__file__) == without_extension(code.co_filename)
-def is_called_from_code_rewriting_importer(frame):
-    return any([is_frame_from_code_rewriting_importer(f) for f in whole_stack(frame)])
+
+# Verdicts of is_code_from_code_rewriting_importer, keyed by file names
+# of code objects. Hash of a file name is cached, while hash of a code
+# object is computed from its contents each time.
+_code_rewriting_importer_files = {}
+
+def is_code_from_code_rewriting_importer(code):
+    try:
+        return _code_rewriting_importer_files[code.co_filename]
+    except KeyError:
+        verdict = without_extension(code_rewriting_importer.__file__) == \
+            without_extension(code.co_filename)
+        _code_rewriting_importer_files[code.co_filename] = verdict
+        return verdict
+
+def matches_any(name, globs):
+    for glob in globs:
+        if fnmatch.fnmatchcase(name, glob):
+            return True
+    return False
+
+class TracingScope(object):
+    """Decides which code the tracer should follow in detail: code from
+    the given files and from modules matching one of the include globs,
+    unless its module matches one of the exclude globs.
+
+    Decisions are remembered for each file, so after the first call in a
+    file they cost a single dictionary lookup.
+    """
+    def __init__(self, paths, includes=[], excludes=[]):
+        self.paths = set([os.path.realpath(path) for path in paths])
+        self.includes = includes
+        self.excludes = excludes
+        # Maps file names of code objects to decisions.
+        self._decisions = {}
+
+    def contains(self, frame):
+        filename = frame.f_code.co_filename
+        try:
+            return self._decisions[filename]
+        except KeyError:
+            decision = self._decide(filename, frame.f_globals.get('__name__'))
+            self._decisions[filename] = decision
+            return decision
+
+    def _decide(self, filename, modulename):
+        if not isinstance(modulename, str):
+            modulename = None
+        if modulename and matches_any(modulename, self.excludes):
+            return False
+        if os.path.realpath(filename) in self.paths:
+            return True
+        return bool(modulename and matches_any(modulename, self.includes))
+
+def is_frame_active(frame, current_frame):
+    """Tell whether the frame is still being executed, given the frame that
+    is executing right now (or has just made a call).
+
+    The frame was called from within another one, so a walk up the stack
+    stops at the frame's caller at the latest.
+    """
+    caller = frame.f_back
+    while current_frame is not None:
+        if current_frame is frame:
+            return True
+        if current_frame is caller:
+            return False
+        current_frame = current_frame.f_back
+    return False
 
 class StandardTracer(object):
     """Wrapper around basic C{sys.settrace} mechanism that maps 'call', 'return'
     and 'exception' events into more meaningful callbacks.
 
     See L{ICallback} for details on events that tracer reports.
+
+    When a TracingScope is given, only calls to code within it are traced
+    in detail. Calls from the scope to other code are reported as unknown
+    calls. The interpreter doesn't report any events from inside them, so
+    their end is noticed on the first event from a frame they can't be
+    active under anymore.
     """
-    def __init__(self, callback):
+    def __init__(self, callback, scope=None):
         self.callback = callback
+        self.scope = scope
 
         self.btracer = BytecodeTracer()
 
         self.top_level_function = None
         self.sys_modules = None
+        # Maps ids of code objects to (code, ArgumentsLayout) pairs.
+        self.arguments_layouts = {}
+        # Maps (id of code object, class) pairs to (code, verdict) pairs,
+        # telling whether the code is a method of the class.
+        self.method_verdicts = {}
+        # Files of modules imported during the last trace() call.
+        self.imported_files = []
+        # Number of active frames of the code rewriting importer, kept up
+        # to date on their 'call' and 'return' events.
+        self.importer_depth = 0
+        # Frames of calls reported as unknown that may still be active.
+        self.unknown_frames = []
 
     # :: function | str -> None
     def trace(self, code):
@@ -171,27 +262,52 @@ class StandardTracer(object):
     def setup(self, code):
         self.top_level_function = make_callable(code)
         self.sys_modules = sys.modules.keys()
+        self.importer_depth = 0
+        self.unknown_frames = []
+        self.arguments_layouts = {}
+        self.method_verdicts = {}
 
     def teardown(self):
         # Revert any changes to sys.modules.
         # This unfortunatelly doesn't include changes to the modules' state itself.
         # Replaced module instances in sys.modules are also not reverted.
         modnames = [m for m in sys.modules.keys() if m not in self.sys_modules]
+        self.imported_files = compact([getattr(sys.modules[m], '__file__', None)
+                                       for m in modnames])
         for modname in modnames:
             del sys.modules[modname]
 
+        # Bytecode tracer clears the cache on its teardown.
+        log.debug("Rewritten code cache: %d hits, %d misses." % \
+                      (rewrite_cache.hits, rewrite_cache.misses))
+
         self.top_level_function = None
         self.sys_modules = None
+        self.unknown_frames = []
+        self.arguments_layouts = {}
+        self.method_verdicts = {}
 
     def tracer(self, frame, event, arg):
+        # We don't want to trace our own internals, so we ignore everything
+        # that happens while the code rewriting importer is on the stack.
+        if event == 'call' and is_code_from_code_rewriting_importer(frame.f_code):
+            self.importer_depth += 1
+            return self.importer_tracer
+        if self.importer_depth:
+            return
         # Bytecode tracing is unreliable without the rewrite step, so we have
         # to ignore all interactions inside that code. That usually concerns
         # modules that were imported before the tracer started.
         if not has_been_rewritten(frame.f_code):
             return
-        # We don't want to trace our own internals.
-        if is_called_from_code_rewriting_importer(frame):
-            return
+        if event == 'call':
+            if self.unknown_frames:
+                self.leave_finished_unknown_calls(frame.f_back)
+            if self.scope is not None and not self.scope.contains(frame):
+                self.enter_unknown_call(frame)
+                return
+        elif self.unknown_frames:
+            self.leave_finished_unknown_calls(frame)
         bytecode_events = list(self.btracer.trace(frame, event))
         if bytecode_events:
             for ev, args in bytecode_events:
@@ -204,6 +320,24 @@ class StandardTracer(object):
                 self.handle_bytecode_tracer_event(ev, args)
         return self.handle_standard_tracer_event(frame, event, arg)
 
+    def enter_unknown_call(self, frame):
+        # Calls between frames outside of the scope aren't interesting.
+        caller = frame.f_back
+        if caller is not None and self.scope.contains(caller):
+            self.unknown_frames.append(frame)
+            self.callback.unknown_called()
+
+    def leave_finished_unknown_calls(self, current_frame):
+        while self.unknown_frames and \
+                not is_frame_active(self.unknown_frames[-1], current_frame):
+            self.unknown_frames.pop()
+            self.callback.unknown_returned()
+
+    def importer_tracer(self, frame, event, arg):
+        if event == 'return':
+            self.importer_depth -= 1
+        return self.importer_tracer
+
     def handle_bytecode_tracer_event(self, event, args):
         if event == 'c_call':
             self.record_c_call(*args)
@@ -295,14 +429,59 @@ class StandardTracer(object):
     def record_call(self, frame):
         code = frame.f_code
         name = code.co_name
+        layout = self.get_arguments_layout(code)
 
         try:
-            obj, input = get_method_information(frame)
+            obj, input = self.get_method_information(frame, layout)
             return self.callback.method_called(name, obj, input, code, frame)
         except NotMethodFrame:
-            input = input_from_argvalues(*inspect.getargvalues(frame))
+            input = layout.input(frame.f_locals)
             return self.callback.function_called(name, input, code, frame)
 
+    def get_arguments_layout(self, code):
+        try:
+            return self.arguments_layouts[id(code)][1]
+        except KeyError:
+            layout = ArgumentsLayout(code)
+            self.arguments_layouts[id(code)] = (code, layout)
+            return layout
+
+    def get_method_information(self, frame, layout):
+        """Analyze the frame and return relevant information about the method
+        call it presumably represents.
+
+        Returns a tuple: (self_object, input_dictionary).
+
+        If the frame doesn't represent a method call, raises NotMethodFrame
+        exception.
+        """
+        locals = frame.f_locals
+        try:
+            obj = layout.first_argument(locals)
+            if not self.is_method_of(frame.f_code, obj):
+                raise NotMethodFrame
+            return (obj, layout.input_without_first_argument(locals))
+        except (AttributeError, KeyError, TypeError, IndexError):
+            raise NotMethodFrame
+
+    def is_method_of(self, code, obj):
+        """Tell whether the code is the code of a method obj has under
+        the code's name. Verdict is remembered for the class of obj.
+        """
+        key = (id(code), method_lookup_class(obj))
+        try:
+            return self.method_verdicts[key][1]
+        except KeyError:
+            try:
+                # Will raise AttributeError when the obj is None or doesn't
+                # have method with given name.
+                method_code = getattr(obj, code.co_name).im_func.func_code
+                verdict = method_code is code or method_code == code
+            except (AttributeError, KeyError, TypeError, IndexError):
+                verdict = False
+            self.method_verdicts[key] = (code, verdict)
+            return verdict
+
     def record_c_call(self, func, pargs, kargs):
         func_name = func.__name__
         obj = get_self_from_method(func)
@@ -388,6 +567,25 @@ class ICallback(object):
         """
         raise NotImplementedError("Method c_function_called() not defined.")
 
+    # :: () -> None
+    def unknown_called(self):
+        """Reported when code within the tracing scope calls code outside
+        of it. Events from inside of such call aren't reported, except for
+        calls it makes back into the scope.
+
+        Return value is ignored.
+        """
+        raise NotImplementedError("Method unknown_called() not defined.")
+
+    # :: () -> None
+    def unknown_returned(self):
+        """Reported when a call reported with unknown_called() is over.
+        Its return value and exceptions are not known.
+
+        Return value is ignored.
+        """
+        raise NotImplementedError("Method unknown_returned() not defined.")
+
     # :: object -> None
     def returned(self, output):
         """Reported when function or method returns.
@@ -9,7 +9,7 @@ import traceback
 import types
 import warnings
 
-from pythoscope.compat import groupby, set, sorted
+from pythoscope.compat import groupby, md5, set, sorted
 from pythoscope.py_wrapper_object import get_wrapper_self
 
 
@@ -176,6 +176,17 @@ def get_last_modification_time(path):
         # File may not exist, in which case it was never modified.
         return 0
 
+def get_content_digest(content):
+    return md5(content).hexdigest()
+
+def get_file_digest(path):
+    """Return digest of the file contents or None if the file cannot be read.
+    """
+    try:
+        return get_content_digest(read_file_contents(path))
+    except IOError:
+        return None
+
 def starts_with_path(path, prefix):
     """Return True if given path starts with given prefix and False otherwise.
     """
@@ -291,12 +302,12 @@ def get_self_from_method(method):
     elif is_method_wrapper(method):
         return get_wrapper_self(method)
 
-def compile_without_warnings(stmt):
-    """Compile single interactive statement with Python interpreter warnings
-    disabled.
+def compile_without_warnings(stmt, mode='single', flags=0):
+    """Compile single interactive statement (or a whole module, if mode is
+    'exec') with Python interpreter warnings disabled.
     """
     warnings.simplefilter('ignore')
-    code = compile(stmt, '', 'single')
+    code = compile(stmt, '', mode, flags)
     warnings.resetwarnings()
     return code
 
@@ -8,13 +8,16 @@ try:
     else:
         install_requires = []
     args = dict(
-        entry_points = {'console_scripts': ['pythoscope = pythoscope:main']},
+        entry_points = {'console_scripts': ['pythoscope = pythoscope:main',
+                                            'pythoscope-daemon = pythoscope.daemon:main']},
+        scripts = ['scripts/pythoscope-client'],
         install_requires = install_requires,
         test_suite = 'nose.collector',
         tests_require = ['nose', 'mock', 'docutils'])
 except ImportError:
     from distutils.core import setup
-    args = dict(scripts = ['scripts/pythoscope'])
+    args = dict(scripts = ['scripts/pythoscope', 'scripts/pythoscope-daemon',
+                           'scripts/pythoscope-client'])
 
 # The C module doesn't need to be built for Python 2.5 and higher.
 if sys.version_info < (2, 5):
@@ -1,4 +1,6 @@
-from pythoscope.astbuilder import parse, regenerate
+import threading
+
+from pythoscope.astbuilder import parse, regenerate, ParseError
 
 from assertions import *
 
@@ -8,3 +10,19 @@ class TestParser:
         tree = parse("42 # answer")
         assert_equal("42 # answer", regenerate(tree))
 
+    def test_can_parse_again_after_a_parse_error(self):
+        assert_raises(ParseError, lambda: parse("a b c"))
+        assert_equal("x = 1\n", regenerate(parse("x = 1\n")))
+
+    def test_can_be_used_from_many_threads_at_once(self):
+        results = {}
+        def parse_many(i):
+            code = "def function_%d(x):\n    return x + %d\n" % (i, i)
+            results[i] = [regenerate(parse(code)) == code for _ in range(50)]
+        threads = [threading.Thread(target=parse_many, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert_equal([[True] * 50] * 8, [results[i] for i in range(8)])
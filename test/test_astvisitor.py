@@ -111,3 +111,38 @@ class TestASTVisitorMainSnippet:
 
         TestVisitor().visit(parse(code))
         assert method_called[0], "visit_main_snippet wasn't called at all"
+
+class TestASTVisitorPatterns:
+    def test_compiles_patterns_once_for_all_visitors(self):
+        assert ASTVisitor().patterns is ASTVisitor().patterns
+
+    def test_registering_a_pattern_doesnt_affect_other_visitors(self):
+        visitor = ASTVisitor()
+        visitor.register_pattern('_visit_all', "simple_stmt< nodes=any* >")
+
+        assert_length(visitor.patterns, len(ASTVisitor.DEFAULT_PATTERNS) + 1)
+        assert_length(ASTVisitor().patterns, len(ASTVisitor.DEFAULT_PATTERNS))
+
+    def test_uses_registered_patterns_for_matching_nodes(self):
+        names = []
+        class TestVisitor(ASTVisitor):
+            def _visit_name(self, results):
+                names.append(results['name'].value)
+        visitor = TestVisitor()
+        visitor.register_pattern('_visit_name', "power< name=NAME trailer< '(' ')' > >")
+
+        visitor.visit(parse("def function():\n    something()\n"))
+
+        assert_equal(["something"], names)
+
+    def test_tries_patterns_matching_nodes_of_any_type_for_every_node(self):
+        names = []
+        class TestVisitor(ASTVisitor):
+            def _visit_name(self, results):
+                names.append(results['name'].value)
+        visitor = TestVisitor()
+        visitor.register_pattern('_visit_name', "any< name=NAME trailer< '(' ')' > >")
+
+        visitor.visit(parse("def function():\n    something()\n"))
+
+        assert_equal(["something"], names)
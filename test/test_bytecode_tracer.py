@@ -1,17 +1,21 @@
 import cPickle
 import dis
 import os
+import re
 import shutil
 import sys
 import tempfile
 
+from StringIO import StringIO
+
 from nose import SkipTest
 from nose.tools import assert_equal
 
 from pythoscope.store import CodeTree
 from pythoscope.util import write_content_to_file
 
-from bytecode_tracer import BytecodeTracer, rewrite_function
+from bytecode_tracer import BytecodeTracer, has_been_rewritten, rewrite_function,\
+    rewrite_cache
 
 
 return_value = None
@@ -39,7 +43,7 @@ class TestBytecodeTracer:
 
     def trace_function(self, fun):
         dis.dis(fun.func_code)
-        rewrite_function(fun)
+        rewrite_function(fun, self.btracer.selective)
         self.btracer.setup()
         sys.settrace(self._trace)
         try:
@@ -544,7 +548,162 @@ class TestBytecodeTracerGlobalAccessAndRebinding(TestBytecodeTracer):
         self.trace_function(fun)
         self.assert_trace(('delete_global', ('test.test_bytecode_tracer', 'return_value')))
 
+    def test_finds_module_which_name_doesnt_match_its_key_in_sys_modules(self):
+        global return_value
+        return_value = 42
+        def fun():
+            return return_value
+        old_name = __name__
+        globals()['__name__'] = 'test.no_such_module'
+        try:
+            self.trace_function(fun)
+        finally:
+            globals()['__name__'] = old_name
+        self.assert_trace(('load_global', ('test.no_such_module', 'return_value', 42)))
+
+    def test_ignores_global_variables_of_code_executed_outside_of_modules(self):
+        namespace = {'return_value': 42}
+        exec "def fun():\n    return return_value\n" in namespace
+        self.trace_function(namespace['fun'])
+        self.trace_function(namespace['fun'])
+        self.assert_trace()
+
+class TestSelectiveRewriting(TestBytecodeTracer):
+    """Tracing code with only the interesting bytecodes marked as new lines
+    should report exactly the same events as tracing code with every byte
+    marked, only with fewer line events.
+    """
+    def setup(self):
+        TestBytecodeTracer.setup(self)
+        self._ignored_events = []
+        self._line_events_count = 0
+
+    def _trace(self, frame, event, arg):
+        if event == 'line':
+            self._line_events_count += 1
+        return TestBytecodeTracer._trace(self, frame, event, arg)
+
+    def _trace_in_mode(self, make_function, selective):
+        self.setup()
+        self.btracer = BytecodeTracer(selective)
+        self.trace_function(make_function())
+        # Functions are created anew for each mode, so compare them by name.
+        return re.sub(r" at 0x[0-9a-f]+", "", repr(self._traces)), \
+            self._line_events_count
+
+    def assert_same_events(self, make_function):
+        full_traces, full_count = self._trace_in_mode(make_function, False)
+        selective_traces, selective_count = self._trace_in_mode(make_function, True)
+        assert full_traces != "[]"
+        assert_equal(full_traces, selective_traces)
+        assert selective_count < full_count
+
+    def test_reports_the_same_events_for_calls_with_all_kinds_of_arguments(self):
+        def make_function():
+            def fun():
+                args, kwds = [1, 2], {'b': 3}
+                max(1, 2)
+                dict(a=1, **kwds)
+                max(*args)
+                len(str(abs(-5)))
+            return fun
+        self.assert_same_events(make_function)
+
+    def test_reports_the_same_events_for_loops(self):
+        def make_function():
+            def fun():
+                for i in range(4):
+                    if i == 1:
+                        continue
+                    abs(-i)
+                else:
+                    abs(-4)
+                i = 0
+                while True:
+                    i = max(i, 1) + 1
+                    if i > 3:
+                        break
+                [abs(j) for j in range(-2, 1)]
+            return fun
+        self.assert_same_events(make_function)
+
+    def test_reports_the_same_events_for_exceptions(self):
+        def make_function():
+            def other(x):
+                return int(x)
+            def fun():
+                try:
+                    int("a")
+                except ValueError:
+                    abs(-1)
+                try:
+                    try:
+                        map(other, ["1", "b"])
+                    finally:
+                        abs(-2)
+                except ValueError:
+                    pass
+                abs(-3)
+            return fun
+        self.assert_same_events(make_function)
+
+    def test_reports_the_same_events_for_generators(self):
+        def make_function():
+            def gen():
+                for i in range(3):
+                    yield abs(-i)
+                    x = yield
+            def fun():
+                list(gen())
+                for value in gen():
+                    str(value)
+            return fun
+        self.assert_same_events(make_function)
+
+    def test_reports_the_same_events_for_callbacks_from_c_functions(self):
+        def make_function():
+            def other(x):
+                return abs(x)
+            def fun():
+                map(other, [-1, 0, 1])
+                sorted([3, 1, 2], key=lambda x: abs(-x))
+            return fun
+        self.assert_same_events(make_function)
+
+    def test_reports_the_same_events_for_prints_attributes_and_globals(self):
+        output = StringIO()
+        class Class(object):
+            pass
+        obj = Class()
+        def make_function():
+            def fun():
+                global return_value
+                print >>output, "foo", abs(-1)
+                obj.x = return_value = abs(-2)
+                del obj.x
+                str(return_value)
+                del return_value
+            return fun
+        self.assert_same_events(make_function)
+
+    def test_reports_the_same_events_for_long_functions(self):
+        # Each "x = x + 1" line takes 10 bytes, so the distance between
+        # interesting bytecodes doesn't fit into a single line table entry.
+        source = "def fun():\n" \
+                 "    for i in range(3):\n" \
+                 "        x = abs(-i)\n" + \
+                 "        x = x + 1\n" * 60 + \
+                 "        str(x)\n"
+        def make_function():
+            namespace = {}
+            exec source in namespace
+            return namespace['fun']
+        self.assert_same_events(make_function)
+
 class TestRewriteFunction:
+    def setup(self):
+        rewrite_cache.clear()
+
     def test_handles_functions_with_free_variables(self):
         x = 1
         def fun():
@@ -560,6 +719,36 @@ class TestRewriteFunction:
         rewrite_function(meth)
         assert_equal(meth(1), 2)
 
+    def test_recognizes_functions_rewritten_in_both_modes(self):
+        def fun():
+            return abs(-1)
+        def other():
+            return abs(-1)
+        rewrite_function(fun, selective=True)
+        rewrite_function(other, selective=False)
+        assert has_been_rewritten(fun.func_code)
+        assert has_been_rewritten(other.func_code)
+        assert_equal(fun.func_code.co_lnotab, "\x06\x01\x03\x01")
+
+    def test_rewrites_code_shared_by_functions_only_once(self):
+        def make_function():
+            def fun():
+                return abs(-1)
+            return fun
+        fun, other = make_function(), make_function()
+        rewrite_function(fun)
+        rewrite_function(other)
+        rewrite_function(other)
+        assert fun.func_code is other.func_code
+        assert_equal((2, 1), (rewrite_cache.hits, rewrite_cache.misses))
+
+    def test_recognizes_code_rewritten_before_the_cache_was_cleared(self):
+        def fun():
+            pass
+        rewrite_function(fun)
+        rewrite_cache.clear()
+        assert has_been_rewritten(fun.func_code)
+
 class TestImportSupportWithOtherModules(TestBytecodeTracer):
     def test_support_with_pickle(self):
         self.btracer.setup()
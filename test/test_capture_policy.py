@@ -0,0 +1,69 @@
+import random
+
+from pythoscope.capture_policy import CapturePolicy, FirstCalls, SampledCalls,\
+    UniqueCalls, capture_policy_from_spec
+
+from assertions import *
+
+
+class TestFirstCalls:
+    def test_admits_given_number_of_units_of_each_key(self):
+        policy = FirstCalls(2)
+
+        assert_equal([True, True, False], [policy.admit('f', {}) for i in range(3)])
+        assert policy.admit('g', {})
+
+class TestSampledCalls:
+    def setUp(self):
+        self.policy = SampledCalls(3, random.Random(42))
+
+    def _capture(self, units):
+        captured = []
+        for unit in units:
+            if self.policy.admit('f', {}):
+                captured.append(unit)
+                evicted = self.policy.captured('f', unit)
+                if evicted is not None:
+                    captured.remove(evicted)
+        return captured
+
+    def test_admits_all_units_until_the_sample_is_full(self):
+        assert_equal([1, 2, 3], self._capture([1, 2, 3]))
+
+    def test_keeps_sample_of_given_size(self):
+        captured = self._capture(range(1000))
+
+        assert_length(captured, 3)
+        assert_equal_sets(captured, self.policy.reservoirs['f'])
+
+    def test_doesnt_favor_first_units(self):
+        assert_not_equal([0, 1, 2], sorted(self._capture(range(1000))))
+
+class TestUniqueCalls:
+    def test_admits_only_units_with_distinct_input_signatures(self):
+        policy = UniqueCalls()
+
+        assert policy.admit('f', {'x': 1})
+        assert not policy.admit('f', {'x': 1})
+        assert policy.admit('f', {'x': 2})
+        assert policy.admit('g', {'x': 1})
+
+    def test_compares_other_objects_by_their_classes(self):
+        policy = UniqueCalls()
+
+        assert policy.admit('f', {'x': object()})
+        assert not policy.admit('f', {'x': object()})
+        assert policy.admit('f', {'x': [1]})
+        assert not policy.admit('f', {'x': [2]})
+
+class TestCapturePolicyFromSpec:
+    def test_creates_policies_from_their_descriptions(self):
+        assert_instance(capture_policy_from_spec(None), CapturePolicy)
+        assert_instance(capture_policy_from_spec('all'), CapturePolicy)
+        assert_instance(capture_policy_from_spec('unique'), UniqueCalls)
+        assert_equal(10, capture_policy_from_spec('first:10').limit)
+        assert_equal(5, capture_policy_from_spec('sample:5').size)
+
+    def test_rejects_invalid_descriptions(self):
+        for spec in ['first', 'first:', 'first:0', 'sample:x', 'everything']:
+            assert_raises(ValueError, lambda: capture_policy_from_spec(spec))
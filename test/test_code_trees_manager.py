@@ -1,11 +1,11 @@
 import gc
 import os.path
-
-from mock import Mock
+import pickle
 
 from pythoscope.code_trees_manager import CodeTreeNotFound, \
     FilesystemCodeTreesManager
 from pythoscope.store import CodeTree, Module
+from pythoscope.util import read_file_contents, write_content_to_file
 
 from assertions import *
 from helper import TempDirectory
@@ -14,13 +14,13 @@ from helper import TempDirectory
 class TestFilesystemCodeTreesManager(TempDirectory):
     def setUp(self):
         super(TestFilesystemCodeTreesManager, self).setUp()
-        self.manager = FilesystemCodeTreesManager(self.tmpdir)
+        self.manager = FilesystemCodeTreesManager(self.tmpdir, max_entries=1)
 
     def assert_empty_cache(self):
-        assert_equal(None, self.manager._cached_code_tree)
+        assert_equal([], self.manager._lru)
 
-    def assert_cache(self, module_subpath):
-        assert_equal(module_subpath, self.manager._cached_code_tree[0])
+    def assert_cache(self, *module_subpaths):
+        assert_equal(list(module_subpaths), self.manager._lru)
 
     def assert_recalled_tree(self, module_subpath, code):
         assert_equal(code, self.manager.recall_code_tree(module_subpath).code)
@@ -32,12 +32,14 @@ class TestFilesystemCodeTreesManager(TempDirectory):
     def assert_code_tree_not_saved(self, module_subpath):
         self.assert_code_tree_saved(module_subpath, saved=False)
 
-    def assert_calls_once(self, mock, callback):
-        """Assert that given callback calls given Mock object exactly once.
+    def assert_code_tree_file_rewritten(self, module_subpath, callback, rewritten=True):
+        """Assert that given callback writes the code tree file of a module
+        (or doesn't, if `rewritten` is False).
         """
-        before_count = mock.call_count
+        path = self.manager._code_tree_path(module_subpath)
+        write_content_to_file("sentinel", path)
         callback()
-        assert_equal(before_count + 1, mock.call_count)
+        assert_equal(rewritten, read_file_contents(path) != "sentinel")
 
     def test_remembered_code_trees_can_be_recalled(self):
         code_tree = CodeTree(None)
@@ -81,6 +83,16 @@ class TestFilesystemCodeTreesManager(TempDirectory):
         self.assert_recalled_tree("module2.py", 2)
         self.assert_cache("module2.py")
 
+    def test_evicts_code_trees_that_dont_fit_in_the_cache_after_limits_change(self):
+        self.manager.set_cache_limits(3, None)
+        for i in range(3):
+            self.manager.remember_code_tree(CodeTree(i), "module%d.py" % i)
+        self.assert_cache("module0.py", "module1.py", "module2.py")
+
+        self.manager.set_cache_limits(2, None)
+
+        self.assert_cache("module1.py", "module2.py")
+
     def test_remembering_code_tree_saves_it_to_the_filesystem(self):
         code_tree = CodeTree(None)
         self.manager.remember_code_tree(code_tree, "module.py")
@@ -93,13 +105,64 @@ class TestFilesystemCodeTreesManager(TempDirectory):
         self.manager.forget_code_tree("module.py")
         self.assert_code_tree_not_saved("module.py")
 
-    def test_when_clearing_cache_code_tree_currently_in_cache_is_saved_to_the_filesystem(self):
+    def test_when_clearing_cache_changed_code_tree_currently_in_cache_is_saved_to_the_filesystem(self):
         code_tree = CodeTree(None)
-        code_tree.save = Mock()
         self.manager.remember_code_tree(code_tree, "module.py")
         self.assert_cache("module.py")
+        code_tree.code = "changed"
+        code_tree.mark_dirty()
+
+        self.assert_code_tree_file_rewritten("module.py", self.manager.clear_cache)
+        self.assert_recalled_tree("module.py", "changed")
+
+    def test_when_clearing_cache_unchanged_code_tree_is_not_saved_to_the_filesystem(self):
+        self.manager.remember_code_tree(CodeTree(None), "module.py")
+
+        self.assert_code_tree_file_rewritten("module.py", self.manager.clear_cache,
+                                             rewritten=False)
+
+    def test_when_clearing_cache_clean_code_tree_is_not_pickled_at_all(self):
+        code_tree = CodeTree(None)
+        self.manager.remember_code_tree(code_tree, "module.py")
+        size = self.manager._cache["module.py"].size
+        # Changed, but not marked as dirty.
+        code_tree.code = "changed"
+
+        self.assert_code_tree_file_rewritten("module.py", self.manager.clear_cache,
+                                             rewritten=False)
+        assert_equal(size, self.manager.bytes_not_written)
+
+    def test_code_tree_modified_with_add_object_is_saved_when_cleared_from_cache(self):
+        self.manager.remember_code_tree(CodeTree(None), "module.py")
+        code_tree = self.manager.recall_code_tree("module.py")
+        code_tree.add_object("main_snippet", "code")
+
+        self.assert_code_tree_file_rewritten("module.py", self.manager.clear_cache)
 
-        self.assert_calls_once(code_tree.save, self.manager.clear_cache)
+    def test_flushing_saves_changed_code_trees_and_keeps_them_in_cache(self):
+        code_tree = CodeTree(None)
+        self.manager.remember_code_tree(code_tree, "module.py")
+        code_tree.code = "changed"
+        code_tree.mark_dirty()
+
+        self.assert_code_tree_file_rewritten("module.py", self.manager.flush)
+        self.assert_cache("module.py")
+        assert not code_tree.dirty
+
+    def test_pickled_manager_doesnt_include_cached_code_trees(self):
+        self.manager.remember_code_tree(CodeTree(None), "module.py")
+
+        manager = pickle.loads(pickle.dumps(self.manager))
+
+        assert_equal([], manager._lru)
+        assert_equal(0, manager._cached_bytes)
+        assert_equal(None, manager.recall_code_tree("module.py").code)
+
+    def test_recalled_code_trees_are_clean(self):
+        self.manager.remember_code_tree(CodeTree(None), "module.py")
+        self.manager.clear_cache()
+
+        assert not self.manager.recall_code_tree("module.py").dirty
 
     def test_code_tree_not_in_cache_can_be_garbage_collected(self):
         code_tree = CodeTree(None)
@@ -111,3 +174,41 @@ class TestFilesystemCodeTreesManager(TempDirectory):
 
         # No longer referred from the CodeTreesManager.
         assert_length(gc.get_referrers(code_tree), 1)
+
+class TestFilesystemCodeTreesManagerWithLargerCache(TempDirectory):
+    def setUp(self):
+        super(TestFilesystemCodeTreesManagerWithLargerCache, self).setUp()
+        self.manager = FilesystemCodeTreesManager(self.tmpdir, max_entries=2,
+                                                  max_bytes=None)
+        for i in range(3):
+            self.manager.remember_code_tree(CodeTree(i), "module%d.py" % i)
+
+    def test_keeps_the_most_recently_used_code_trees(self):
+        assert_equal(["module1.py", "module2.py"], self.manager._lru)
+
+        self.manager.recall_code_tree("module1.py")
+        assert_equal(["module2.py", "module1.py"], self.manager._lru)
+
+        self.manager.recall_code_tree("module0.py")
+        assert_equal(["module1.py", "module0.py"], self.manager._lru)
+
+    def test_counts_hits_misses_and_evictions(self):
+        self.manager.recall_code_tree("module2.py")
+        self.manager.recall_code_tree("module0.py")
+        self.manager.recall_code_tree("module0.py")
+
+        assert_equal(2, self.manager.hits)
+        assert_equal(1, self.manager.misses)
+        assert_equal(2, self.manager.evictions)
+
+    def test_evicts_code_trees_when_bytes_limit_is_exceeded(self):
+        self.manager.max_bytes = self.manager._cache["module2.py"].size
+        self.manager.recall_code_tree("module0.py")
+
+        assert_equal(["module0.py"], self.manager._lru)
+
+    def test_keeps_the_most_recently_used_code_tree_even_if_it_exceeds_the_bytes_limit(self):
+        self.manager.max_bytes = 1
+        self.manager.recall_code_tree("module0.py")
+
+        assert_equal(["module0.py"], self.manager._lru)
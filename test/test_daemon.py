@@ -0,0 +1,114 @@
+import os
+import socket
+
+from pythoscope.cmdline import init_project
+from pythoscope.daemon import Daemon, read_request
+from pythoscope.store import Project
+
+from nose import SkipTest
+
+from assertions import *
+from helper import CapturedLogger, P, TempDirectory, putfile
+
+
+class TestDaemon(CapturedLogger, TempDirectory):
+    def setUp(self):
+        if not hasattr(socket, 'socketpair'):
+            raise SkipTest("Daemon tests require socket.socketpair.")
+        super(TestDaemon, self).setUp()
+        init_project(self.tmpdir, skip_inspection=True)
+        self.daemon = Daemon(self.tmpdir)
+
+    def _request(self, *fields):
+        """Send a request to the daemon and return its status and output.
+        """
+        client, server = socket.socketpair()
+        try:
+            client.sendall("\0".join(fields))
+            client.shutdown(socket.SHUT_WR)
+            self.daemon.handle_connection(server)
+            server.close()
+            status, output = "".join(read_request(client)).split("\n", 1)
+        finally:
+            client.close()
+        return int(status), output
+
+    def test_generates_tests_for_given_modules(self):
+        module_path = putfile(self.tmpdir, "module.py", "def function(x):\n    pass\n")
+
+        status, output = self._request("generate", "INFO", "0", "unittest", module_path)
+
+        assert_equal(0, status)
+        assert_contains(output, "Adding generated")
+        assert os.path.exists(os.path.join(self.tmpdir, P("tests/test_module.py")))
+
+    def test_reports_errors_with_nonzero_status(self):
+        module_path = putfile(self.tmpdir, "module.py", "")
+
+        status, output = self._request("generate", "INFO", "0", "nonexistent", module_path)
+
+        assert_equal(1, status)
+        assert_contains(output, "ERROR")
+
+    def test_rejects_unknown_commands(self):
+        status, output = self._request("rewind", "INFO")
+
+        assert_equal(1, status)
+        assert_contains(output, "Unknown daemon command 'rewind'")
+
+    def test_uses_requested_log_level_for_request_output(self):
+        putfile(self.tmpdir, "module.py", "def function(x):\n    pass\n")
+
+        status, output = self._request("inspect", "ERROR")
+
+        assert_equal(0, status)
+        assert_equal("", output)
+
+    def test_inspects_changed_modules_while_idle(self):
+        putfile(self.tmpdir, "module.py", "def function(x):\n    pass\n")
+
+        self.daemon.refresh()
+
+        assert_equal(["function"], [f.name for f in self.daemon.project["module"].functions])
+        assert_equal(1, self.daemon.pending_updates)
+
+    def test_reloads_project_saved_by_someone_else(self):
+        old_project = self.daemon.project
+        project = Project.from_directory(self.tmpdir)
+        putfile(self.tmpdir, "module.py", "")
+        project.create_module(os.path.join(self.tmpdir, "module.py"), code=None)
+        project.save()
+        # Make sure the modification time changes.
+        os.utime(os.path.join(self.tmpdir, P(".pythoscope/project.pickle")),
+                 (1, 1))
+
+        self.daemon.refresh()
+
+        assert self.daemon.project is not old_project
+        assert_contains(self.daemon.project.get_modules()[0].subpath, "module.py")
+
+    def test_survives_clients_going_away_before_the_reply(self):
+        client, server = socket.socketpair()
+        try:
+            client.sendall("inspect\0INFO")
+            client.close()
+            self.daemon.handle_connection(server)
+        finally:
+            server.close()
+
+        assert_contains(self._get_log_output(), "Couldn't send the reply")
+
+    def test_logs_errors_of_idle_refreshes(self):
+        def refresh():
+            raise EOFError("project is being saved")
+        self.daemon.refresh = refresh
+
+        self.daemon.refresh_while_idle()
+
+        assert_contains(self._get_log_output(), "EOFError: project is being saved")
+
+    def test_stops_on_request(self):
+        status, _ = self._request("stop", "INFO")
+
+        assert_equal(0, status)
+        assert self.daemon.stopped
@@ -3,13 +3,14 @@ import sys
 
 from nose import SkipTest
 
+from pythoscope.capture_policy import FirstCalls
 from pythoscope.inspector.static import inspect_code
 from pythoscope.inspector.dynamic import inspect_code_in_context,\
     inspect_point_of_entry
 from pythoscope.serializer import BuiltinException, ImmutableObject,\
     SequenceObject, MapObject, LibraryObject
 from pythoscope.store import Class, Function, FunctionCall, GeneratorObject,\
-    GeneratorObjectInvocation, Method, UserObject
+    GeneratorObjectInvocation, Method, UnknownCall, UserObject
 from pythoscope.compat import all
 from pythoscope.util import findfirst, generator_has_ended
 
@@ -17,7 +18,7 @@ from assertions import *
 from inspector_assertions import *
 from inspector_helper import *
 from helper import ProjectInDirectory, PointOfEntryMock, EmptyProjectExecution, \
-    IgnoredWarnings, putfile, TempDirectory, CapturedLogger, noindent
+    IgnoredWarnings, P, putfile, TempDirectory, CapturedLogger, noindent
 from testing_project import TestingProject
 
 
@@ -187,6 +188,12 @@ def function_calling_methods_with_strangely_named_self():
     Class().strange_method()
     Class().another_strange_method()
 
+def function_calling_method_with_varargs_only():
+    class Class(object):
+        def method(*args):
+            return len(args)
+    return Class().method(1)
+
 def function_calling_two_methods_with_the_same_name_from_different_classes():
     class FirstClass(object):
         def method(self):
@@ -392,6 +399,11 @@ class TestTraceFunction:
         assert_equal_sets(['strange_method', 'another_strange_method'],
                           [obj.calls[0].definition.name for obj in callables])
 
+    def test_passes_self_in_varargs_of_traced_methods(self):
+        user_object = inspect_returning_single_callable(function_calling_method_with_varargs_only)
+
+        assert_call({'args': (1,)}, 2, user_object.calls[0])
+
     def test_distinguishes_between_methods_with_the_same_name_from_different_classes(self):
         callables = inspect_returning_callables(function_calling_two_methods_with_the_same_name_from_different_classes)
 
@@ -1032,9 +1044,20 @@ class TestTraceExec:
         assert_call({'x': 5},  6,  function.calls[0])
         assert_call({'x': 42}, 43, function.calls[1])
 
+class CountingFirstCalls(FirstCalls):
+    def __init__(self, limit):
+        FirstCalls.__init__(self, limit)
+        self.questions = 0
+
+    def admit(self, key, args):
+        self.questions += 1
+        return FirstCalls.admit(self, key, args)
+
 class TestInspectPointOfEntry(TempDirectory):
-    def _init_project(self, module_code="", poe_content=""):
+    def _init_project(self, module_code="", poe_content="", capture_policy=None):
         self.project = ProjectInDirectory(self.tmpdir)
+        if capture_policy is not None:
+            self.project.use_capture_policy(capture_policy)
         putfile(self.project.path, "module.py", module_code)
         inspect_code(self.project, os.path.join(self.project.path, "module.py"), module_code)
         self.poe = PointOfEntryMock(self.project, content=poe_content)
@@ -1062,6 +1085,16 @@ class TestInspectPointOfEntry(TempDirectory):
         call = assert_one_element_and_return(user_object.calls)
         assert_call({'x': 42}, 43, call)
 
+    def test_traces_calls_made_after_a_failed_import(self):
+        self._init_project("def function(x):\n  return x + 1\n",
+                           "try:\n  import broken\nexcept ValueError:\n  pass\n"
+                           "from module import function\nfunction(42)\n")
+        putfile(self.project.path, "broken.py", "raise ValueError\n")
+
+        inspect_point_of_entry(self.poe)
+
+        assert_length(self.project["module"].functions[0].calls, 1)
+
     def test_properly_wipes_out_imports_from_sys_modules(self):
         self._init_project(poe_content="import module")
 
@@ -1069,6 +1102,134 @@ class TestInspectPointOfEntry(TempDirectory):
 
         assert 'module' not in sys.modules
 
+    def test_reports_calls_outside_of_the_project_as_unknown(self):
+        self._init_project("from lib import call_twice\n"
+                           "def inner(x):\n  return x + 1\n"
+                           "def outer():\n  return call_twice(inner, 1)\n",
+                           "from module import outer\nouter()\n")
+        putfile(self.project.path, "lib.py",
+                "def call_twice(f, x):\n  return f(abs(f(x)))\n")
+
+        inspect_point_of_entry(self.poe)
+
+        inner, outer = self.project["module"].functions
+        unknown_call = assert_one_element_and_return(outer.calls[0].subcalls)
+        assert_instance(unknown_call, UnknownCall)
+        # Calls made by the unknown code to C functions are not traced.
+        assert_equal(inner.calls, unknown_call.subcalls)
+        assert_call({'x': 2}, 3, inner.calls[1])
+
+    def test_notices_end_of_unknown_calls_without_their_return_events(self):
+        self._init_project("from lib import identity\n"
+                           "def inner(x):\n  return x + 1\n"
+                           "def outer():\n  return inner(identity(1)) + inner(2)\n",
+                           "from module import outer\nouter()\n")
+        putfile(self.project.path, "lib.py", "def identity(x):\n  return x\n")
+
+        inspect_point_of_entry(self.poe)
+
+        inner, outer = self.project["module"].functions
+        subcalls = outer.calls[0].subcalls
+        assert_equal([UnknownCall, FunctionCall, FunctionCall], map(type, subcalls))
+        assert_equal([], subcalls[0].subcalls)
+
+    def test_doesnt_trace_modules_excluded_from_tracing(self):
+        self._init_project("def function(x):\n  return x + 1\n",
+                           "from module import function\nfunction(42)\n")
+        putfile(self.project.path, P(".pythoscope/tracing"), "-module\n")
+
+        inspect_point_of_entry(self.poe)
+
+        assert_length(self.project["module"].functions[0].calls, 0)
+
+    def test_captures_only_calls_admitted_by_the_capture_policy(self):
+        self._init_project("def function(x):\n  return x + 1\n",
+                           "from module import function\n"
+                           "for x in [1, 1, 2, 3]:\n  function(x)\n",
+                           capture_policy="first:2")
+
+        inspect_point_of_entry(self.poe)
+
+        function = self.project["module"].functions[0]
+        assert_equal(['1', '1'], [call.input['x'].reconstructor for call in function.calls])
+        assert_equal(function.calls, self.poe.execution.captured_calls)
+
+    def test_captures_calls_with_distinct_inputs_with_unique_policy(self):
+        self._init_project("def function(x):\n  return x + 1\n",
+                           "from module import function\n"
+                           "for x in [1, 1, 2, 1]:\n  function(x)\n",
+                           capture_policy="unique")
+
+        inspect_point_of_entry(self.poe)
+
+        function = self.project["module"].functions[0]
+        assert_equal(['1', '2'], [call.input['x'].reconstructor for call in function.calls])
+
+    def test_keeps_calls_evicted_by_the_capture_policy_out_of_the_call_graph(self):
+        self._init_project("def function(x):\n  return x + 1\n",
+                           "from module import function\n"
+                           "for x in range(100):\n  function(x)\n",
+                           capture_policy="sample:3")
+
+        inspect_point_of_entry(self.poe)
+
+        function = self.project["module"].functions[0]
+        assert_length(function.calls, 3)
+        assert_equal_sets(map(id, function.calls),
+            [id(call) for call in self.poe.execution.call_graph
+             if isinstance(call, FunctionCall)])
+
+    def test_records_calls_made_inside_dropped_calls_under_their_caller(self):
+        self._init_project("seen = []\n"
+                           "def inner(x):\n  return x\n"
+                           "def outer(x):\n  seen.append(x)\n  return inner(len(seen))\n",
+                           "from module import outer\nouter(1)\nouter(1)\n",
+                           capture_policy="unique")
+
+        inspect_point_of_entry(self.poe)
+
+        inner, outer = self.project["module"].functions
+        assert_length(outer.calls, 1)
+        assert_equal([id(inner.calls[0])], [id(call) for call in outer.calls[0].subcalls
+                                            if isinstance(call, FunctionCall)])
+        assert_equal(None, inner.calls[1].caller)
+        assert_equal([id(outer.calls[0]), id(inner.calls[1])],
+                     [id(call) for call in self.poe.execution.call_graph
+                      if isinstance(call, FunctionCall)])
+
+    def test_applies_capture_policy_to_whole_user_objects(self):
+        self._init_project("class SomeClass(object):\n"
+                           "  def __init__(self, x): self.x = x\n"
+                           "  def method(self): return self.x\n",
+                           "from module import SomeClass\n"
+                           "for x in range(10):\n  SomeClass(x).method()\n",
+                           capture_policy="sample:2")
+
+        inspect_point_of_entry(self.poe)
+
+        klass = self.project["module"].classes[0]
+        assert_length(klass.user_objects, 2)
+        for user_object in klass.user_objects:
+            assert_equal(['__init__', 'method'],
+                         [call.definition.name for call in user_object.calls])
+        assert_length(self.poe.execution.captured_calls, 4)
+
+    def test_asks_capture_policy_once_about_objects_without_weak_references(self):
+        self._init_project("class SomeClass(object):\n"
+                           "  __slots__ = ['x']\n"
+                           "  def __init__(self, x): self.x = x\n"
+                           "  def method(self): return self.x\n",
+                           "from module import SomeClass\n"
+                           "for x in range(2):\n"
+                           "  obj = SomeClass(x)\n  obj.method()\n  obj.method()\n")
+        policy = self.poe.execution.capture_policy = CountingFirstCalls(1)
+
+        inspect_point_of_entry(self.poe)
+
+        klass = self.project["module"].classes[0]
+        assert_length(klass.user_objects, 1)
+        assert_equal(2, policy.questions)
+
 class TestInspectPointOfEntryWithCapturedLog(TempDirectory, CapturedLogger):
     def test_changes_current_directory_to_the_projects_root(self):
         project = ProjectInDirectory(self.tmpdir)
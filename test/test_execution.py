@@ -0,0 +1,84 @@
+import os
+import pickle
+
+from pythoscope.execution import Execution
+from pythoscope.store import Class, Function
+
+from assertions import *
+from helper import EmptyProject
+
+
+class Old:
+    pass
+
+class New(object):
+    # Pretend it's been defined in the project module.
+    __module__ = "module"
+
+class TestDefinitionLookups:
+    def setUp(self):
+        self.project = EmptyProject().with_module("module.py",
+            objects=[Function("function"), Class("New")])
+        self.execution = Execution(self.project)
+        self.code = compile("def function(): pass\n",
+                            os.path.join(self.project.path, "module.py"), "exec")
+        self.lookups = []
+        find_object = self.project.find_object
+        def counting_find_object(type, name, modulename):
+            self.lookups.append(name)
+            return find_object(type, name, modulename)
+        self.project.find_object = counting_find_object
+
+    def _replace_module(self):
+        self.project.with_module("module.py",
+            objects=[Function("function"), Class("New")])
+        return self.project["module"]
+
+    def test_finds_function_only_once_per_code_object(self):
+        function = self.execution.find_function("function", self.code)
+
+        assert_equal(self.project["module"].find_object(Function, "function"), function)
+        assert function is self.execution.find_function("function", self.code)
+        assert_equal(["function"], self.lookups)
+
+    def test_remembers_code_outside_of_the_project(self):
+        code = compile("pass\n", "/elsewhere/module.py", "exec")
+
+        assert_equal(None, self.execution.find_function("function", code))
+        assert_equal(None, self.execution.find_function("function", code))
+        assert_equal([], self.lookups)
+
+    def test_finds_function_again_after_its_module_is_replaced(self):
+        old_function = self.execution.find_function("function", self.code)
+        new_function = self._replace_module().find_object(Function, "function")
+
+        assert new_function is not old_function
+        assert new_function is self.execution.find_function("function", self.code)
+
+    def test_finds_class_only_once_per_python_class(self):
+        klass = self.execution.find_class_of(New())
+
+        assert_equal(self.project["module"].find_object(Class, "New"), klass)
+        assert klass is self.execution.find_class_of(New())
+        assert_equal(1, len(self.lookups))
+
+    def test_remembers_classes_outside_of_the_project(self):
+        assert_equal(None, self.execution.find_class_of(Old()))
+        assert_equal(None, self.execution.find_class_of(Old()))
+        assert_equal(None, self.execution.find_class_of(123))
+        assert_equal(2, len(self.lookups))
+
+    def test_finds_class_again_after_its_module_is_replaced(self):
+        old_class = self.execution.find_class_of(New())
+        new_class = self._replace_module().find_object(Class, "New")
+
+        assert new_class is not old_class
+        assert new_class is self.execution.find_class_of(New())
+
+    def test_doesnt_pickle_lookup_tables(self):
+        self.execution.find_function("function", self.code)
+        del self.project.find_object
+
+        execution = pickle.loads(pickle.dumps(self.execution))
+
+        assert not hasattr(execution, '_functions_by_code')
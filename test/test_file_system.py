@@ -0,0 +1,94 @@
+import os
+
+from pythoscope.inspector.file_system import python_modules_below, \
+    read_excludes, read_tracing_globs, write_excludes, WalkStatistics, \
+    DEFAULT_EXCLUDES
+
+from assertions import *
+from helper import P, TempDirectory, putfile, putdir
+
+
+class TestPythonModulesBelow(TempDirectory):
+    def _modules_below(self, excludes=DEFAULT_EXCLUDES, statistics=None):
+        paths = python_modules_below(self.tmpdir, excludes, statistics)
+        return [path[len(self.tmpdir)+1:] for path in paths]
+
+    def test_finds_python_modules_in_nested_directories(self):
+        putfile(self.tmpdir, "module.py", "")
+        putfile(self.tmpdir, P("package/__init__.py"), "")
+        putfile(self.tmpdir, P("package/sub/module.py"), "")
+        putfile(self.tmpdir, "README", "")
+
+        assert_equal_sets(["module.py", P("package/__init__.py"), P("package/sub/module.py")],
+                          self._modules_below())
+
+    def test_ignores_files_and_directories_beginning_with_a_dot(self):
+        putfile(self.tmpdir, P(".hg/module.py"), "")
+        putfile(self.tmpdir, ".hidden.py", "")
+
+        assert_equal([], self._modules_below())
+
+    def test_ignores_virtualenv_and_packaging_directories_by_default(self):
+        putfile(self.tmpdir, P("venv/lib/python2.7/site-packages/nose/core.py"), "")
+        putfile(self.tmpdir, P("module.egg-info/module.py"), "")
+        putfile(self.tmpdir, "module.py", "")
+
+        assert_equal(["module.py"], self._modules_below())
+
+    def test_doesnt_ignore_generically_named_directories_by_default(self):
+        putfile(self.tmpdir, P("build/__init__.py"), "")
+        putfile(self.tmpdir, P("dist/__init__.py"), "")
+
+        assert_equal_sets([P("build/__init__.py"), P("dist/__init__.py")],
+                          self._modules_below())
+
+    def test_matches_globs_with_separators_against_relative_paths(self):
+        putfile(self.tmpdir, P("docs/examples/example.py"), "")
+        putfile(self.tmpdir, P("examples/example.py"), "")
+
+        assert_equal([P("examples/example.py")],
+                     self._modules_below([P("docs/examples")]))
+
+    def test_prunes_excluded_directories_without_listing_them(self):
+        putfile(self.tmpdir, P("build/lib/module.py"), "")
+        putfile(self.tmpdir, P("build/lib/other.py"), "")
+        putdir(self.tmpdir, ".git")
+        putfile(self.tmpdir, "module.py", "")
+        putfile(self.tmpdir, "setup.cfg", "")
+        putfile(self.tmpdir, "module.pyc", "")
+        statistics = WalkStatistics()
+
+        self._modules_below(["build", "*.pyc"], statistics)
+
+        assert_equal(2, statistics.scanned_files)
+        assert_equal(1, statistics.skipped_files)
+        assert_equal(2, statistics.skipped_directories)
+        assert_equal(["build"], statistics.excluded_directories)
+
+class TestExcludes(TempDirectory):
+    def test_uses_defaults_when_excludes_file_is_missing(self):
+        assert_equal(DEFAULT_EXCLUDES,
+                     read_excludes(os.path.join(self.tmpdir, "excludes")))
+
+    def test_reads_back_written_excludes(self):
+        path = os.path.join(self.tmpdir, "excludes")
+        write_excludes(path, ["build", P("docs/examples")])
+
+        assert_equal(["build", P("docs/examples")], read_excludes(path))
+
+    def test_ignores_comments_and_empty_lines(self):
+        path = putfile(self.tmpdir, "excludes", "# comment\n\n  build  \n")
+
+        assert_equal(["build"], read_excludes(path))
+
+class TestTracingGlobs(TempDirectory):
+    def test_has_no_globs_when_file_is_missing(self):
+        assert_equal(([], []),
+                     read_tracing_globs(os.path.join(self.tmpdir, "tracing")))
+
+    def test_splits_globs_into_includes_and_excludes(self):
+        path = putfile(self.tmpdir, "tracing",
+                       "# comment\nlib.*\n+ other\n-module.migrations.*\n")
+
+        assert_equal((["lib.*", "other"], ["module.migrations.*"]),
+                     read_tracing_globs(path))
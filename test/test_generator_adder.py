@@ -4,13 +4,15 @@ from pythoscope.astbuilder import parse, EmptyCode
 from pythoscope.generator import UnittestTestGenerator, TestMethodDescription
 from pythoscope.generator.adder import add_test_case_to_project, add_test_case, \
     find_test_module, module_path_to_test_path, replace_test_case
-from pythoscope.inspector.static import inspect_code
+from pythoscope.inspector.static import analyze_code_quickly, \
+    create_module_from_analysis, inspect_code
 from pythoscope.store import TestClass, TestMethod
 
 from assertions import *
 from factories import create
 from helper import get_test_cases, CapturedLogger, CustomSeparator, \
-    EmptyProject, ProjectWithModules
+    EmptyProject, ProjectInDirectory, ProjectWithModules, TempDirectory, \
+    putfile
 
 
 def ProjectAndTestClass(test_module_name):
@@ -243,3 +245,33 @@ class TestGeneratorAdderOnCode:
 
         assert_matches(r"from __future__ import division.*from nose import SkipTest",
             module.get_content())
+
+class TestGeneratorAdderOnLazyCodeTrees(TempDirectory):
+    def setUp(self):
+        super(TestGeneratorAdderOnLazyCodeTrees, self).setUp()
+        self.generator = UnittestTestGenerator()
+        self.project = ProjectInDirectory(self.tmpdir)
+        self.module = self.project.create_module(os.path.join(self.tmpdir, "module.py"))
+
+    def test_appends_new_test_methods_to_lazily_inspected_test_modules(self):
+        code = "import unittest\n\n"\
+            "class NewTestClass(unittest.TestCase):\n"\
+            "    def test_some_method(self):\n"\
+            "        assert False\n"
+        path = putfile(self.tmpdir, "test_module.py", code)
+        test_module = create_module_from_analysis(self.project, path, code,
+                                                  analyze_code_quickly(code))
+        klass = self.generator._generate_test_class("NewTestClass",
+            [TestMethodDescription("test_new_method", self.generator.template)],
+            self.module,
+            "class NewTestClass(unittest.TestCase):\n"\
+            "    def test_new_method(self):\n"\
+            "        assert True\n")
+
+        add_test_case_to_project(self.project, klass)
+
+        assert not test_module.lazy_code_tree
+        assert_equal_strings(code + "\n"\
+            "    def test_new_method(self):\n"\
+            "        assert True\n",
+            test_module.get_content())
@@ -1,13 +1,21 @@
+import os
 import sys
+import time
 
 from nose import SkipTest
 
-from pythoscope.inspector import inspect_project
-from pythoscope.util import generator_has_ended
+from pythoscope.cmdline import inspect_changes
+from pythoscope.compat import Pool
+from pythoscope.inspector import inspect_project, \
+    inspect_project_incrementally, inspect_project_statically, ProjectWatcher
+from pythoscope.inspector.file_system import write_excludes
+from pythoscope.store import Class, Function, Project
+from pythoscope.util import generator_has_ended, get_names, \
+    write_content_to_file
 
 from assertions import *
 from helper import CapturedLogger, CapturedDebugLogger, P, ProjectInDirectory,\
-    TempDirectory
+    TempDirectory, putfile
 
 
 class TestInspector(CapturedLogger, TempDirectory):
@@ -81,6 +89,27 @@ class TestInspector(CapturedLogger, TempDirectory):
                                  "WARNING: Point of entry exited with error: "
                                  "TypeError('exceptions must be classes or instances, not str',)")
 
+    def test_inspects_modules_using_worker_processes(self):
+        if Pool is None:
+            raise SkipTest
+        project = ProjectInDirectory(self.tmpdir)
+        putfile(project.path, "module.py", "class Something:\n    def method(self):\n        pass\n")
+        putfile(project.path, "other_module.py", "def function():\n    yield 1\n")
+        putfile(project.path, "bad_module.py", "a b c d e f g\n")
+
+        inspect_project(project, jobs=2)
+
+        assert_equal(["Something"], get_names(project["module"].classes))
+        assert_equal(["method"], get_names(project["module"].classes[0].methods))
+        assert project["other_module"].functions[0].is_generator
+        assert_length(project["bad_module"].errors, 1)
+        assert_contains_once(self._get_log_output(),
+                             "WARNING: Inspection of module %s failed." % \
+                                 os.path.join(project.path, "bad_module.py"))
+        for path in ["module.py", "other_module.py", "bad_module.py"]:
+            assert_contains_once(self._get_log_output(),
+                                 "INFO: Inspecting module %s." % path)
+
 class TestInspectorWithDebugOutput(CapturedDebugLogger, TempDirectory):
     def test_skips_inspection_of_up_to_date_modules(self):
         paths = ["module.py", "something_else.py", P("module/in/directory.py")]
@@ -91,3 +120,204 @@ class TestInspectorWithDebugOutput(CapturedDebugLogger, TempDirectory):
         for path in paths:
             assert_contains_once(self._get_log_output(),
                 "DEBUG: %s hasn't changed since last inspection, skipping." % path)
+
+class TestInspectorWithContentDigests(CapturedLogger, TempDirectory):
+    def setUp(self):
+        super(TestInspectorWithContentDigests, self).setUp()
+        self.project = ProjectInDirectory(self.tmpdir)
+        self.project.use_content_digests()
+        putfile(self.project.path, "module.py", "def function():\n    pass\n")
+        self.project.with_point_of_entry("poe.py", "import module\n")
+        inspect_project(self.project)
+        self.captured.truncate(0)
+
+    def _touch_everything(self):
+        # Fake modification of files by faking their creation time.
+        self.project["module"].created = 0
+        self.project.get_point_of_entry("poe.py").execution.ended = 0
+
+    def test_skips_inspection_of_touched_files_with_unchanged_contents(self):
+        self._touch_everything()
+
+        inspect_project(self.project)
+
+        assert_equal_strings("INFO: No changes discovered in the source code, skipping dynamic inspection.\n",
+                             self._get_log_output())
+
+    def test_inspects_touched_modules_with_changed_contents(self):
+        putfile(self.project.path, "module.py", "def other_function():\n    pass\n")
+        self._touch_everything()
+
+        inspect_project(self.project)
+
+        assert_contains_once(self._get_log_output(),
+                             "INFO: Inspecting module module.py.")
+
+class TestIncrementalInspection(TempDirectory):
+    def setUp(self):
+        super(TestIncrementalInspection, self).setUp()
+        self.project = ProjectInDirectory(self.tmpdir)
+        self.code = "def unchanged(x):\n    return x\n\n"\
+            "class Unchanged(object):\n    def method(self):\n        pass\n\n"\
+            "def changed():\n    return 1\n"
+
+    def _inspect(self, code):
+        putfile(self.project.path, "module.py", code)
+        inspect_project_statically(self.project)
+        return self.project["module"]
+
+    def _reinspect(self, code):
+        # Force the inspection by faking the file creation time.
+        self.project["module"].created = 0
+        return self._inspect(code)
+
+    def _test_keeps_unchanged_definitions(self):
+        module = self._inspect(self.code)
+        function = module.find_object(Function, "unchanged")
+        klass = module.find_object(Class, "Unchanged")
+        function.calls.append("a call")
+        klass.user_objects.append("a user object")
+
+        module = self._reinspect("import os\n" + self.code.replace("return 1", "return 2"))
+
+        assert module.find_object(Function, "unchanged") is function
+        assert module.find_object(Class, "Unchanged") is klass
+        assert_equal(["a call"], function.calls)
+        assert_equal(["a user object"], klass.user_objects)
+        assert function.module is module
+        assert_equal([], module.find_object(Function, "changed").calls)
+
+    def test_keeps_unchanged_definitions(self):
+        self._test_keeps_unchanged_definitions()
+
+    def test_keeps_unchanged_definitions_with_lazy_code_trees(self):
+        self.project.use_lazy_code_trees()
+        self._test_keeps_unchanged_definitions()
+
+    def test_replaces_changed_definitions(self):
+        module = self._inspect(self.code)
+        klass = module.find_object(Class, "Unchanged")
+
+        module = self._reinspect(self.code.replace("pass", "return self"))
+
+        assert module.find_object(Class, "Unchanged") is not klass
+
+    def test_keeps_unchanged_definitions_of_modules_in_sharded_store(self):
+        self.project.use_sharded_store()
+        self._inspect(self.code).find_object(Function, "unchanged").calls.append("a call")
+        self.project.save()
+        self.project = Project.from_directory(self.project.path)
+        path = putfile(self.project.path, "module.py",
+                       self.code.replace("return 1", "return 2"))
+        # Make the file look modified without loading the module.
+        modification_time = time.time() + 10
+        os.utime(path, (modification_time, modification_time))
+
+        inspect_project_statically(self.project)
+
+        module = self.project["module"]
+        assert_equal(["a call"], module.find_object(Function, "unchanged").calls)
+        assert_equal([], module.find_object(Function, "changed").calls)
+
+def modify(path, contents):
+    """Write new contents to a file, making sure its modification time changes.
+    """
+    write_content_to_file(contents, path)
+    modification_time = time.time() + 10
+    os.utime(path, (modification_time, modification_time))
+
+class TestWatchedInspection(CapturedLogger, TempDirectory):
+    def setUp(self):
+        super(TestWatchedInspection, self).setUp()
+        self.project = ProjectInDirectory(self.tmpdir)
+        self.first = putfile(self.tmpdir, "first.py", "def function():\n    return 1\n")
+        self.second = putfile(self.tmpdir, "second.py", "def function():\n    return 2\n")
+        self.project.with_point_of_entry("use_first.py",
+                                         "import first\nfirst.function()\n")
+        self.project.with_point_of_entry("use_second.py",
+                                         "import second\nsecond.function()\n")
+
+    def _poe_names(self, points_of_entry):
+        return sorted([poe.name for poe in points_of_entry])
+
+    def test_watcher_reports_added_modified_and_removed_files(self):
+        watcher = ProjectWatcher(self.project)
+        third = putfile(self.tmpdir, "third.py", "")
+        modify(self.first, "")
+        os.remove(self.second)
+
+        assert_equal(sorted([self.first, self.second, third]), watcher.changes())
+        assert_equal([], watcher.changes())
+
+    def test_watcher_notices_changed_points_of_entry(self):
+        watcher = ProjectWatcher(self.project)
+        poe_path = os.path.join(self.project.get_points_of_entry_path(), "use_first.py")
+        modify(poe_path, "import first\n")
+
+        assert_equal([poe_path], watcher.changes())
+
+    def test_watcher_notices_changed_excludes(self):
+        watcher = ProjectWatcher(self.project)
+        write_excludes(self.project.get_excludes_path(), ["second.py"])
+
+        # Newly excluded modules are reported as removed.
+        assert_equal(sorted([self.project.get_excludes_path(), self.second]),
+                     watcher.changes())
+
+    def test_inspects_only_modules_with_changed_paths(self):
+        inspect_project(self.project)
+        third = putfile(self.tmpdir, "third.py", "")
+        modify(self.first, "def other_function():\n    pass\n")
+        os.remove(self.second)
+
+        inspect_project_incrementally(self.project, [self.first, self.second])
+
+        assert_equal(["first.py"], self.project.get_module_subpaths())
+        assert_equal(["other_function"], get_names(self.project["first"].functions))
+
+    def test_updates_whole_project_after_excludes_change(self):
+        inspect_project(self.project)
+        third = putfile(self.tmpdir, "third.py", "")
+        write_excludes(self.project.get_excludes_path(), ["second.py"])
+
+        inspect_project_incrementally(self.project, [self.project.get_excludes_path()])
+
+        assert_equal(["first.py", "third.py"], sorted(self.project.get_module_subpaths()))
+
+    def test_keeps_watching_after_inspection_of_changes_fails(self):
+        watcher = ProjectWatcher(self.project)
+        def failing_save(keep_code_trees=False):
+            raise IOError("disk full")
+        self.project.save = failing_save
+        modify(self.first, "def other_function():\n    pass\n")
+
+        inspect_changes(self.project, watcher)
+
+        assert_contains(self._get_log_output(), "IOError: disk full")
+        assert_equal([], watcher.changes())
+
+    def test_remembers_project_modules_imported_by_points_of_entry(self):
+        inspect_project(self.project)
+
+        assert_equal(["first.py"],
+                     self.project.get_point_of_entry("use_first.py").execution.imported_modules)
+
+    def test_runs_only_points_of_entry_that_imported_changed_modules(self):
+        inspect_project(self.project)
+        modify(self.first, "def function():\n    return 3\n")
+
+        points_of_entry = inspect_project_incrementally(self.project, [self.first])
+
+        assert_equal(["use_first.py"], self._poe_names(points_of_entry))
+        assert_length(self.project["first"].find_object(Function, "function").calls, 1)
+        assert_length(self.project["second"].find_object(Function, "function").calls, 1)
+
+    def test_runs_changed_points_of_entry(self):
+        inspect_project(self.project)
+        poe_path = os.path.join(self.project.get_points_of_entry_path(), "use_second.py")
+        modify(poe_path, "import second\nsecond.function()\nsecond.function()\n")
+
+        points_of_entry = inspect_project_incrementally(self.project, [poe_path])
+
+        assert_equal(["use_second.py"], self._poe_names(points_of_entry))
+        assert_length(self.project["second"].find_object(Function, "function").calls, 2)
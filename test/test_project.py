@@ -1,11 +1,15 @@
 import os
 from cPickle import PicklingError
 
-from pythoscope.store import Project, Class, Function, Method, TestClass, \
-     TestMethod, ModuleNotFound
+from pythoscope.cmdline import init_project
+from pythoscope.store import Project, Class, Function, FunctionCall, Method,\
+     TestClass, TestMethod, ModuleNotFound
 from pythoscope.inspector import remove_deleted_modules
+from pythoscope.inspector.file_system import write_excludes
 from pythoscope.generator.adder import add_test_case
-from pythoscope.util import get_names, read_file_contents
+from pythoscope.point_of_entry import PointOfEntry
+from pythoscope.serializer import ImmutableObject
+from pythoscope.util import get_names, read_file_contents, write_content_to_file
 
 from assertions import *
 from factories import create
@@ -53,6 +57,62 @@ class TestProject:
         assert_length(test_class.associated_modules, 1)
         assert test_class.associated_modules[0] is new_module
 
+    def test_replaced_module_can_be_queried_by_its_locator(self):
+        project = ProjectWithModules(["module.py"])
+
+        new_module = project.create_module("module.py")
+
+        assert project["module"] is new_module
+
+    def test_removed_module_cannot_be_queried_by_its_locator(self):
+        project = ProjectWithModules(["module.py", P("sub/module.py")])
+
+        project.remove_module(P("sub/module.py"))
+
+        assert_raises(ModuleNotFound, lambda: project["sub.module"])
+        assert_not_raises(ModuleNotFound, lambda: project["module"])
+
+    def test_falls_back_to_other_module_with_the_same_locator_after_removal(self):
+        project = ProjectWithModules(["package.py", P("package/__init__.py")])
+        remaining_module = project["package.py"]
+
+        project.remove_module(P("package/__init__.py"))
+
+        assert project["package"] is remaining_module
+
+    def test_can_be_queried_for_test_classes_by_their_name(self):
+        project = ProjectWithModules(["test_module.py"])
+        test_class = create(TestClass, name="TestSomething")
+        add_test_case(project["test_module.py"], test_class)
+
+        assert project.find_test_class_by_name("TestSomething") is test_class
+        assert_equal(None, project.find_test_class_by_name("TestOther"))
+
+    def test_doesnt_find_removed_test_classes(self):
+        project = ProjectWithModules(["test_module.py"])
+        test_class = create(TestClass, name="TestSomething")
+        add_test_case(project["test_module.py"], test_class)
+
+        project["test_module.py"].remove_test_case(test_class)
+
+        assert_equal(None, project.find_test_class_by_name("TestSomething"))
+
+    def test_finds_test_classes_of_replaced_modules_only(self):
+        project = ProjectWithModules(["test_module.py"])
+        add_test_case(project["test_module.py"], create(TestClass, name="TestSomething"))
+
+        project.create_module("test_module.py")
+
+        assert_equal(None, project.find_test_class_by_name("TestSomething"))
+
+    def test_doesnt_find_test_classes_of_removed_modules(self):
+        project = ProjectWithModules(["test_module.py"])
+        add_test_case(project["test_module.py"], create(TestClass, name="TestSomething"))
+
+        project.remove_module("test_module.py")
+
+        assert_equal(None, project.find_test_class_by_name("TestSomething"))
+
 
 class TestProjectOnTheFilesystem(TempDirectory):
     def test_can_be_saved_and_restored_from_file(self):
@@ -71,6 +131,24 @@ class TestProjectOnTheFilesystem(TempDirectory):
         assert_equal(["afunction"], get_names(project['good_module'].functions))
         assert_equal(["Syntax error"], project['bad_module'].errors)
 
+    def test_modules_restored_from_file_can_be_queried_by_their_locator(self):
+        project = ProjectInDirectory(self.tmpdir).with_modules([P("sub/module.py")])
+        project.save()
+
+        project = Project.from_directory(project.path)
+
+        assert project["sub.module"] is project[P("sub/module.py")]
+
+    def test_test_classes_restored_from_file_can_be_queried_by_their_name(self):
+        project = ProjectInDirectory(self.tmpdir).with_modules(["test_module.py"])
+        add_test_case(project["test_module.py"], create(TestClass, name="TestSomething"))
+        project.save()
+
+        project = Project.from_directory(project.path)
+
+        assert project.find_test_class_by_name("TestSomething") is \
+            project["test_module.py"].test_classes[0]
+
     def _test_finds_new_test_directory(self, test_module_dir):
         putdir(self.tmpdir, ".pythoscope")
         putdir(self.tmpdir, test_module_dir)
@@ -98,6 +176,33 @@ class TestProjectOnTheFilesystem(TempDirectory):
         assert_raises(ModuleNotFound, lambda: project["other_module"])
         assert_not_raises(ModuleNotFound, lambda: project["test_module"])
 
+    def test_removes_definitions_of_modules_excluded_from_inspection(self):
+        project = ProjectInDirectory(self.tmpdir).with_modules(["module.py", P("build/module.py")])
+        write_excludes(project.get_excludes_path(), ["build"])
+
+        remove_deleted_modules(project)
+
+        assert_equal(["module.py"], project.get_module_subpaths())
+
+    def test_restores_code_trees_cache_limits(self):
+        project = ProjectInDirectory(self.tmpdir)
+        project.use_code_trees_cache_limits(2, 1024)
+        project.save()
+
+        project = Project.from_directory(self.tmpdir)
+
+        assert_equal(2, project.code_trees_manager.max_entries)
+        assert_equal(1024, project.code_trees_manager.max_bytes)
+
+    def test_initializes_project_with_given_code_trees_cache_limits(self):
+        init_project(self.tmpdir, skip_inspection=True, cache_entries=4,
+                     cache_bytes=4096)
+
+        project = Project.from_directory(self.tmpdir)
+
+        assert_equal(4, project.code_trees_manager.max_entries)
+        assert_equal(4096, project.code_trees_manager.max_bytes)
+
     def test_doesnt_save_uncomplete_pickle_files(self):
         project = ProjectInDirectory(self.tmpdir)
         project.save()
@@ -113,3 +218,114 @@ class TestProjectOnTheFilesystem(TempDirectory):
         # Make sure that the original file wasn't overwritten.
         assert_equal_strings(original_pickle,
                              read_file_contents(project._get_pickle_path()))
+
+class TestShardedProjectOnTheFilesystem(TempDirectory):
+    def _create_sharded_project(self):
+        project = ProjectInDirectory(self.tmpdir).with_modules(["module.py", "other_module.py"])
+        project.use_sharded_store()
+        project['module'].add_objects([Class("AClass", [Method("amethod")]),
+                                       Function("afunction")])
+        return project
+
+    def _add_traced_call(self, project):
+        function = project['module'].find_object(Function, "afunction")
+        poe = PointOfEntry(project, "poe.py")
+        call = FunctionCall(function, {}, ImmutableObject(42))
+        poe.execution.captured_calls.append(call)
+        function.add_call(call)
+        project.add_point_of_entry(poe)
+
+    def test_can_be_saved_and_restored_from_shards(self):
+        project = self._create_sharded_project()
+        project.save()
+
+        project = Project.from_directory(project.path)
+
+        assert_equal(2, len(project.get_modules()))
+        assert_equal(["AClass"], get_names(project['module'].classes))
+        assert_equal(["amethod"], get_names(project['module'].classes[0].methods))
+        assert_equal(["afunction"], get_names(project['module'].functions))
+
+    def test_checks_contents_of_touched_modules_without_loading_them(self):
+        project = self._create_sharded_project()
+        project.use_content_digests()
+        project['module'].update_digest(read_file_contents(project['module'].get_path()))
+        project['module'].created = 0
+        project['other_module'].created = 0
+        project.save()
+
+        project = Project.from_directory(self.tmpdir)
+
+        assert project.is_module_up_to_date("module.py")
+        assert not project.is_module_up_to_date("other_module.py")
+        assert_equal([], project._modules.keys())
+
+    def test_loads_modules_only_when_they_are_needed(self):
+        self._create_sharded_project().save()
+
+        project = Project.from_directory(self.tmpdir)
+        assert_equal([], project._modules.keys())
+
+        project['module']
+        assert_equal(['module.py'], project._modules.keys())
+
+    def test_loads_only_modules_with_test_class_of_given_name(self):
+        project = self._create_sharded_project().with_modules(["test_module.py"])
+        add_test_case(project["test_module.py"], create(TestClass, name="TestSomething"))
+        project.save()
+
+        project = Project.from_directory(self.tmpdir)
+        test_class = project.find_test_class_by_name("TestSomething")
+
+        assert_equal("TestSomething", test_class.name)
+        assert_equal(None, project.find_test_class_by_name("TestOther"))
+        assert_equal(['test_module.py'], project._modules.keys())
+
+    def test_restores_code_trees_cache_limits(self):
+        project = self._create_sharded_project()
+        project.use_code_trees_cache_limits(2, 1024)
+        project.save()
+
+        project = Project.from_directory(self.tmpdir)
+
+        assert_equal(2, project.code_trees_manager.max_entries)
+        assert_equal(1024, project.code_trees_manager.max_bytes)
+
+    def test_preserves_calls_captured_during_executions(self):
+        project = self._create_sharded_project()
+        self._add_traced_call(project)
+        project.save()
+
+        project = Project.from_directory(project.path)
+
+        function = project['module'].find_object(Function, "afunction")
+        call = assert_one_element_and_return(function.calls)
+        assert call is project.points_of_entry['poe.py'].execution.captured_calls[0]
+        assert call.definition is function
+
+    def test_doesnt_rewrite_shards_that_havent_changed(self):
+        self._create_sharded_project().save()
+        project = Project.from_directory(self.tmpdir)
+        project['module'].add_object(Function("another_function"))
+        project['other_module']
+        shard_paths = [project._store._module_shard_path(project, subpath)
+                       for subpath in ["module.py", "other_module.py"]]
+        for path in shard_paths:
+            write_content_to_file("sentinel", path)
+
+        project.save()
+
+        assert_not_equal("sentinel", read_file_contents(shard_paths[0]))
+        assert_equal("sentinel", read_file_contents(shard_paths[1]))
+
+    def test_removes_shards_of_removed_modules(self):
+        project = self._create_sharded_project()
+        project.save()
+        shard_path = project._store._module_shard_path(project, "other_module.py")
+        assert os.path.exists(shard_path)
+
+        project.remove_module("other_module.py")
+        project.save()
+
+        assert not os.path.exists(shard_path)
+        assert_equal(["module.py"], Project.from_directory(project.path).get_module_subpaths())
@@ -2,13 +2,14 @@ import sys
 
 from nose import SkipTest
 
-from pythoscope.inspector.static import inspect_code
+from pythoscope.inspector.static import analyze_code_quickly, \
+    create_module_from_analysis, inspect_code
 from pythoscope.astbuilder import regenerate
-from pythoscope.store import code_of
+from pythoscope.store import code_of, Function, ModuleNeedsAnalysis
 from pythoscope.util import get_names
 
 from assertions import *
-from helper import EmptyProject
+from helper import EmptyProject, ProjectInDirectory, TempDirectory, putfile
 
 
 new_style_class = """
@@ -190,6 +191,30 @@ function_returning_generator_object = """def fun():
     return gen()
 """
 
+decorated_generator_definitions = """def decorator(fun):
+    return fun
+
+@decorator
+def decorated_function(x):
+    return x
+
+@decorator
+@decorator
+def decorated_generator(x):
+    yield x
+"""
+
+generator_with_invalid_return = """def gen_with_return():
+    yield 1
+    return 2
+
+def regular_gen():
+    yield 3
+
+def function():
+    return 4
+"""
+
 class_with_method_generator_definition = """class SomeClass(object):
     def method_generator(self):
         yield 2
@@ -378,6 +403,18 @@ class TestStaticInspector:
         assert method.is_generator
         assert_equal("method_generator", method.name)
 
+    def test_recognizes_decorated_generator_definitions(self):
+        module = self._inspect_code(decorated_generator_definitions)
+
+        generators = [f.name for f in module.functions if f.is_generator]
+        assert_equal(["decorated_generator"], generators)
+
+    def test_recognizes_generators_in_modules_that_dont_compile_as_a_whole(self):
+        module = self._inspect_code(generator_with_invalid_return)
+
+        generators = [f.name for f in module.functions if f.is_generator]
+        assert_equal(["regular_gen"], generators)
+
     def test_handles_functions_without_arguments(self):
         module = self._inspect_code(stand_alone_function)
 
@@ -420,3 +457,73 @@ class TestStaticInspector:
         assert_function(info.functions[0], "nestfun", [('a', 'b'), 'c'])
         assert_function(info.functions[1], "nestfun2", ['a', ('b', 'c')])
         assert_function(info.functions[2], "nestfun3", ['a', ('b', 'c'), 'd'])
+
+def describe_definitions(module):
+    return [(o.__class__.__name__, o.name, getattr(o, 'args', None),
+             getattr(o, 'is_generator', None), get_names(o.methods))
+            for o in module.classes + module.test_classes] +\
+        [(f.name, f.args, f.is_generator) for f in module.functions]
+
+class TestQuickStaticInspector(TempDirectory):
+    def _inspect_code(self, code):
+        project = ProjectInDirectory(self.tmpdir)
+        path = putfile(self.tmpdir, "module.py", code)
+        return create_module_from_analysis(project, path, code,
+                                           analyze_code_quickly(code))
+
+    def test_finds_the_same_objects_as_full_inspection(self):
+        code = application_module_with_test_class + class_with_method_generator_definition +\
+            lambda_definition + decorated_generator_definitions
+        module = self._inspect_code(code)
+        full_module = inspect_code(EmptyProject(), "module.py", code)
+
+        assert module.lazy_code_tree
+        assert_equal(describe_definitions(full_module), describe_definitions(module))
+        assert_equal(full_module.imports, module.imports)
+        assert_equal(full_module.test_classes[0].imports, module.test_classes[0].imports)
+
+    def test_keeps_source_order_of_definitions_in_try_statements(self):
+        code = "try:\n    def get(a):\n        pass\n" \
+            "except ImportError:\n    def get(b):\n        pass\n" \
+            "else:\n    def get(c):\n        pass\n" \
+            "finally:\n    def get(d):\n        pass\n" \
+            "class Environ:\n" \
+            "    try:\n        def delete(self, a):\n            pass\n" \
+            "    except AttributeError:\n        def delete(self, b):\n            pass\n" \
+            "    else:\n        def delete(self, c):\n            pass\n"
+        module = self._inspect_code(code)
+        full_module = inspect_code(EmptyProject(), "module.py", code)
+
+        assert module.lazy_code_tree
+        assert_equal(describe_definitions(full_module), describe_definitions(module))
+        assert_equal(full_module.find_object(Function, "get").args,
+                     module.find_object(Function, "get").args)
+
+    def test_builds_code_tree_when_its_needed(self):
+        module = self._inspect_code(application_module_with_test_class)
+
+        assert code_of(module, 'main_snippet') is not None
+        assert code_of(module.test_classes[0]) is not None
+        assert not module.lazy_code_tree
+        assert_equal(application_module_with_test_class, module.get_content())
+
+    def test_falls_back_to_full_inspection_for_relative_imports(self):
+        module = self._inspect_code("from . import sibling\n")
+
+        assert not module.lazy_code_tree
+        assert_equal(["sibling"], module.imports)
+
+    def test_falls_back_to_full_inspection_for_definitions_in_dead_code(self):
+        module = self._inspect_code("if 0:\n    def f():\n        pass\n"
+                                    "while 0:\n    def g():\n        yield 1\n")
+
+        assert not module.lazy_code_tree
+        assert_equal([("f", False), ("g", True)],
+                     [(f.name, f.is_generator) for f in module.functions])
+
+    def test_refuses_to_build_code_tree_of_changed_module(self):
+        module = self._inspect_code(application_module_with_test_class)
+        # Fake modification of the file by faking its creation time.
+        module.created = 0
+
+        assert_raises(ModuleNeedsAnalysis, lambda: code_of(module))
@@ -1,3 +1,5 @@
+import cPickle
+
 from pythoscope.astbuilder import parse
 from pythoscope.code_trees_manager import CodeTreeNotFound
 from pythoscope.store import Class, Function, Method, Module, CodeTree,\
@@ -35,6 +37,47 @@ class TestModule:
         module = self.project.create_module("module_with_errors.py", errors=[Exception()])
         assert_raises(CodeTreeNotFound, lambda: CodeTree.of(module))
 
+    def test_finds_objects_by_type_and_name(self):
+        klass = Class("Something")
+        function = Function("Something")
+        self.module.add_objects([klass, function])
+
+        assert klass is self.module.find_object(Class, "Something")
+        assert function is self.module.find_object(Function, "Something")
+        assert_equal(None, self.module.find_object(TestClass, "Something"))
+        assert_equal(None, self.module.find_object(Class, "Other"))
+
+    def test_doesnt_find_removed_objects(self):
+        klass = Class("Something")
+        self.module.add_objects([klass])
+        self.module.remove_object(klass)
+
+        assert_equal(None, self.module.find_object(Class, "Something"))
+        assert_equal([], self.module.classes)
+
+    def test_keeps_lists_of_objects_of_each_type_in_order(self):
+        objects = [Class("A"), Function("b"), Class("C"), self.test_class]
+        self.module.add_objects(objects)
+
+        assert_equal([objects[0], objects[2]], self.module.classes)
+        assert_equal([objects[1]], self.module.functions)
+        assert_equal([self.test_class], self.module.test_classes)
+
+    def test_notices_when_list_of_objects_is_replaced(self):
+        self.module.add_objects([Class("Something")])
+        klass = Class("Something")
+        self.module.objects = [klass]
+
+        assert klass is self.module.find_object(Class, "Something")
+
+    def test_doesnt_pickle_the_index_of_objects(self):
+        self.module.add_objects([Class("Something")])
+        self.module.find_object(Class, "Something")
+
+        state = self.module.__getstate__()
+        for name in ['_objects_by_type', '_objects_by_name', '_indexed_objects']:
+            assert name not in state
+
 class TestStoreWithCustomSeparator(CustomSeparator):
     def test_uses_system_specific_path_separator(self):
         module = Module(subpath="some#path.py", project=EmptyProject())
@@ -134,3 +177,31 @@ class TestCodeTree:
         project.remove_module(mod.subpath)
 
         assert_raises(CodeTreeNotFound, lambda: CodeTree.of(mod))
+
+    def test_is_dirty_after_creation_and_clean_after_unpickling(self):
+        ct = CodeTree(None)
+        assert ct.dirty
+
+        assert not cPickle.loads(cPickle.dumps(ct, cPickle.HIGHEST_PROTOCOL)).dirty
+
+    def test_adding_and_removing_objects_marks_it_as_dirty(self):
+        project = EmptyProject()
+        mod = project.create_module('module.py', code=parse("# comment"))
+        ct = CodeTree.of(mod)
+        ct.mark_clean()
+
+        ct.add_object('main_snippet', None)
+        assert ct.dirty
+        ct.mark_clean()
+
+        ct.remove_object('main_snippet')
+        assert ct.dirty
+
+    def test_adding_a_test_case_marks_its_module_code_tree_as_dirty(self):
+        project = EmptyProject()
+        mod = project.create_module('module.py', code=parse("# comment"))
+        CodeTree.of(mod).mark_clean()
+
+        add_test_case(mod, TestClass(name="TestSomething", code=parse("# some test code")))
+
+        assert CodeTree.of(mod).dirty
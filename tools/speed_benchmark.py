@@ -1,15 +1,23 @@
 from __future__ import division
 
 import gc
+import glob
 import os.path
 import sys
+import tarfile
 import timeit
 
+from types import FunctionType
+
 pythoscope_path = os.path.join(os.path.dirname(__file__), os.pardir)
 sys.path.insert(0, os.path.abspath(pythoscope_path))
 
+from bytecode_tracer import BytecodeTracer, rewrite_function
 from pythoscope.cmdline import init_project
-from pythoscope.store import get_pickle_path
+from pythoscope.inspector import inspect_project_statically
+from pythoscope.store import Project, get_code_trees_path, get_pickle_path, \
+    get_points_of_entry_path, get_shards_path
+from pythoscope.util import read_file_contents
 from test.helper import putfile, rmtree, tmpdir
 
 
@@ -66,16 +74,27 @@ def human_size(bytes, prefixes=['', 'K', 'M', 'G']):
         return human_size(bytes/1024, prefixes[1:])
     return "%.2f%sb" % (bytes, prefixes[0])
 
-def benchmark_project_load_performance(modules_count=25):
-    print "==> Creating project with %d modules..." % modules_count
+def directory_size(path):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            total += os.path.getsize(os.path.join(dirpath, filename))
+    return total
+
+def benchmark_project_load_performance(modules_count=25, sharded_store=False):
+    if sharded_store:
+        layout = "sharded"
+    else:
+        layout = "monolithic"
+    print "==> Creating project with %d modules (%s store)..." % (modules_count, layout)
     project_path = tmpdir()
     module = make_module()
     for i in range(modules_count):
         putfile(project_path, "module%s.py" % i, module)
-    init_project(project_path, skip_inspection=True)
+    init_project(project_path, skip_inspection=True, sharded_store=sharded_store)
 
     print "==> Inspecting project.."
-    elapsed = run_timer("inspect_project(Project('%s'))" % project_path,
+    elapsed = run_timer("inspect_project(Project.from_directory('%s'))" % project_path,
                         "from pythoscope.inspector import inspect_project; from pythoscope.store import Project")
     print "It took %f seconds to inspect." % elapsed
 
@@ -83,17 +102,302 @@ def benchmark_project_load_performance(modules_count=25):
     elapsed = run_timer("project.save()",
                         """from pythoscope.inspector import inspect_project ;\
                            from pythoscope.store import Project ;\
-                           project = Project('%s') ;\
+                           project = Project.from_directory('%s') ;\
                            inspect_project(project)""" % project_path)
     print "It took %f seconds to save the project information." % elapsed
 
     print "==> Reading project information"
     elapsed = run_timer("Project.from_directory('%s')" % project_path,
                         "from pythoscope.store import Project")
-    print "It took %f seconds to read project information from %s pickle." % \
-        (elapsed, human_size(os.path.getsize(get_pickle_path(project_path))))
+    if sharded_store:
+        size = directory_size(get_shards_path(project_path))
+    else:
+        size = os.path.getsize(get_pickle_path(project_path))
+    print "It took %f seconds to read project information from %s %s store." % \
+        (elapsed, human_size(size), layout)
+
+    print "==> Reading a single module"
+    elapsed = run_timer("Project.from_directory('%s')['module0.py']" % project_path,
+                        "from pythoscope.store import Project")
+    print "It took %f seconds to read project information with a single module." % elapsed
+
+    rmtree(project_path)
+
+def benchmark_tracing_performance(modules_count=1000, calls_count=1000):
+    print "==> Creating project with %d modules..." % modules_count
+    project_path = tmpdir()
+    for i in range(modules_count):
+        putfile(project_path, "module%s.py" % i,
+                "CONSTANT = %d\n%s    return CONSTANT\n" % \
+                    (i, make_function("function_%d" % i).replace("pass\n", "")))
+    init_project(project_path)
+
+    print "==> Tracing %d calls..." % calls_count
+    last = modules_count - 1
+    code = "from module%d import function_%d\n"\
+           "for _ in range(%d):\n"\
+           "    function_%d()\n" % (last, last, calls_count, last)
+    sys.path.insert(0, project_path)
+    try:
+        # Module has to be imported under the tracer, so we make sure it
+        # isn't cached in sys.modules by a previous run.
+        elapsed = run_timer("exec code in {}",
+                            """sys.modules.pop('module%d', None) ;\
+                               code = %r""" % (last, code))
+        print "It took %f seconds to run the code without tracing." % elapsed
+        elapsed = run_timer("inspect_code_in_context(code, Execution(project))",
+                            """from pythoscope.execution import Execution ;\
+                               from pythoscope.inspector.dynamic import inspect_code_in_context ;\
+                               from pythoscope.store import Project ;\
+                               sys.modules.pop('module%d', None) ;\
+                               project = Project.from_directory('%s') ;\
+                               code = %r""" % (last, project_path, code))
+        print "It took %f seconds to trace the code." % elapsed
+    finally:
+        sys.path.remove(project_path)
 
     rmtree(project_path)
 
+def trace_with_bytecode_tracer(function, selective=True):
+    btracer = BytecodeTracer(selective)
+    def trace(frame, event, arg):
+        list(btracer.trace(frame, event))
+        return trace
+    rewrite_function(function, selective)
+    btracer.setup()
+    sys.settrace(trace)
+    try:
+        function()
+    finally:
+        sys.settrace(None)
+        btracer.teardown()
+
+def count_in_a_loop(iterations_count):
+    total = 0
+    for i in xrange(iterations_count):
+        total = total + i * 2 - 1
+    return total
+
+def counting_in_a_loop(iterations_count):
+    # Tracer rewrites code of functions it sees, so use a new function each
+    # time to trace code that hasn't been rewritten yet.
+    count = FunctionType(count_in_a_loop.func_code, globals())
+    return lambda: count(iterations_count)
+
+def benchmark_bytecode_tracing(iterations_count=20000):
+    for selective in [False, True]:
+        print "==> Tracing a loop of %d iterations with the bytecode tracer (selective=%s).." % (iterations_count, selective)
+        elapsed = run_timer("trace_with_bytecode_tracer(counting_in_a_loop(%d), %s)" % (iterations_count, selective),
+                            "pass")
+        print "It took %f seconds to trace." % elapsed
+
+def benchmark_parallel_inspection(modules_count=100, jobs_counts=[1, 2, 4, 8]):
+    print "==> Creating project with %d modules..." % modules_count
+    project_path = tmpdir()
+    module = make_module()
+    for i in range(modules_count):
+        putfile(project_path, "module%s.py" % i, module)
+    init_project(project_path, skip_inspection=True)
+
+    for jobs in jobs_counts:
+        print "==> Inspecting project using %d worker(s).." % jobs
+        elapsed = run_timer("inspect_project_statically(Project('%s'), %d)" % (project_path, jobs),
+                            "from pythoscope.inspector import inspect_project_statically; from pythoscope.store import Project")
+        print "It took %f seconds to inspect." % elapsed
+
+    rmtree(project_path)
+
+def benchmark_fragment_parsing(fragments_count=5000):
+    print "==> Parsing %d fragments with a new driver each time.." % fragments_count
+    setup = """from lib2to3 import pygram, pytree ;\
+               from lib2to3.pgen2 import driver ;\
+               from pythoscope.astbuilder import parse ;\
+             from lib2to3.pygram import python_symbols ;\
+               code = 'def test_something(self):\\n    assert_equal(1, f(2))\\n'"""
+    elapsed = run_timer("for _ in xrange(%d): driver.Driver(pygram.python_grammar, pytree.convert).parse_string(code, True)" % fragments_count,
+                        setup)
+    print "It took %f seconds to parse." % elapsed
+
+    print "==> Parsing %d fragments with astbuilder.parse.." % fragments_count
+    elapsed = run_timer("for _ in xrange(%d): parse(code)" % fragments_count,
+                        setup)
+    print "It took %f seconds to parse." % elapsed
+
+def benchmark_bundled_projects_inspection():
+    projects_path = os.path.join(os.path.dirname(__file__), "projects")
+    for archive in sorted(glob.glob(os.path.join(projects_path, "*.tar.gz"))):
+        print "==> Inspecting %s.." % os.path.basename(archive)
+        project_path = tmpdir()
+        tar = tarfile.open(archive)
+        tar.extractall(project_path)
+        tar.close()
+        init_project(project_path, skip_inspection=True)
+        elapsed = run_timer("inspect_project_statically(Project('%s'))" % project_path,
+                            "from pythoscope.inspector import inspect_project_statically; from pythoscope.store import Project")
+        print "It took %f seconds to inspect." % elapsed
+        rmtree(project_path)
+
+def benchmark_bundled_projects_tracing(projects=[
+        ("Reverend-r17924", ["Reverend_poe_from_homepage.py", "Reverend_poe_from_readme.py"]),
+        ("isodate-0.4.4-src", ["isodate_poe.py"])]):
+    projects_path = os.path.join(os.path.dirname(__file__), "projects")
+    for name, poe_names in projects:
+        print "==> Tracing points of entry of %s.." % name
+        tmp_path = tmpdir()
+        tar = tarfile.open(os.path.join(projects_path, name + ".tar.gz"))
+        tar.extractall(tmp_path)
+        tar.close()
+        project_path = os.path.join(tmp_path, name)
+        init_project(project_path)
+        for poe_name in poe_names:
+            putfile(get_points_of_entry_path(project_path), poe_name,
+                    read_file_contents(os.path.join(projects_path, poe_name)))
+
+        old_cwd = os.getcwd()
+        os.chdir(project_path)
+        sys.path.insert(0, project_path)
+        try:
+            # Modules have to be imported during each run, so we remove
+            # those imported by the previous one from sys.modules. Cache of
+            # the re module would make regular expressions compiled during
+            # imports free after the first run, so it gets purged as well.
+            elapsed = run_timer("""re.purge()
+        for code in codes: exec code in {}
+        for m in sys.modules.keys():
+            if m not in modules: del sys.modules[m]""",
+                                """import re ;\
+                                   modules = sys.modules.keys() ;\
+                                   codes = [compile(read_file_contents(os.path.join(%r, n)), n, 'exec') for n in %r]""" % \
+                                    (projects_path, poe_names))
+            print "It took %f seconds to run the code without tracing." % elapsed
+            elapsed = run_timer("""re.purge()
+        for poe in project.points_of_entry.values(): inspect_point_of_entry(poe)""",
+                                """import re ;\
+                                   from pythoscope.inspector.dynamic import inspect_point_of_entry ;\
+                                   from pythoscope.inspector import inspect_project_statically ;\
+                                   project = Project.from_directory(%r) ;\
+                                   inspect_project_statically(project)""" % project_path)
+            print "It took %f seconds to trace the code." % elapsed
+        finally:
+            sys.path.remove(project_path)
+            os.chdir(old_cwd)
+        rmtree(tmp_path)
+
+def benchmark_library_code_tracing(iterations_count=20000):
+    print "==> Creating project calling a library outside of it.."
+    project_path = tmpdir()
+    library_path = tmpdir()
+    putfile(library_path, "library.py",
+            "def work(n):\n"
+            "    total = 0\n"
+            "    for i in xrange(n):\n"
+            "        total += len(str(i))\n"
+            "    return total\n")
+    putfile(project_path, "module.py",
+            "from library import work\n"
+            "def function(n):\n"
+            "    return work(n)\n")
+    init_project(project_path)
+
+    code = "from module import function\nfunction(%d)\n" % iterations_count
+    setup = """from pythoscope.execution import Execution ;\
+               from pythoscope.inspector.dynamic import inspect_code_in_context, project_tracing_scope ;\
+               sys.modules.pop('module', None) ;\
+               sys.modules.pop('library', None) ;\
+               project = Project.from_directory('%s') ;\
+               code = %r""" % (project_path, code)
+    sys.path.insert(0, project_path)
+    sys.path.insert(0, library_path)
+    try:
+        # Both modules have to be imported under the tracer each time.
+        elapsed = run_timer("""exec code in {}
+        for m in ['module', 'library']: sys.modules.pop(m, None)""", setup)
+        print "It took %f seconds to run the code without tracing." % elapsed
+        elapsed = run_timer("inspect_code_in_context(code, Execution(project))", setup)
+        print "It took %f seconds to trace all the code." % elapsed
+        elapsed = run_timer("inspect_code_in_context(code, Execution(project), project_tracing_scope(project))",
+                            setup)
+        print "It took %f seconds to trace the project code." % elapsed
+    finally:
+        sys.path.remove(project_path)
+        sys.path.remove(library_path)
+
+    rmtree(project_path)
+    rmtree(library_path)
+
+def benchmark_generator_detection(classes_count=50, functions_count=500):
+    code = make_module(classes_count, functions_count)
+    definitions_count = classes_count * 20 + functions_count
+    setup = "from pythoscope.inspector.static import analyze_code, find_generators, is_generator_definition ;\
+             from pythoscope.astbuilder import parse ;\
+             from lib2to3.pygram import python_symbols ;\
+             code = %r ;\
+             tree = parse(code)" % code
+
+    print "==> Detecting generators among %d definitions one by one.." % definitions_count
+    elapsed = run_timer("for node in tree.pre_order(): node.type == python_symbols.funcdef and is_generator_definition(node)",
+                        setup)
+    print "It took %f seconds to detect." % elapsed
+
+    print "==> Detecting generators among %d definitions with a single compile.." % definitions_count
+    elapsed = run_timer("find_generators(code)", setup)
+    print "It took %f seconds to detect." % elapsed
+
+    print "==> Analyzing a module with %d definitions.." % definitions_count
+    elapsed = run_timer("analyze_code(code)", setup)
+    print "It took %f seconds to analyze." % elapsed
+
+def benchmark_directory_walk(modules_count=50, ignored_files_count=5000):
+    project_path = tmpdir()
+    for i in range(modules_count):
+        putfile(project_path, "module%d.py" % i, "")
+    for i in range(ignored_files_count):
+        putfile(project_path, os.path.join("venv", "lib", "package%d" % (i // 50), "file%d.py" % i), "")
+        putfile(project_path, os.path.join("node_modules", "package%d" % (i // 50), "file%d.js" % i), "")
+    setup = "from pythoscope.inspector.file_system import python_modules_below"
+
+    print "==> Walking a project with %d modules and %d files in virtualenv and node_modules without excludes.." % (modules_count, ignored_files_count*2)
+    elapsed = run_timer("python_modules_below(%r, [])" % project_path, setup)
+    print "It took %f seconds to walk." % elapsed
+
+    print "==> Walking a project with %d modules and %d files in virtualenv and node_modules with default excludes.." % (modules_count, ignored_files_count*2)
+    elapsed = run_timer("python_modules_below(%r)" % project_path, setup)
+    print "It took %f seconds to walk." % elapsed
+
+    rmtree(project_path)
+
+def benchmark_lazy_code_trees(modules_count=25):
+    for lazy_code_trees in [False, True]:
+        project_path = tmpdir()
+        module = make_module()
+        for i in range(modules_count):
+            putfile(project_path, "module%s.py" % i, module)
+        init_project(project_path, skip_inspection=True,
+                     lazy_code_trees=lazy_code_trees)
+
+        print "==> Inspecting project with %d modules (lazy code trees: %s).." % \
+            (modules_count, lazy_code_trees)
+        elapsed = run_timer("inspect_project_statically(Project.from_directory('%s'))" % project_path,
+                            "from pythoscope.inspector import inspect_project_statically; from pythoscope.store import Project")
+        print "It took %f seconds to inspect." % elapsed
+
+        project = Project.from_directory(project_path)
+        inspect_project_statically(project)
+        project.save()
+        print "Code trees take %s." % \
+            human_size(directory_size(get_code_trees_path(project_path)))
+        rmtree(project_path)
+
 if __name__ == "__main__":
     benchmark_project_load_performance()
+    benchmark_project_load_performance(sharded_store=True)
+    benchmark_tracing_performance()
+    benchmark_bytecode_tracing()
+    benchmark_library_code_tracing()
+    benchmark_parallel_inspection()
+    benchmark_fragment_parsing()
+    benchmark_bundled_projects_inspection()
+    benchmark_bundled_projects_tracing()
+    benchmark_generator_detection()
+    benchmark_directory_walk()
+    benchmark_lazy_code_trees()